@@ -23,11 +23,14 @@
 
 import argparse
 import collections
+import inspect
 import os
 import re
 
 import torch
 
+from common_utils import get_tied_parameter_aliases, tie_state_dict_aliases
+
 
 def average_checkpoints(args):
     """Loads checkpoints from inputs and returns a model with averaged weights.
@@ -42,6 +45,7 @@ def average_checkpoints(args):
     """
     params_dict = collections.OrderedDict()
     params_keys = None
+    tied_params_aliases = None
     new_state = None
     num_models = len(args.inputs)
 
@@ -62,6 +66,7 @@ def average_checkpoints(args):
         model_params_keys = list(model_params.keys())
         if params_keys is None:
             params_keys = model_params_keys
+            tied_params_aliases = get_tied_parameter_aliases(model_params)
         elif params_keys != model_params_keys:
             raise KeyError(
                 "For checkpoint {}, expected list of params: {}, "
@@ -69,6 +74,9 @@ def average_checkpoints(args):
             )
 
         for k in params_keys:
+            if k in tied_params_aliases:
+                # tied params are averaged once and shared again below
+                continue
             p = model_params[k]
             if isinstance(p, torch.HalfTensor):
                 p = p.float()
@@ -94,10 +102,137 @@ def average_checkpoints(args):
                 averaged_params[k].pow_(1/num_models).round()
             else:
                 averaged_params[k] //= num_models
-    new_state["model"] = averaged_params
+    new_state["model"] = tie_state_dict_aliases(
+        collections.OrderedDict((k, averaged_params.get(k)) for k in params_keys),
+        tied_params_aliases,
+    )
     return new_state
 
 
+def load_model_params_lazily(fpath):
+    """Loads the model params from a checkpoint without reading the tensors into memory.
+
+    The file is memory mapped so that a tensor is only read from disk when it is
+    accessed. Files saved in the legacy (non zip) format cannot be memory mapped and
+    are loaded fully, as are all files with versions of torch whose torch.load has
+    no mmap argument (older than 2.1). Full checkpoints are reduced to their 'model'
+    entry so that the optimizer and scheduler states are never touched when memory
+    mapped and are freed right after loading otherwise.
+
+    Returns:
+      A tuple of the model params and a flag indicating whether the file was a full
+      checkpoint with a 'model' entry or a pure model.
+    """
+    state = None
+    if "mmap" in inspect.signature(torch.load).parameters:
+        try:
+            state = torch.load(fpath, map_location="cpu", mmap=True)
+        except (RuntimeError, TypeError):  # legacy format files can not be memory mapped
+            state = None
+    if state is None:
+        state = torch.load(fpath, map_location="cpu")
+    if isinstance(state, dict) and "model" in state and isinstance(state["model"], dict):
+        return state.pop("model"), True
+    return state, False
+
+
+def get_averaging_weights(args):
+    """Returns the weight of each input checkpoint in the average.
+
+    The weights are uniform by default. If args.weights is given then they are
+    normalized to sum up to 1. If args.ema_decay is given then the inputs are
+    assumed to be in chronological order and the weights are those of an
+    exponential moving average ema = decay*ema + (1-decay)*params which starts
+    from the first checkpoint.
+    """
+    num_models = len(args.inputs)
+    if args.weights is not None:
+        if len(args.weights) != num_models:
+            raise ValueError(
+                "Got {} weights for {} checkpoints".format(len(args.weights), num_models)
+            )
+        total_weight = sum(args.weights)
+        return [weight / total_weight for weight in args.weights]
+    if args.ema_decay is not None:
+        return [args.ema_decay ** (num_models - 1)] + [
+            (1 - args.ema_decay) * args.ema_decay ** (num_models - 1 - i)
+            for i in range(1, num_models)
+        ]
+    return [1.0 / num_models] * num_models
+
+
+def average_checkpoints_streaming(args):
+    """Averages the model params of the inputs one checkpoint at a time.
+
+    Unlike average_checkpoints, only the model params are read (the 'model' entry
+    of full checkpoints or the .pure_model files) and they are memory mapped when
+    torch supports it. The arithmetic (uniform, weighted and EMA) and geometric
+    means are accumulated into one running float32 (float64 for integer params)
+    tensor per parameter and each checkpoint is released before the next one is
+    loaded. Thus the memory needed is that of the accumulated model plus a single
+    checkpoint instead of several full checkpoints.
+
+    Args:
+      args: The args passed to the script.
+
+    Returns:
+      A dict with the averaged params under the 'model' key if the inputs are full
+      checkpoints or the averaged params themselves if the inputs are pure models.
+    """
+    weights = get_averaging_weights(args)
+    if args.geometric_mean and (args.weights is not None or args.ema_decay is not None):
+        raise ValueError("Weighted and exponential moving averages are arithmetic means.")
+    print("Averaging weights:", weights)
+
+    accumulated_params = collections.OrderedDict()
+    params_dtypes = {}
+    is_full_checkpoint = None
+    for i, (fpath, weight) in enumerate(zip(args.inputs, weights)):
+        print("Loading: ", fpath)
+        model_params, is_full = load_model_params_lazily(fpath)
+        if is_full_checkpoint is None:
+            is_full_checkpoint = is_full
+            params_keys = list(model_params.keys())
+            tied_params_aliases = get_tied_parameter_aliases(model_params)
+        elif list(model_params.keys()) != params_keys:
+            raise KeyError(
+                "For checkpoint {}, expected list of params: {}, "
+                "but found: {}".format(fpath, params_keys, list(model_params.keys()))
+            )
+
+        for k in params_keys:
+            if k in tied_params_aliases:
+                # tied params are averaged once and shared again below
+                continue
+            if i == 0:
+                params_dtypes[k] = model_params[k].dtype
+            accumulator_dtype = torch.float32 if params_dtypes[k].is_floating_point else torch.float64
+            p = model_params[k].to(accumulator_dtype)
+            if i == 0:
+                # NOTE: clone() is needed in case p is the tensor of the checkpoint itself
+                accumulated_params[k] = p.clone() if args.geometric_mean else p * weight
+            elif args.geometric_mean:
+                accumulated_params[k] *= p
+            else:
+                accumulated_params[k].add_(p, alpha=weight)
+        # release the checkpoint before the next one is loaded
+        model_params = p = None
+
+    averaged_params = collections.OrderedDict()
+    for k in params_keys:
+        if k in tied_params_aliases:
+            averaged_params[k] = None
+            continue
+        accumulated = accumulated_params.pop(k)
+        if args.geometric_mean:
+            accumulated.pow_(1 / len(args.inputs))
+        if not params_dtypes[k].is_floating_point:
+            accumulated.round_()
+        averaged_params[k] = accumulated.to(params_dtypes[k])
+    averaged_params = tie_state_dict_aliases(averaged_params, tied_params_aliases)
+    return {"model": averaged_params} if is_full_checkpoint else averaged_params
+
+
 def last_n_checkpoints(paths, n, update_based, upper_bound=None):
     assert len(paths) == 1
     path = paths[0]
@@ -133,10 +268,19 @@ def main():
                         help='Write the new checkpoint containing the averaged weights to this path.')
     parser.add_argument('--geometric_mean', action='store_true',
                         help='Should we do geometric mean instead of arithmetic mean?')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Should we accumulate the average one checkpoint at a time? Only one checkpoint is held in memory at a time along with the running average. Only the model params are read and written. The optimizer and scheduler states are dropped. Use this when the checkpoints are too large to be loaded into memory together. The inputs can either be full checkpoints or .pure_model files. With torch 2.1 or newer the checkpoints are memory mapped so even a single checkpoint is never fully read into memory. With older versions of torch each checkpoint is loaded fully and its optimizer and scheduler states are freed right after loading.')
+    parser.add_argument('--weights', default=None, type=float, nargs='+',
+                        help='The weight of each input checkpoint. These are normalized to sum up to 1. Only used with --streaming.')
+    parser.add_argument('--ema_decay', default=None, type=float,
+                        help='Compute an exponential moving average of the input checkpoints with this decay instead of a uniform average. The inputs should be in chronological order. Only used with --streaming.')
     args = parser.parse_args()
     print(args)
 
-    new_state = average_checkpoints(args)
+    if args.streaming:
+        new_state = average_checkpoints_streaming(args)
+    else:
+        new_state = average_checkpoints(args)
     torch.save(new_state, args.output)
     print("Finished writing averaged checkpoint to {}".format(args.output))
 
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import time
+import torch
+##
+
+## Huggingface imports
+from transformers.generation_logits_process import EncoderNoRepeatNGramLogitsProcessor, LogitsProcessorList, NoRepeatNGramLogitsProcessor
+##
+
+
+def legacy_get_ngrams(ngram_size, prev_input_ids, num_hypos):
+    """The per hypothesis n-gram dictionaries which the n-gram blocking processors used to build at every step. They are kept here only as a reference for the benchmark."""
+    generated_ngrams = [{} for _ in range(num_hypos)]
+    for idx in range(num_hypos):
+        gen_tokens = prev_input_ids[idx].tolist()
+        generated_ngram = generated_ngrams[idx]
+        for ngram in zip(*[gen_tokens[i:] for i in range(ngram_size)]):
+            prev_ngram_tuple = tuple(ngram[:-1])
+            generated_ngram[prev_ngram_tuple] = generated_ngram.get(prev_ngram_tuple, []) + [ngram[-1]]
+    return generated_ngrams
+
+def legacy_get_generated_ngrams(banned_ngrams, prev_input_ids, ngram_size, cur_len):
+    """Looks up the tokens which follow the last ngram_size-1 tokens of a hypothesis."""
+    start_idx = cur_len + 1 - ngram_size
+    ngram_idx = tuple(prev_input_ids[start_idx:cur_len].tolist())
+    return banned_ngrams.get(ngram_idx, [])
+
+def legacy_no_repeat_ngram(ngram_size, input_ids, scores):
+    """The old no_repeat_ngram_size processor."""
+    num_hypos, cur_len = scores.shape[0], input_ids.shape[-1]
+    if cur_len + 1 < ngram_size:
+        return scores
+    generated_ngrams = legacy_get_ngrams(ngram_size, input_ids, num_hypos)
+    for hypo_idx in range(num_hypos):
+        scores[hypo_idx, legacy_get_generated_ngrams(generated_ngrams[hypo_idx], input_ids[hypo_idx], ngram_size, cur_len)] = -float("inf")
+    return scores
+
+def legacy_encoder_no_repeat_ngram(ngram_size, encoder_ngrams, input_ids, scores):
+    """The old encoder_no_repeat_ngram_size processor given the n-gram dictionaries of the encoder input ids."""
+    num_hypos, cur_len = scores.shape[0], input_ids.shape[-1]
+    num_beams = num_hypos // len(encoder_ngrams)
+    for hypo_idx in range(num_hypos):
+        scores[hypo_idx, legacy_get_generated_ngrams(encoder_ngrams[hypo_idx // num_beams], input_ids[hypo_idx], ngram_size, cur_len)] = -float("inf")
+    return scores
+
+def run_benchmark(name, make_step_fn, steps, num_repeats):
+    """Runs the processor over all decoding steps num_repeats times and prints the average time per step. make_step_fn is called once per repeat and returns the function which processes a step so that any state starts afresh. Only the processor is timed."""
+    banned = 0
+    elapsed = 0.0
+    for _ in range(num_repeats):
+        step_fn = make_step_fn()
+        for input_ids, beam_idx, scores in steps:
+            scores = scores.clone()
+            if scores.is_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+            scores = step_fn(input_ids, beam_idx, scores)
+            if scores.is_cuda:
+                torch.cuda.synchronize()
+            elapsed += time.time() - start
+            banned += torch.isinf(scores).sum().item()
+    print(name.ljust(45), "%10.3f ms/step" % (1000*elapsed/(num_repeats*len(steps))), "%8.3f seconds" % elapsed, "%12d banned tokens" % banned)
+    return banned
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmark comparing the tensorized n-gram blocking of no_repeat_ngram_size and encoder_no_repeat_ngram_size with the old per hypothesis dictionaries",
+    )
+    parser.add_argument('--batch_size', default=64, type=int, help='The number of sentences decoded together.')
+    parser.add_argument('--beam_size', default=8, type=int, help='The number of beams per sentence.')
+    parser.add_argument('--source_length', default=40, type=int, help='The length of the encoder input ids.')
+    parser.add_argument('--max_decode_length', default=60, type=int, help='The number of decoding steps.')
+    parser.add_argument('--vocab_size', default=32000, type=int, help='The size of the vocabulary.')
+    parser.add_argument('--token_vocab_size', default=10, type=int, help='The tokens of the hypotheses are drawn from the first token_vocab_size tokens so that n-grams repeat and get banned like they would in real translations.')
+    parser.add_argument('--no_repeat_ngram_size', default=4, type=int, help='The size of the n-grams which may not repeat in the hypotheses.')
+    parser.add_argument('--encoder_no_repeat_ngram_size', default=4, type=int, help='The size of the n-grams of the encoder input ids which may not occur in the hypotheses.')
+    parser.add_argument('--num_repeats', default=3, type=int, help='The number of times all decoding steps are processed.')
+    parser.add_argument('--gpu', action='store_true', help='Run on the GPU.')
+    args = parser.parse_args()
+    print(args)
+
+    device = "cuda" if args.gpu else "cpu"
+    torch.manual_seed(0)
+    num_hypos = args.batch_size*args.beam_size
+    encoder_input_ids = torch.randint(0, args.token_vocab_size, (args.batch_size, args.source_length), device=device)
+    input_ids = torch.randint(0, args.token_vocab_size, (num_hypos, 1), device=device)
+    steps = [] ## The input ids of each step along with the reordering of the beams which led to them like in beam search.
+    for _ in range(args.max_decode_length):
+        beam_idx = (torch.arange(num_hypos, device=device) // args.beam_size)*args.beam_size + torch.randint(0, args.beam_size, (num_hypos,), device=device)
+        input_ids = torch.cat([input_ids[beam_idx], torch.randint(0, args.token_vocab_size, (num_hypos, 1), device=device)], dim=-1)
+        steps.append((input_ids, beam_idx, torch.zeros(num_hypos, args.vocab_size, device=device)))
+    print("Blocking n-grams for", args.batch_size, "sentences with", args.beam_size, "beams over", args.max_decode_length, "steps")
+
+    def make_no_repeat_ngram():
+        processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(args.no_repeat_ngram_size)])
+        def step_fn(input_ids, beam_idx, scores):
+            processors.reorder_state(beam_idx) ## The state of the previous step is reordered before the next step just like beam search does.
+            return processors(input_ids, scores)
+        return step_fn
+    legacy_banned = run_benchmark("legacy no_repeat_ngram_size", lambda: lambda input_ids, beam_idx, scores: legacy_no_repeat_ngram(args.no_repeat_ngram_size, input_ids, scores), steps, args.num_repeats)
+    banned = run_benchmark("tensorized no_repeat_ngram_size", make_no_repeat_ngram, steps, args.num_repeats)
+    assert banned == legacy_banned, "The tensorized processor banned different tokens."
+
+    encoder_ngrams = legacy_get_ngrams(args.encoder_no_repeat_ngram_size, encoder_input_ids, args.batch_size)
+    legacy_banned = run_benchmark("legacy encoder_no_repeat_ngram_size", lambda: lambda input_ids, beam_idx, scores: legacy_encoder_no_repeat_ngram(args.encoder_no_repeat_ngram_size, encoder_ngrams, input_ids, scores), steps, args.num_repeats)
+    def make_encoder_no_repeat_ngram():
+        processor = EncoderNoRepeatNGramLogitsProcessor(args.encoder_no_repeat_ngram_size, encoder_input_ids)
+        return lambda input_ids, beam_idx, scores: processor(input_ids, scores)
+    banned = run_benchmark("tensorized encoder_no_repeat_ngram_size", make_encoder_no_repeat_ngram, steps, args.num_repeats)
+    assert banned == legacy_banned, "The tensorized processor banned different tokens."
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import random
+import time
+import numpy as np
+##
+
+## Our imports
+from common_utils import span_mask_sentence_batch, span_mask_token_id_batch
+##
+
+
+def legacy_span_mask(sentence_split, mask_tok, mask_percent, args):
+    """The per sentence poisson span masking loop which used to be copied into every batch generator. It is kept here only as a reference for the benchmark."""
+    sentence_split = list(sentence_split)
+    sent_len = len(sentence_split)
+    mask_count = 0
+    max_mask_count = int(mask_percent*sent_len)
+    spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
+    curr_sent_len = sent_len
+    while mask_count < max_mask_count:
+        try:
+            span_to_mask = spans_to_mask[0]
+            del spans_to_mask[0]
+            if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
+                continue
+            idx_to_mask = random.randint(sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1))
+            if mask_tok not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask]:
+                sentence_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
+                mask_count += span_to_mask
+                curr_sent_len -= (span_to_mask-1)
+        except:
+            break
+    return " ".join(sentence_split)
+
+def run_benchmark(name, mask_fn, batches, num_sentences, num_words):
+    """Runs the masking function over all batches and prints the throughput and the fraction of words that were masked."""
+    start = time.time()
+    masked_words = 0
+    for batch in batches:
+        for masked_sentence in mask_fn(batch):
+            masked_words += len(masked_sentence)
+    elapsed = time.time() - start
+    print(name.ljust(40), "%10.1f sentences/sec" % (num_sentences/elapsed), "%8.3f seconds" % elapsed, "%6.3f output/input length ratio" % (masked_words/num_words))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmark comparing the vectorized span masking in common_utils.py with the old per sentence masking loop",
+    )
+    parser.add_argument('--input_file', default='examples/data/train.en', type=str,
+                        help='A file with one sentence per line. The sentences are split on spaces just like the batch generators do.')
+    parser.add_argument('--num_sentences', default=100000, type=int,
+                        help='The number of sentences to mask. The lines of the input file are repeated if needed.')
+    parser.add_argument('--batch_size', default=128, type=int,
+                        help='The number of sentences masked together by the vectorized masking.')
+    parser.add_argument('--token_masking_lambda', default=3.5, type=float, help="The value for the poisson sampling lambda value")
+    parser.add_argument('--mask_percent', default=0.3, type=float, help="The fraction of words to be masked.")
+    parser.add_argument('--future_prediction', action='store_true',
+                        help='Mask only the second half of each sentence.')
+    parser.add_argument('--mask_individual_tokens', action='store_true', help="Benchmark token masking instead of text infilling. The legacy loop only supports text infilling.")
+    args = parser.parse_args()
+    print(args)
+
+    mask_tok = "[MASK]"
+    sentences = [line.strip().split(" ") for line in open(args.input_file)]
+    sentences = [sentences[i % len(sentences)] for i in range(args.num_sentences)]
+    num_words = sum(len(sentence) for sentence in sentences)
+    batches = [sentences[i:i+args.batch_size] for i in range(0, len(sentences), args.batch_size)]
+    ids_batches = [[np.arange(5, 5+len(sentence)) for sentence in batch] for batch in batches] ## Fake token ids with the same lengths as the words.
+    print("Masking", args.num_sentences, "sentences with", num_words, "words in batches of", args.batch_size)
+
+    if not args.mask_individual_tokens:
+        run_benchmark("legacy per sentence loop", lambda batch: [legacy_span_mask(sentence, mask_tok, args.mask_percent, args).split(" ") for sentence in batch], batches, args.num_sentences, num_words)
+    run_benchmark("span_mask_sentence_batch", lambda batch: [masked_sentence.split(" ") for masked_sentence in span_mask_sentence_batch(batch, mask_tok, [args.mask_percent]*len(batch), args)], batches, args.num_sentences, num_words)
+    run_benchmark("span_mask_token_id_batch", lambda batch: span_mask_token_id_batch(batch, 2, [args.mask_percent]*len(batch), args), ids_batches, args.num_sentences, num_words)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import functools
+import multiprocessing
+##
+
+## Huggingface imports
+from transformers import AutoTokenizer, MBartTokenizer, MBart50Tokenizer
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def binarize_shard(args, file_name):
+    """Loads the tokenizer and binarizes a single shard. This is run in a separate process for each shard."""
+    if args.use_official_pretrained:
+        if "50" in args.tokenizer_name_or_path:
+            tok = MBart50Tokenizer.from_pretrained(args.tokenizer_name_or_path)
+        else:
+            tok = MBartTokenizer.from_pretrained(args.tokenizer_name_or_path)
+    else:
+        tok = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
+    binarize_file(tok, file_name)
+    return file_name
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to tokenize training shards once so that pretrain_nmt.py and train_nmt.py can create batches "
+        "from memory mapped token ids via the --use_binarized_shards flag",
+    )
+    parser.add_argument('--files', required=True, type=str,
+                        help='Comma separated list of file prefixes. These are the same files passed to the mono_src, train_src or train_tgt flags of the training scripts. For parallel corpora, specify both the source and target files.')
+    parser.add_argument('--num_shards', required=True, type=int,
+                        help='The number of shards per file. This is the world size (number of GPUs) used for training.')
+    parser.add_argument('--shard_files', action='store_true',
+                        help='Should we shard the files before binarizing them? Set to true only if the data is not already pre-sharded. If you do this then dont pass the shard_files flag to the training script or else the binarized shards will be out of date.')
+    parser.add_argument('--tokenizer_name_or_path', default='ai4bharat/indic-bert', type=str,
+                        help='Name of or path to the tokenizer')
+    parser.add_argument('--use_official_pretrained', action='store_true',
+                        help='Use this flag if the tokenizer is that of an official MBART model.')
+    parser.add_argument('--num_workers', default=8, type=int,
+                        help='The number of shards which will be binarized in parallel.')
+    args = parser.parse_args()
+    print(args)
+
+    files = args.files.strip().split(",")
+    if args.shard_files:
+        shard_files_mono({file_name: file_name for file_name in files}, args.num_shards) ## Source and target files are sharded independently but since they have the same number of lines their shards will be parallel.
+
+    shards = [file_name+"."+"%02d" % shard_id for file_name in files for shard_id in range(args.num_shards)]
+    pool = multiprocessing.Pool(args.num_workers)
+    for file_name in pool.imap_unordered(functools.partial(binarize_shard, args), shards):
+        print("Finished binarizing", file_name)
+    pool.close()
+    pool.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,11 @@ import os
 import argparse
 import time
 import sys
+import mmap
+import json
+import hashlib
+import threading
+import sqlite3
 os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"   # see issue #152
 ##
 
@@ -44,6 +49,7 @@ from torch.nn.parallel import DistributedDataParallel
 import torch.multiprocessing as mp
 import torch.distributed as dist
 from torch.optim import Adam
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 ##
 
 ## Our imports
@@ -57,6 +63,7 @@ import math
 import sacrebleu
 from rouge_score import rouge_scorer
 import functools
+import collections
 import matplotlib.pyplot as plt  # drawing heat map of attention weights
 from matplotlib import rcParams
 import matplotlib.colors as mcolors
@@ -249,6 +256,27 @@ def remap_embeddings(our_model_dict, model_to_load_dict, args):
     model_to_load_dict["module.final_logits_bias"] = our_model_dict["module.final_logits_bias"]
     return model_to_load_dict
 
+def get_tied_parameter_aliases(state_dict):
+    """This method finds the entries of a state dict which are aliases of an earlier entry. When layers are shared via encoder_tying_config or decoder_tying_config, the state dict has a key for every position of a shared layer but all of them point to the same tensor. Returns a dictionary mapping each alias to the first key holding the same tensor."""
+    first_keys = {}
+    aliases = {}
+    for key, value in state_dict.items():
+        if not torch.is_tensor(value) or value.numel() == 0: ## Empty tensors have no memory to share.
+            continue
+        tensor_id = (value.data_ptr(), value.dtype, value.device, tuple(value.size()), tuple(value.stride()))
+        if tensor_id in first_keys:
+            aliases[key] = first_keys[tensor_id]
+        else:
+            first_keys[tensor_id] = key
+    return aliases
+
+def tie_state_dict_aliases(state_dict, aliases):
+    """This method makes each alias in a state dict point to the tensor of the key it is an alias of. Torch saves a tensor only once no matter how many keys point to it so tied layers are stored once on disk. When loading, every position of a shared layer gets the parameters of its first position."""
+    for alias, key in aliases.items():
+        if key in state_dict:
+            state_dict[alias] = state_dict[key]
+    return state_dict
+
 def remap_embeddings_eliminate_components_and_eliminate_mismatches(our_model_dict, model_to_load_dict, args):
     """This method first remaps embeddings from pretrained to current model and then eliminates mismatched layers between the pretrained model and the current model. A mismatch is when the size of the pretrained parameter is not the same as the parameter of the current model."""
     print("Remapping embeddings.")
@@ -277,7 +305,10 @@ def remap_embeddings_eliminate_components_and_eliminate_mismatches(our_model_dic
             if our_model_dict[our_model_key].size() != model_to_load_dict[our_model_key].size():
                 print("Eliminating", our_model_key)
                 del model_to_load_dict[our_model_key]
-    return model_to_load_dict
+    tied_parameter_aliases = get_tied_parameter_aliases(our_model_dict) ## Layers shared in the current model are loaded from their first position only. Otherwise the parameters of the last position would silently overwrite the others.
+    if len(tied_parameter_aliases) > 0:
+        print("Loading", len(tied_parameter_aliases), "tied params from the params they are tied to.")
+    return tie_state_dict_aliases(model_to_load_dict, tied_parameter_aliases)
 
 def init_weights(module, in_features, out_features):
     """Method to initialize model weights. Not used for now but might be used in the future. Tries to mimic t2t initialization.
@@ -294,58 +325,324 @@ def init_weights(module, in_features, out_features):
             module.weight.data[module.padding_idx].zero_()
             
 def shard_files_mono(files, world_size):
-    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed."""
+    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed. The files are streamed (see shard_file) and are sharded in parallel, one process per language."""
     print("Sharding files into", world_size, "parts")
-    for lang in files:
-        infile = open(files[lang]).readlines()
-        num_lines = len(infile)
-        lines_per_shard = math.ceil(num_lines/world_size)
-        print("For language:",lang," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
-        for shard_id in range(world_size):
-            outfile = open(files[lang]+"."+"%02d" % shard_id, "w")
-            for line in infile[shard_id*lines_per_shard:(shard_id+1)*lines_per_shard]:
-                outfile.write(line)
-            outfile.flush()
-            outfile.close()
-        print("File for language", lang, "has been sharded.")
-        sys.stdout.flush()
+    with mp.Pool(min(len(files), os.cpu_count())) as pool:
+        for lang, num_lines in zip(files, pool.starmap(shard_file, [(files[lang], world_size) for lang in files])):
+            print("File for language", lang, "with", num_lines, "lines has been sharded.")
+    sys.stdout.flush()
 
 def shard_files_bi(files, world_size):
-    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed."""
+    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed. The files are streamed (see shard_file) and are counted and sharded in parallel, one process per file. Like zipping the source and target lines, lines beyond the length of the shorter file of a pair are ignored."""
     print("Sharding files into", world_size, "parts")
+    file_names = list(dict.fromkeys(file_name for pair in files for file_name in files[pair])) ## A file may appear in several pairs such as the target file of a copying task. It must be sharded only once.
+    with mp.Pool(min(len(file_names), os.cpu_count())) as pool:
+        line_counts = dict(zip(file_names, pool.map(count_lines, file_names)))
+        changed = True
+        while changed: ## The files of every pair must have the same number of lines, even if a file is shared with another pair.
+            changed = False
+            for pair in files:
+                pair_num_lines = min(line_counts[file_name] for file_name in files[pair])
+                for file_name in files[pair]:
+                    changed = changed or line_counts[file_name] != pair_num_lines
+                    line_counts[file_name] = pair_num_lines
+        num_lines = {pair: line_counts[files[pair][0]] for pair in files}
+        pool.starmap(shard_file, [(file_name, world_size, line_counts[file_name]) for file_name in file_names])
     for pair in files:
-        infile = list(zip(open(files[pair][0]).readlines(), open(files[pair][1]).readlines()))
-        num_lines = len(infile)
-        lines_per_shard = math.ceil(num_lines/world_size)
-        print("For language pair:",pair," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
-        for shard_id in range(world_size):
-            srcoutfile = open(files[pair][0]+"."+"%02d" % shard_id, "w")
-            tgtoutfile = open(files[pair][1]+"."+"%02d" % shard_id, "w")
-            for src_line, tgt_line in infile[shard_id*lines_per_shard:(shard_id+1)*lines_per_shard]:
-                srcoutfile.write(src_line)
-                tgtoutfile.write(tgt_line)
-            srcoutfile.flush()
-            srcoutfile.close()
-            tgtoutfile.flush()
-            tgtoutfile.close()
-        print("File for language pair", pair, "has been sharded.")
-        sys.stdout.flush()
-        
+        print("Files for language pair", pair, "with", num_lines[pair], "lines have been sharded.")
+    sys.stdout.flush()
+
+def count_lines(file_name):
+    """Returns the number of lines in a file using the cached line offsets."""
+    return len(load_line_offsets(file_name)) - 1
+
+def shard_file(file_name, world_size, num_lines=None, chunk_size=2**26):
+    """This method splits the first num_lines lines (all lines by default) of a file into world_size shards of contiguous lines without loading the file into RAM. The line offsets come from the cache maintained by load_line_offsets, so after the first time the file is only read once while its byte ranges are copied into the shards. A manifest with the md5 checksums of the file and the shards is saved in file_name.shards. If the manifest matches the file and the existing shards then sharding is skipped. Returns the number of lines sharded."""
+    offsets = load_line_offsets(file_name)
+    num_lines = len(offsets) - 1 if num_lines is None else num_lines
+    lines_per_shard = math.ceil(num_lines/world_size)
+    shard_file_names = [file_name+"."+"%02d" % shard_id for shard_id in range(world_size)]
+    manifest_file_name = file_name+".shards"
+    file_stat = os.stat(file_name)
+    if os.path.exists(manifest_file_name):
+        manifest = json.load(open(manifest_file_name))
+        if manifest["world_size"] == world_size and manifest["num_lines"] == num_lines and all(os.path.exists(shard_file_name) for shard_file_name in shard_file_names):
+            if (manifest["size"], manifest["mtime"]) == (file_stat.st_size, file_stat.st_mtime_ns) or compute_md5(file_name, chunk_size=chunk_size) == manifest["md5"]: ## Only rehash the file if it was touched.
+                if [compute_md5(shard_file_name, chunk_size=chunk_size) for shard_file_name in shard_file_names] == manifest["shard_md5s"]:
+                    print("Shards of", file_name, "match the checksums in", manifest_file_name, "so sharding is skipped.")
+                    sys.stdout.flush()
+                    return num_lines
+    print("For file:", file_name, " the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
+    sys.stdout.flush()
+    file_md5 = hashlib.md5()
+    shard_md5s = []
+    with open(file_name, "rb") as infile:
+        for shard_id, shard_file_name in enumerate(shard_file_names):
+            start = offsets[min(shard_id*lines_per_shard, num_lines)]
+            end = offsets[min((shard_id+1)*lines_per_shard, num_lines)]
+            shard_md5 = hashlib.md5()
+            infile.seek(start)
+            with open(shard_file_name+".tmp", "wb") as outfile:
+                while start < end:
+                    chunk = infile.read(min(chunk_size, end-start))
+                    outfile.write(chunk)
+                    file_md5.update(chunk)
+                    shard_md5.update(chunk)
+                    start += len(chunk)
+            os.replace(shard_file_name+".tmp", shard_file_name)
+            shard_md5s.append(shard_md5.hexdigest())
+        infile.seek(offsets[num_lines]) ## Lines which were ignored are a part of the file checksum as well.
+        for chunk in iter(functools.partial(infile.read, chunk_size), b""):
+            file_md5.update(chunk)
+    manifest = {"world_size": world_size, "num_lines": num_lines, "size": file_stat.st_size, "mtime": file_stat.st_mtime_ns, "md5": file_md5.hexdigest(), "shard_md5s": shard_md5s}
+    with open(manifest_file_name+".tmp", "w") as outfile:
+        json.dump(manifest, outfile)
+    os.replace(manifest_file_name+".tmp", manifest_file_name)
+    return num_lines
+
+def compute_md5(file_name, chunk_size=2**26):
+    """Returns the md5 checksum of a file which is read in chunks."""
+    md5 = hashlib.md5()
+    with open(file_name, "rb") as infile:
+        for chunk in iter(functools.partial(infile.read, chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def binarize_file(tok, file_name, chunk_size=10000):
+    """This method tokenizes a (shard) file once and saves the token ids so that batches can be created without calling the tokenizer during training. Two files are written: file_name.bin which contains the token ids of all lines concatenated as int32 and file_name.idx which contains the int64 offsets of each line into the former file. Line i is thus ids[offsets[i]:offsets[i+1]]. Special tokens such as language indicators and EOS are not stored and are added when batching."""
+    print("Binarizing", file_name)
+    sys.stdout.flush()
+    num_lines = 0
+    num_tokens = 0
+    with open(file_name) as infile, open(file_name+".bin", "wb") as idsfile, open(file_name+".idx", "wb") as idxfile:
+        np.array([0], dtype=np.int64).tofile(idxfile)
+        lines = []
+        for line in infile:
+            lines.append(line.strip())
+            if len(lines) == chunk_size:
+                num_lines, num_tokens = binarize_lines(tok, lines, idsfile, idxfile, num_lines, num_tokens)
+                lines = []
+        if len(lines) != 0:
+            num_lines, num_tokens = binarize_lines(tok, lines, idsfile, idxfile, num_lines, num_tokens)
+    print("Binarized", num_lines, "lines containing", num_tokens, "tokens from", file_name)
+    sys.stdout.flush()
+
+def binarize_lines(tok, lines, idsfile, idxfile, num_lines, num_tokens):
+    """Tokenizes a chunk of lines and appends their ids and offsets to the already open binarized files. Returns the updated line and token counts."""
+    all_ids = tok(lines, add_special_tokens=False).input_ids
+    lengths = np.array([len(ids) for ids in all_ids], dtype=np.int64)
+    np.concatenate([np.array(ids, dtype=np.int32) for ids in all_ids] + [np.zeros(0, dtype=np.int32)]).tofile(idsfile)
+    (num_tokens + np.cumsum(lengths)).tofile(idxfile)
+    return num_lines + len(lines), num_tokens + int(lengths.sum())
+
+def load_binarized_file(file_name):
+    """Memory maps the token ids and offsets created by binarize_file. Nothing is read into RAM until a line is accessed so this is cheap even for very large shards."""
+    token_ids = np.memmap(file_name+".bin", dtype=np.int32, mode="r") if os.path.getsize(file_name+".bin") > 0 else np.zeros(0, dtype=np.int32) ## Empty files cannot be memory mapped.
+    offsets = np.memmap(file_name+".idx", dtype=np.int64, mode="r")
+    return token_ids, offsets
+
+def pad_token_ids(token_id_lists, pad_token_id, hard_truncate_length=0):
+    """Converts a list of token id sequences into a padded LongTensor of size (number of sequences, length of longest sequence). If hard_truncate_length is positive then the padded sequences are truncated to that length."""
+    max_len = max(len(token_ids) for token_ids in token_id_lists)
+    padded_ids = np.full((len(token_id_lists), max_len), pad_token_id, dtype=np.int64)
+    for idx, token_ids in enumerate(token_id_lists):
+        padded_ids[idx, :len(token_ids)] = token_ids
+    if hard_truncate_length > 0 and max_len > hard_truncate_length: ## Truncate again if we exceed the maximum sequence length.
+        padded_ids = padded_ids[:,:hard_truncate_length]
+    return torch.from_numpy(padded_ids)
+
+def bucket_examples_by_length(lengths, batch_size, batch_size_indicates_lines=False, shuffle=True):
+    """This method sorts a pool of examples by their lengths and cuts the sorted pool into batches. lengths is a matrix of size (number of examples, number of sequences per example) such as the source and target lengths. The batches fill the token budget batch_size computed as the maximum length in the batch times the number of examples, or contain batch_size examples if batch_size_indicates_lines is set. If shuffle is set then the batches are shuffled so that consecutive batches do not have similar lengths. Returns a list of arrays of example indices."""
+    lengths = np.asarray(lengths, dtype=np.int64).reshape(len(lengths), -1)
+    order = np.lexsort(lengths.T[::-1]) ## Sort by the first column and break ties using the remaining columns.
+    example_lengths = lengths.max(axis=1)
+    batches = []
+    batch_start = 0
+    max_len = 0
+    for position, idx in enumerate(order):
+        curr_max_len = max(max_len, example_lengths[idx])
+        num_examples = position - batch_start
+        if num_examples > 0 and ((batch_size_indicates_lines and num_examples == batch_size) or (not batch_size_indicates_lines and curr_max_len*(num_examples+1) > batch_size)):
+            batches.append(order[batch_start:position])
+            batch_start = position
+            curr_max_len = example_lengths[idx]
+        max_len = curr_max_len
+    if batch_start < len(order):
+        batches.append(order[batch_start:])
+    if shuffle:
+        random.shuffle(batches)
+    return batches
+
+def compute_padding_efficiency(input_masks, labels, pad_token_id):
+    """This method computes the fraction of the encoder and decoder tokens in a batch which are not padding tokens. Higher values mean that less computation is wasted on padding. Call it on the batch before it is moved to the GPU since reading the counts of GPU tensors waits for all queued GPU work."""
+    num_tokens = input_masks.sum().item() + (labels != pad_token_id).sum().item()
+    return num_tokens/(input_masks.numel() + labels.numel())
+
+def get_token_id(tok, token):
+    """Returns the id of a special token such as a language indicator token, EOS or the mask token."""
+    return tok([token], add_special_tokens=False).input_ids[0][0]
+
+def get_decoding_shard_line_numbers(num_lines, rank, world_size, strategy="contiguous"):
+    """This method returns the line numbers of the test set which should be decoded by the process with the given rank. Contiguous sharding gives each process a block of consecutive lines with the first num_lines % world_size processes getting one extra line. Strided sharding gives the process the lines rank, rank+world_size, rank+2*world_size and so on."""
+    if strategy == "strided":
+        return list(range(rank, num_lines, world_size))
+    shard_size, remainder = divmod(num_lines, world_size)
+    shard_start = rank*shard_size + min(rank, remainder)
+    return list(range(shard_start, shard_start + shard_size + (1 if rank < remainder else 0)))
+
+def merge_decoding_shards(args, num_sequences_per_line=1, test_tgt=None):
+    """This method merges the partial translation files written by each decoding process into test_tgt (args.test_tgt by default) in the order of the lines of args.test_src. Each line of the test set has num_sequences_per_line lines in the partial files. The partial files are deleted after merging and the best translation of each line is returned so that BLEU can be computed once."""
+    test_tgt = args.test_tgt if test_tgt is None else test_tgt
+    num_lines = len(open(args.test_src).readlines()) ## Counted in the same way as the lines are read for decoding. This also avoids every process trying to build the line offsets cache of count_lines next to the test set at the same time.
+    translations_by_line = [None]*num_lines
+    for rank in range(args.world_size):
+        shard_file_name = test_tgt+"."+"%02d" % rank
+        with open(shard_file_name) as shard_file:
+            shard_translations = shard_file.readlines()
+        for idx, line_number in enumerate(get_decoding_shard_line_numbers(num_lines, rank, args.world_size, args.decoding_shard_strategy)):
+            translations_by_line[line_number] = shard_translations[idx*num_sequences_per_line:(idx+1)*num_sequences_per_line]
+        os.remove(shard_file_name)
+    hyp = []
+    with open(test_tgt, 'w') as outf:
+        for line_translations in translations_by_line:
+            outf.write("".join(line_translations))
+            hyp.append(line_translations[0].rstrip("\n"))
+    return hyp
+
+TRANSLATION_MEMORY_IGNORED_ARGS = ["nodes", "gpus", "nr", "ipaddr", "port", "world_size", "cpu", "test_src", "test_tgt", "test_ref", "export_dir", "export_format", "batch_size", "max_decode_batch_tokens", "length_sorted_decoding", "decoding_shard_strategy", "translation_memory", "translation_memory_max_entries", "deduplicate_test_src"] ## These only decide how and where the test set is decoded and not what its translations are. The batching args are among them because decode_test_set computes the length limits of each line from its own length and not from the padded length of its batch.
+TRANSLATION_MEMORY_HASHED_ARGS = ["model_path", "locally_fine_tuned_model_path", "draft_model_path", "shortlist_lexical_table", "shortlist_frequent_tokens_file"] ## The translations depend on the contents of these files and not on where they are.
+
+def get_translation_memory_namespace(args):
+    """This method returns the hash of everything other than the source sentence which decides its translation, that is the md5 checksums of the model checkpoint (and the other files in TRANSLATION_MEMORY_HASHED_ARGS), the source and target languages and all the decoding hyperparameters such as the beam size and the length penalty. Arguments in TRANSLATION_MEMORY_IGNORED_ARGS do not change the translations and are left out. Translations are only reused from a translation memory if their namespaces match."""
+    namespace = {}
+    for arg_name, arg_value in sorted(vars(args).items()):
+        if arg_name in TRANSLATION_MEMORY_IGNORED_ARGS:
+            continue
+        if arg_name in TRANSLATION_MEMORY_HASHED_ARGS and arg_value is not None and os.path.isfile(arg_value): ## Official pretrained models are identified by their names.
+            arg_value = compute_md5(arg_value)
+        namespace[arg_name] = arg_value
+    return hashlib.sha256(json.dumps(namespace, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class TranslationMemory:
+    """An exact match translation memory stored on disk in an sqlite database so that it persists across decoding runs and can be shared by the decoding processes. The translations of a source sentence are stored under the hash of the sentence and the namespace (see get_translation_memory_namespace) so a translation is only reused for the same model, language pair and decoding hyperparameters. When there are more than max_entries translations the least recently used ones are evicted."""
+    def __init__(self, file_name, namespace, max_entries=1000000):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(file_name, timeout=600) ## Other decoding processes may be writing to the same memory.
+        self.connection.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translations TEXT NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)")
+        self.connection.commit()
+
+    def key(self, source):
+        return hashlib.sha256((self.namespace+"\t"+source).encode("utf-8")).hexdigest()
+
+    def get(self, sources):
+        """Looks up a list of source sentences and returns a dict from the ones in the memory to their lists of translations. These are marked as used now. Sentences which are found count as hits and the others as misses."""
+        keys_to_sources = {self.key(source): source for source in sources}
+        keys = list(keys_to_sources)
+        found = {}
+        for chunk_start in range(0, len(keys), 500): ## Sqlite limits the number of parameters of a query.
+            chunk = keys[chunk_start:chunk_start+500]
+            for key, translations in self.connection.execute("SELECT key, translations FROM translations WHERE key IN (%s)" % ",".join(["?"]*len(chunk)), chunk):
+                found[keys_to_sources[key]] = json.loads(translations)
+        last_used = time.time()
+        self.connection.executemany("UPDATE translations SET last_used = ? WHERE key = ?", [(last_used, self.key(source)) for source in found])
+        self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(keys_to_sources) - len(found)
+        return found
+
+    def put(self, sources_and_translations):
+        """Stores a dict from source sentences to their lists of translations and evicts the least recently used translations if the memory is full."""
+        last_used = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO translations (key, translations, last_used) VALUES (?, ?, ?)", [(self.key(source), json.dumps(translations, ensure_ascii=False), last_used) for source, translations in sources_and_translations.items()])
+        num_entries = self.connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+        if num_entries > self.max_entries:
+            self.connection.execute("DELETE FROM translations WHERE key IN (SELECT key FROM translations ORDER BY last_used LIMIT ?)", (num_entries - self.max_entries,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def load_vocabulary_shortlist(tok, args):
+    """This method loads what is needed to build decode time vocabulary shortlists (see build_vocabulary_shortlist). The lexical translation table args.shortlist_lexical_table has lines of the form "source_token target_token probability" where the tokens are subwords of the tokenizer. The args.shortlist_lexical_top_k most probable target tokens of each source token are kept. The args.shortlist_num_frequent_tokens most frequent tokens of the target language file args.shortlist_frequent_tokens_file and the special tokens are always in the shortlist. Returns a dict mapping source token ids to lists of target token ids and a list of the token ids which are always in the shortlist."""
+    lexical_candidates = collections.defaultdict(list)
+    if args.shortlist_lexical_table is not None:
+        with open(args.shortlist_lexical_table) as lexical_table:
+            for line in lexical_table:
+                fields = line.strip().split()
+                if len(fields) != 3:
+                    continue
+                source_id, target_id = tok.convert_tokens_to_ids([fields[0], fields[1]])
+                if source_id == tok.unk_token_id or target_id == tok.unk_token_id: ## Tokens not in the vocabulary.
+                    continue
+                lexical_candidates[source_id].append((float(fields[2]), target_id))
+    lexical_shortlist = {source_id: [target_id for _, target_id in sorted(candidates, reverse=True)[:args.shortlist_lexical_top_k]] for source_id, candidates in lexical_candidates.items()}
+    base_shortlist_ids = set(tok.all_special_ids) ## The language indicator tokens are special tokens too.
+    base_shortlist_ids.add(get_token_id(tok, args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"))
+    if args.shortlist_frequent_tokens_file is not None:
+        token_counts = collections.Counter()
+        with open(args.shortlist_frequent_tokens_file) as frequent_tokens_file:
+            for line in frequent_tokens_file:
+                token_counts.update(tok(line.strip(), add_special_tokens=False).input_ids)
+        base_shortlist_ids.update(token_id for token_id, _ in token_counts.most_common(args.shortlist_num_frequent_tokens))
+    return lexical_shortlist, sorted(base_shortlist_ids)
+
+def build_vocabulary_shortlist(input_ids, lexical_shortlist, base_shortlist_ids):
+    """This method builds the shortlist of target token ids for a batch of source token ids. It contains the source tokens themselves since names, numbers and the like are often copied, the lexical translations of the source tokens and the base shortlist ids. Returns a sorted LongTensor."""
+    source_ids = torch.unique(input_ids).tolist()
+    shortlist = set(base_shortlist_ids)
+    shortlist.update(source_ids)
+    for source_id in source_ids:
+        shortlist.update(lexical_shortlist.get(source_id, ()))
+    return torch.tensor(sorted(shortlist), dtype=torch.long)
+
 def get_sacrebleu(refs, hyp):
     """Returns sacrebleu score. Sacrebleu is a reliable implementation for computing corpus level BLEU scores."""
     bleu = sacrebleu.corpus_bleu(hyp, refs)
     return bleu.score
 
-def yield_corpus_indefinitely_mono(corpus, lang):
-    """This shuffles the corpus or corpus shard at the beginning of each epoch and returns sentences indefinitely."""
+def load_line_offsets(file_name, chunk_size=2**26):
+    """Returns the byte offsets of the beginnings of all lines of a file followed by the size of the file so that line i is file[offsets[i]:offsets[i+1]]. The offsets are computed by reading the file in chunks and are cached on disk in file_name.offsets (int64) so that they are computed only once per file. The cache is memory mapped and is rebuilt if the file is newer than it."""
+    offsets_file_name = file_name+".offsets"
+    if not os.path.exists(offsets_file_name) or os.path.getmtime(offsets_file_name) < os.path.getmtime(file_name):
+        print("Computing line offsets for", file_name)
+        sys.stdout.flush()
+        file_size = 0
+        with open(file_name, "rb") as infile, open(offsets_file_name+".tmp", "wb") as outfile:
+            np.array([0], dtype=np.int64).tofile(outfile)
+            while True:
+                chunk = infile.read(chunk_size)
+                if len(chunk) == 0:
+                    break
+                (np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n")).astype(np.int64) + file_size + 1).tofile(outfile)
+                file_size += len(chunk)
+                last_byte = chunk[-1:]
+            if file_size > 0 and last_byte != b"\n": ## The last line has no newline so we mark its end manually.
+                np.array([file_size], dtype=np.int64).tofile(outfile)
+        os.replace(offsets_file_name+".tmp", offsets_file_name) ## Atomic so that other processes never see a partially written cache.
+    return np.memmap(offsets_file_name, dtype=np.int64, mode="r")
+
+def memory_map_file(file_name):
+    """Memory maps a text file for reading. The OS page cache is shared between all processes on a node so the corpus is never duplicated in RAM. Empty files cannot be memory mapped so we return an empty bytes object for them."""
+    if os.path.getsize(file_name) == 0:
+        return b""
+    with open(file_name, "rb") as infile:
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+def yield_corpus_indefinitely_mono(file_name, offsets, lang):
+    """This shuffles the line offsets of the corpus or corpus shard at the beginning of each epoch and returns sentences indefinitely. Lines are read from a memory mapped file so only the permutation of line indices lives in RAM."""
     epoch_counter = 0
+    corpus = memory_map_file(file_name)
+    num_lines = len(offsets) - 1
     try:
         while True:
             print("Shuffling corpus!")
             sys.stdout.flush()
-            random.shuffle(corpus)
-            for src_line in corpus:
-                yield src_line
+            for line_idx in np.random.permutation(num_lines):
+                yield corpus[offsets[line_idx]:offsets[line_idx+1]].decode("utf-8")
 
             epoch_counter += 1
             print("Finished epoch", epoch_counter, "for language:", lang)
@@ -354,19 +651,47 @@ def yield_corpus_indefinitely_mono(corpus, lang):
         print("Catastrophic data gen failure")
     return None
 
-def yield_corpus_indefinitely_bi(corpus, language):
-    """This shuffles the corpus at the beginning of each epoch and returns sentences indefinitely."""
+def yield_corpus_indefinitely_bi(src_file_name, src_offsets, tgt_file_name, tgt_offsets, language):
+    """This shuffles the line offsets of the parallel corpus at the beginning of each epoch and returns sentence pairs indefinitely. Lines are read from memory mapped files so only the permutation of line indices lives in RAM."""
     epoch_counter = 0
+    src_corpus = memory_map_file(src_file_name)
+    tgt_corpus = memory_map_file(tgt_file_name)
+    num_lines = min(len(src_offsets), len(tgt_offsets)) - 1 ## The same as zipping the source and target lines.
     while True:
         print("Shuffling corpus:", language)
-        random.shuffle(corpus)
-        for src_line, tgt_line in corpus:
-            yield src_line, tgt_line
+        for line_idx in np.random.permutation(num_lines):
+            yield src_corpus[src_offsets[line_idx]:src_offsets[line_idx+1]].decode("utf-8"), tgt_corpus[tgt_offsets[line_idx]:tgt_offsets[line_idx+1]].decode("utf-8")
         
         epoch_counter += 1
         print("Finished epoch", epoch_counter, "for language:", language)
     return None, None ## We should never reach this point.
 
+def yield_binarized_corpus_indefinitely_mono(token_ids, offsets, lang):
+    """This shuffles the line indices of a binarized corpus shard at the beginning of each epoch and returns token id arrays indefinitely."""
+    epoch_counter = 0
+    num_lines = len(offsets) - 1
+    while True:
+        print("Shuffling corpus!")
+        sys.stdout.flush()
+        for line_idx in np.random.permutation(num_lines):
+            yield np.array(token_ids[offsets[line_idx]:offsets[line_idx+1]])
+
+        epoch_counter += 1
+        print("Finished epoch", epoch_counter, "for language:", lang)
+
+def yield_binarized_corpus_indefinitely_bi(src_token_ids, src_offsets, tgt_token_ids, tgt_offsets, language):
+    """This shuffles the line indices of a binarized parallel corpus shard at the beginning of each epoch and returns source and target token id arrays indefinitely."""
+    epoch_counter = 0
+    num_lines = len(src_offsets) - 1
+    assert num_lines == len(tgt_offsets) - 1, "The source and target shards for "+language+" have a different number of lines."
+    while True:
+        print("Shuffling corpus:", language)
+        for line_idx in np.random.permutation(num_lines):
+            yield np.array(src_token_ids[src_offsets[line_idx]:src_offsets[line_idx+1]]), np.array(tgt_token_ids[tgt_offsets[line_idx]:tgt_offsets[line_idx+1]])
+
+        epoch_counter += 1
+        print("Finished epoch", epoch_counter, "for language:", language)
+
 def sub_sample_and_permute_document(sentence, document_level_sentence_delimiter, max_length):
     """Here we start at a particular random index and select the rest of the sentences. This is to make sure that we dont always see only the initial part of each document all the time."""
     sentence_split = sentence.split(" "+document_level_sentence_delimiter+" ")
@@ -387,10 +712,97 @@ def sub_sample_and_permute_document(sentence, document_level_sentence_delimiter,
     sentence_split_shuffled = sentence_split_shuffled.split(" ")
     return sentence_split_shuffled, sentence, sent_len
 
-    
+def sub_sample_and_permute_document_ids(token_ids, document_level_sentence_delimiter_id, max_length):
+    """The token id version of sub_sample_and_permute_document. We start at a random sentence of the document, truncate and then permute the sentences. Returns the permuted ids (to be masked) and the unpermuted ids (the target)."""
+    boundaries = np.flatnonzero(token_ids == document_level_sentence_delimiter_id)
+    starts = np.concatenate([[0], boundaries+1])
+    token_ids = token_ids[starts[random.randint(0, len(starts)-1)]:][:max_length]
+    boundaries = np.flatnonzero(token_ids == document_level_sentence_delimiter_id)
+    sentences = np.split(token_ids, boundaries) ## Every sentence except the first begins with the delimiter.
+    sentences = [sentences[0]] + [sentence[1:] for sentence in sentences[1:]]
+    random.shuffle(sentences)
+    delimiter = np.array([document_level_sentence_delimiter_id], dtype=token_ids.dtype)
+    shuffled_token_ids = np.concatenate([part for sentence in sentences for part in (delimiter, sentence)][1:])
+    return shuffled_token_ids, token_ids
+
+def span_mask_batch(lengths, mask_percents, args, protected=None):
+    """This method masks a whole batch of sequences at once and is shared by all batch generators. For each sequence it returns an array of indices into the original sequence where -1 stands for a mask token. By default we do text infilling where spans whose lengths are sampled from a poisson distribution are replaced with a single mask token and spans of length 0 insert a mask token. If args.mask_individual_tokens is set then every chosen token is replaced by a mask token. Positions marked in the boolean matrix protected (such as document delimiters and existing mask tokens) are never masked. If args.future_prediction is set then only the second half of each sequence is masked."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    batch_size = len(lengths)
+    if batch_size == 0:
+        return []
+    max_len = int(lengths.max())
+    positions = np.arange(max_len)
+    region_start = lengths//2 if args.future_prediction else np.zeros_like(lengths) ## We mask only the remaining half of the sentence to encourage the model to learn representations that can make do without most of the future tokens.
+    region_len = lengths - region_start
+    budgets = np.minimum((np.asarray(mask_percents, dtype=np.float64)*lengths).astype(np.int64), region_len) ## Cant mask more than the allowable number of tokens.
+    in_region = (positions >= region_start[:, None]) & (positions < lengths[:, None])
+    if protected is None:
+        protected = np.zeros((batch_size, max_len), dtype=bool)
+    insertion_rows = np.zeros(0, dtype=np.int64)
+    insertion_positions = np.zeros(0, dtype=np.int64)
+    if args.mask_individual_tokens: ## Choose a random subset of the maskable positions. Protected positions are pushed to the end of the random order so that they are never chosen.
+        keys = np.random.random((batch_size, max_len))
+        keys[~in_region | protected] = 2.0
+        ranks = np.argsort(np.argsort(keys, axis=1), axis=1)
+        masked = (ranks < budgets[:, None]) & (keys < 2.0)
+        span_starts = masked
+    else: ## Sample enough spans to exhaust the budget, shorten the span that crosses the budget and then scatter the spans over the unmasked positions using sorted random gaps so that spans never overlap.
+        num_spans = int(budgets.max()) + 1
+        span_lengths = np.random.poisson(args.token_masking_lambda, (batch_size, num_spans))
+        span_ends = np.minimum(np.cumsum(span_lengths, axis=1), budgets[:, None])
+        span_begins = np.concatenate([np.zeros((batch_size, 1), dtype=np.int64), span_ends[:, :-1]], axis=1)
+        valid = span_begins < budgets[:, None] ## Spans sampled after the budget was exhausted are ignored. Valid spans of length 0 are mask insertions.
+        span_lengths = span_ends - span_begins
+        gaps = (np.random.random((batch_size, num_spans)) * (region_len - budgets + 1)[:, None]).astype(np.int64)
+        gaps = np.sort(np.where(valid, gaps, max_len + 1), axis=1) ## Valid spans form a prefix both before and after sorting.
+        starts = region_start[:, None] + gaps + span_begins
+        rows, cols = np.nonzero(valid & (span_lengths > 0))
+        coverage = np.zeros((batch_size, max_len + 1), dtype=np.int64)
+        np.add.at(coverage, (rows, starts[rows, cols]), 1)
+        np.add.at(coverage, (rows, starts[rows, cols] + span_lengths[rows, cols]), -1)
+        masked = (np.cumsum(coverage, axis=1)[:, :max_len] > 0) & ~protected
+        span_starts = np.zeros((batch_size, max_len + 1), dtype=bool)
+        span_starts[rows, starts[rows, cols]] = True
+        prev_masked = np.concatenate([np.zeros((batch_size, 1), dtype=bool), masked[:, :-1]], axis=1)
+        span_starts = masked & (span_starts[:, :max_len] | ~prev_masked) ## A protected token splits a span into two masked spans.
+        insertion_rows, insertion_cols = np.nonzero(valid & (span_lengths == 0))
+        insertion_positions = starts[insertion_rows, insertion_cols]
+    kept_rows, kept_positions = np.nonzero((positions < lengths[:, None]) & (~masked | span_starts))
+    all_rows = np.concatenate([kept_rows, insertion_rows])
+    all_keys = np.concatenate([2*kept_positions + 1, 2*insertion_positions]) ## Insertions go right before the token at their position.
+    all_indices = np.concatenate([np.where(masked[kept_rows, kept_positions], -1, kept_positions), np.full(len(insertion_rows), -1, dtype=np.int64)])
+    order = np.lexsort((all_keys, all_rows))
+    counts = np.bincount(all_rows, minlength=batch_size)
+    return np.split(all_indices[order], np.cumsum(counts)[:-1])
+
+def span_mask_token_id_batch(token_id_batch, mask_tok_id, mask_percents, args, protected_ids=()):
+    """This method applies span_mask_batch to a list of token id arrays and returns the masked token id arrays. Existing mask tokens and the tokens in protected_ids are never masked."""
+    lengths = np.array([len(token_ids) for token_ids in token_id_batch], dtype=np.int64)
+    max_len = int(lengths.max()) if len(lengths) > 0 else 0
+    padded = np.full((len(lengths), max_len), mask_tok_id, dtype=np.int64)
+    padded[np.arange(max_len) < lengths[:, None]] = np.concatenate([np.asarray(token_ids, dtype=np.int64) for token_ids in token_id_batch]) if max_len > 0 else []
+    protected = np.isin(padded, [mask_tok_id] + list(protected_ids))
+    masked_indices = span_mask_batch(lengths, mask_percents, args, protected)
+    return [np.append(token_ids, mask_tok_id)[indices] for token_ids, indices in zip(token_id_batch, masked_indices)] ## The index -1 picks the appended mask token.
+
+def span_mask_sentence_batch(sentence_splits, mask_tok, mask_percents, args, protected_tokens=()):
+    """This method applies span_mask_batch to a list of sentences split into words and returns the masked sentences as strings. Existing mask tokens and the words in protected_tokens are never masked."""
+    protected_tokens = set(protected_tokens) | {mask_tok}
+    lengths = np.array([len(sentence_split) for sentence_split in sentence_splits], dtype=np.int64)
+    max_len = int(lengths.max()) if len(lengths) > 0 else 0
+    protected = np.zeros((len(lengths), max_len), dtype=bool)
+    protected[np.arange(max_len) < lengths[:, None]] = [word in protected_tokens for sentence_split in sentence_splits for word in sentence_split]
+    masked_indices = span_mask_batch(lengths, mask_percents, args, protected)
+    return [" ".join(np.array(sentence_split + [mask_tok], dtype=object)[indices]) for sentence_split, indices in zip(sentence_splits, masked_indices)] ## The index -1 picks the appended mask token.
+
 def generate_batches_monolingual_masked(tok, args, files, rank):
     """Generates the source, target and source attention masks for denoising. Long sequences are truncated and short sequences are ignored."""
-    
+
+    if args.use_binarized_shards and not args.tokenization_sampling: ## Binarized shards contain a single deterministic segmentation so stochastic tokenization has to go through the tokenizer.
+        yield from generate_batches_monolingual_masked_binarized(tok, args, files, rank)
+        return
+
     if args.tokenization_sampling:
         print("Stochastic tokenizer will be used.")
         if "bart" in args.tokenizer_name_or_path:
@@ -413,9 +825,9 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
     language_file_dict = {}
     probs = {}
     for l in language_list:
-        file_content = open(files[l]+"."+"%02d" % rank).readlines()
-        probs[l] = len(file_content)
-        language_file_dict[l] = yield_corpus_indefinitely_mono(file_content, l)
+        offsets = load_line_offsets(files[l]+"."+"%02d" % rank)
+        probs[l] = len(offsets) - 1
+        language_file_dict[l] = yield_corpus_indefinitely_mono(files[l]+"."+"%02d" % rank, offsets, l)
     probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
     probs = probs_temp
     probs_temp = {lang: probs[lang]**(1.0/args.data_sampling_temperature) for lang in probs} ## Temperature sampling probabilities.
@@ -424,112 +836,79 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
     probs = [probs_temp[lang] for lang in language_list]
     num_langs = len(language_list)
     language_indices = list(range(num_langs))
+    dropped_sentence = None ## We will save the sentence to be dropped this batch and add it to the next batch.
     while batch_count != args.num_batches:
-        curr_batch_count = 0
         encoder_input_batch = []
         decoder_input_batch = []
         decoder_label_batch = []
+        sentence_splits_to_mask = []
+        mask_percents = []
+        sentences = []
+        langs = []
         batch_count += 1
         max_src_sent_len = 0
         max_tgt_sent_len = 0
-        prev_max_src_sent_len = 0
-        prev_max_tgt_sent_len = 0
         start = time.time()
         sents_in_batch = 0
-        dropped_sentence = "" ## We will save the sentence to be dropped this batch and add it to the next batch.
         while True:
-            if dropped_sentence != "":
-                sentence = dropped_sentence # Reuse the previous sentence
-                dropped_sentence = ""
+            if dropped_sentence is not None:
+                sentence_split, sentence, lang, mask_percent, curr_src_sent_len, curr_tgt_sent_len = dropped_sentence # Reuse the previous sentence
+                dropped_sentence = None
             else:
                 language_idx = random.choices(language_indices, probs)[0]
                 sentence = next(language_file_dict[language_list[language_idx]]).strip()
-            lang = language_list[language_idx] if args.use_official_pretrained else "<2"+language_list[language_idx]+">"
-            if type(mp_val_or_range) is float:
-                mask_percent = mp_val_or_range
-            else:
-                mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
-            if args.is_document:
-                sentence_split, sentence, sent_len = sub_sample_and_permute_document(sentence, args.document_level_sentence_delimiter, args.max_length)
-            else:
-                sentence_split = sentence.split(" ")
-                sent_len = len(sentence_split)
-                if sent_len < 1: 
-                    continue
-                if sent_len > args.max_length: ## Initial truncation
-                    sentence_split = sentence_split[:args.max_length]
-                    sentence = " ".join(sentence_split)
-                    sent_len = args.max_length
-            mask_count = 0
-            max_mask_count = int(mask_percent*sent_len)
-            spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
-            curr_sent_len = sent_len
-            while mask_count < max_mask_count:
-                try:
-                    span_to_mask = spans_to_mask[0]
-                    del spans_to_mask[0]
-                    if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
+                lang = language_list[language_idx] if args.use_official_pretrained else "<2"+language_list[language_idx]+">"
+                if type(mp_val_or_range) is float:
+                    mask_percent = mp_val_or_range
+                else:
+                    mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
+                if args.is_document:
+                    sentence_split, sentence, sent_len = sub_sample_and_permute_document(sentence, args.document_level_sentence_delimiter, args.max_length)
+                else:
+                    sentence_split = sentence.split(" ")
+                    sent_len = len(sentence_split)
+                    if sent_len < 1: 
                         continue
-                    idx_to_mask = random.randint(sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1)) ## We mask only the remaining half of the sentence to encourage the model to learn representations that can make do without most of the future tokens.
-                    if mask_tok not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask] and args.document_level_sentence_delimiter not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                        sentence_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                        mask_count += span_to_mask # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                        curr_sent_len -= (span_to_mask-1)
-                except:
-                    break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
-            
-            masked_sentence = " ".join(sentence_split)
-            if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
-                iids = tok(masked_sentence, return_tensors="pt").input_ids
-                curr_src_sent_len = len(iids[0])
-                iids = tok(sentence, return_tensors="pt").input_ids
-                curr_tgt_sent_len = len(iids[0])
-            else:
-                iids = tok(lang + " " + masked_sentence + " </s>", add_special_tokens=False, return_tensors="pt").input_ids
-                curr_src_sent_len = len(iids[0])
-                iids = tok("<s> " + sentence, add_special_tokens=False, return_tensors="pt").input_ids
-                curr_tgt_sent_len = len(iids[0])
-            
-                        
-            if curr_src_sent_len > max_src_sent_len:
-                prev_max_src_sent_len = max_src_sent_len
-                max_src_sent_len = curr_src_sent_len
-            
-            if curr_tgt_sent_len > max_tgt_sent_len:
-                prev_max_tgt_sent_len = max_tgt_sent_len
-                max_tgt_sent_len = curr_tgt_sent_len
-            
-            if args.batch_size_indicates_lines: ## Batch a fixed number of sentences. We can safely add the current example because we assume that the user knows the max batch size.
+                    if sent_len > args.max_length: ## Initial truncation
+                        sentence_split = sentence_split[:args.max_length]
+                        sentence = " ".join(sentence_split)
+                        sent_len = args.max_length
+                ## Masking is done for the whole batch at once after the batch is formed so the masked sentence is never tokenized here. Masking never makes a sentence longer (except for the rare mask insertions) so we use the length of the unmasked sentence with the EOS and language indicator tokens as the source length.
                 if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
-                    encoder_input_batch.append(src_sent)
-                    decoder_input_batch.append(tgt_sent)
+                    curr_tgt_sent_len = len(tok(sentence).input_ids)
+                    curr_src_sent_len = curr_tgt_sent_len
                 else:
-                    encoder_input_batch.append(masked_sentence + " </s> " + lang)
-                    decoder_input_batch.append(lang + " " + sentence)
-                    decoder_label_batch.append(sentence + " </s>")
-                    if args.tokenization_sampling:
-                        decoder_input_batch[-1] += " </s>" ## In case of stochastic subword segmentation we have to generate the decoder label ids from the decoder input ids. This will make the model behavior sliiiiiightly different from how it was when stochastic decoding is not done. However it should have no major difference. In the non stochastic case, the </s> or EOS token is never fed as the input but in the stochastic case that token is fed as the input. So this means in the non stochastic case, the end of decoder and labels will be something like: "a good person <pad> <pad> <pad>" and "good person </s> <pad <pad> <pad>". In the stochastic case, the end of decoder and labels will be something like: "a good person </s> <pad> <pad>" and "good person </s> <pad> <pad <pad>". Now think about how we compute loss. When the label is a pad, the loss is never propagated through it. So the model will never learn anything when </s> or <pad> will be the input. Furthermore, the generation of </s> is what dictates the end of generation. When the model generates a </s> the sequence is taken out of the computation process and therefore whatever it generates after that will not be considered at all towards its final score. In conclusion, there should be no practical difference in outcomes between the two batching approaches.
-                sents_in_batch += 1
-                if sents_in_batch == args.batch_size:
+                    curr_tgt_sent_len = len(tok("<s> " + sentence, add_special_tokens=False).input_ids)
+                    curr_src_sent_len = curr_tgt_sent_len + 1
+            
+            if not args.batch_size_indicates_lines: ## We will drop this sentence for now because we may go over the limit of what the GPU can handle. It may be used in a future iteration. Note that this will be unreliable when we do stochastic subword segmentation.
+                potential_batch_count = max(max_src_sent_len, curr_src_sent_len, max_tgt_sent_len, curr_tgt_sent_len)*(sents_in_batch+1)
+                if potential_batch_count > args.batch_size and sents_in_batch > 0:
+                    dropped_sentence = (sentence_split, sentence, lang, mask_percent, curr_src_sent_len, curr_tgt_sent_len)
                     break
+            max_src_sent_len = max(max_src_sent_len, curr_src_sent_len)
+            max_tgt_sent_len = max(max_tgt_sent_len, curr_tgt_sent_len)
+            sentence_splits_to_mask.append(sentence_split)
+            mask_percents.append(mask_percent)
+            sentences.append(sentence)
+            langs.append(lang)
+            sents_in_batch += 1
+            if args.batch_size_indicates_lines and sents_in_batch == args.batch_size: ## Batch a fixed number of sentences. We can safely add the current example because we assume that the user knows the max batch size.
+                break
+        
+        masked_sentences = span_mask_sentence_batch(sentence_splits_to_mask, mask_tok, mask_percents, args, [args.document_level_sentence_delimiter])
+        for masked_sentence, sentence, lang in zip(masked_sentences, sentences, langs):
+            if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
+                encoder_input_batch.append(masked_sentence + " </s> " )
+                decoder_input_batch.append(sentence + " </s>")
             else:
-                potential_batch_count = max(max_src_sent_len, max_tgt_sent_len)*(sents_in_batch+1) ## Note that this will be unreliable when we do stochastic subword segmentation.
-                if potential_batch_count > args.batch_size: ## We will drop this sentence for now because we may go over the limit of what the GPU can handle. It may be used in a future iteration. Note that this will be unreliable when we do stochastic subword segmentation.
-                    dropped_sentence = sentence
-                    max_src_sent_len = prev_max_src_sent_len
-                    max_tgt_sent_len = prev_max_tgt_sent_len
-                    break
-                if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
-                    encoder_input_batch.append(masked_sentence + " </s> " )
-                    decoder_input_batch.append(sentence + " </s>")
-                else:
-                    encoder_input_batch.append(masked_sentence + " </s> " + lang)
-                    decoder_input_batch.append(lang + " " + sentence)
-                    decoder_label_batch.append(sentence + " </s>")
-                    if args.tokenization_sampling:
-                        decoder_input_batch[-1] += " </s>" ## In case of stochastic subword segmentation we have to generate the decoder label ids from the decoder input ids. This will make the model behavior sliiiiiightly different from how it was when stochastic decoding is not done. However it should have no major difference. In the non stochastic case, the </s> or EOS token is never fed as the input but in the stochastic case that token is fed as the input. So this means in the non stochastic case, the end of decoder and labels will be something like: "a good person <pad> <pad> <pad>" and "good person </s> <pad <pad> <pad>". In the stochastic case, the end of decoder and labels will be something like: "a good person </s> <pad> <pad>" and "good person </s> <pad> <pad <pad>". Now think about how we compute loss. When the label is a pad, the loss is never propagated through it. So the model will never learn anything when </s> or <pad> will be the input. Furthermore, the generation of </s> is what dictates the end of generation. When the model generates a </s> the sequence is taken out of the computation process and therefore whatever it generates after that will not be considered at all towards its final score. In conclusion, there should be no practical difference in outcomes between the two batching approaches.
-                sents_in_batch += 1
+                encoder_input_batch.append(masked_sentence + " </s> " + lang)
+                decoder_input_batch.append(lang + " " + sentence)
+                decoder_label_batch.append(sentence + " </s>")
+                if args.tokenization_sampling:
+                    decoder_input_batch[-1] += " </s>" ## In case of stochastic subword segmentation we have to generate the decoder label ids from the decoder input ids. This will make the model behavior sliiiiiightly different from how it was when stochastic decoding is not done. However it should have no major difference. In the non stochastic case, the </s> or EOS token is never fed as the input but in the stochastic case that token is fed as the input. So this means in the non stochastic case, the end of decoder and labels will be something like: "a good person <pad> <pad> <pad>" and "good person </s> <pad <pad> <pad>". In the stochastic case, the end of decoder and labels will be something like: "a good person </s> <pad> <pad>" and "good person </s> <pad> <pad <pad>". Now think about how we compute loss. When the label is a pad, the loss is never propagated through it. So the model will never learn anything when </s> or <pad> will be the input. Furthermore, the generation of </s> is what dictates the end of generation. When the model generates a </s> the sequence is taken out of the computation process and therefore whatever it generates after that will not be considered at all towards its final score. In conclusion, there should be no practical difference in outcomes between the two batching approaches.
         
+
         if len(encoder_input_batch) == 0:
             print("Zero size batch due to an abnormal example. Skipping empty batch.")
             continue
@@ -557,7 +936,98 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
 #         if rank == 0:
 #             print(input_ids.size(), functools.reduce(lambda x,y: x*y, input_ids.size()), decoder_input_ids.size(), functools.reduce(lambda x,y: x*y, decoder_input_ids.size()))
         yield input_ids, input_masks, decoder_input_ids, labels
-    
+
+def generate_batches_monolingual_masked_binarized(tok, args, files, rank):
+    """Generates the source, target and source attention masks for denoising from shards binarized via binarize_corpora.py. This is the same as generate_batches_monolingual_masked except that the tokenizer is never called. Masking and truncation are done at the level of subwords instead of words."""
+    assert not (args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model), "Binarized shards are not supported for the official BART model."
+    print("Batches will be generated from binarized shards.")
+    batch_count = 0
+    if args.use_official_pretrained:
+        mask_tok = "<mask>"
+    else:
+        mask_tok = "[MASK]"
+    mask_tok_id = get_token_id(tok, mask_tok)
+    eos_tok_id = get_token_id(tok, "</s>")
+    document_level_sentence_delimiter_id = get_token_id(tok, args.document_level_sentence_delimiter) if args.is_document else None
+    if len(args.token_masking_probs_range) == 1:
+        mp_val_or_range = args.token_masking_probs_range[0]
+    elif len(args.token_masking_probs_range) == 2:
+        mp_val_or_range = args.token_masking_probs_range
+    print("Masking ratio:", mp_val_or_range)
+    language_list = list(files.keys())
+    print("Training for:", language_list)
+    language_file_dict = {}
+    lang_tok_ids = {}
+    probs = {}
+    for l in language_list:
+        token_ids, offsets = load_binarized_file(files[l]+"."+"%02d" % rank)
+        probs[l] = len(offsets) - 1
+        language_file_dict[l] = yield_binarized_corpus_indefinitely_mono(token_ids, offsets, l)
+        lang_tok_ids[l] = get_token_id(tok, l if args.use_official_pretrained else "<2"+l+">")
+    probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
+    probs = probs_temp
+    probs_temp = {lang: probs[lang]**(1.0/args.data_sampling_temperature) for lang in probs} ## Temperature sampling probabilities.
+    probs = probs_temp
+    probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
+    probs = [probs_temp[lang] for lang in language_list]
+    num_langs = len(language_list)
+    language_indices = list(range(num_langs))
+    dropped_sentence = None ## We will save the sentence to be dropped this batch and add it to the next batch.
+    while batch_count != args.num_batches:
+        sentence_ids_batch = []
+        sentence_ids_to_mask_batch = []
+        mask_percents = []
+        lang_tok_id_batch = []
+        batch_count += 1
+        max_src_sent_len = 0
+        max_tgt_sent_len = 0
+        sents_in_batch = 0
+        while True:
+            if dropped_sentence is not None:
+                sentence_ids_to_mask, sentence_ids, lang_tok_id, mask_percent = dropped_sentence # Reuse the previous sentence
+                dropped_sentence = None
+            else:
+                language_idx = random.choices(language_indices, probs)[0]
+                sentence_ids = next(language_file_dict[language_list[language_idx]])
+                lang_tok_id = lang_tok_ids[language_list[language_idx]]
+                if type(mp_val_or_range) is float:
+                    mask_percent = mp_val_or_range
+                else:
+                    mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
+                if args.is_document:
+                    sentence_ids_to_mask, sentence_ids = sub_sample_and_permute_document_ids(sentence_ids, document_level_sentence_delimiter_id, args.max_length)
+                else:
+                    sentence_ids = sentence_ids[:args.max_length] ## Initial truncation
+                    sentence_ids_to_mask = sentence_ids
+                if len(sentence_ids) < 1:
+                    continue
+            curr_src_sent_len = len(sentence_ids_to_mask) + 2 ## The EOS and language indicator tokens. Masking is done for the whole batch at once and never makes a sentence longer except for the rare mask insertions.
+            curr_tgt_sent_len = len(sentence_ids) + 1 ## The language indicator token.
+            if not args.batch_size_indicates_lines: ## We will drop this sentence for now because we may go over the limit of what the GPU can handle. It may be used in a future iteration.
+                potential_batch_count = max(max_src_sent_len, curr_src_sent_len, max_tgt_sent_len, curr_tgt_sent_len)*(sents_in_batch+1)
+                if potential_batch_count > args.batch_size and sents_in_batch > 0:
+                    dropped_sentence = (sentence_ids_to_mask, sentence_ids, lang_tok_id, mask_percent)
+                    break
+            max_src_sent_len = max(max_src_sent_len, curr_src_sent_len)
+            max_tgt_sent_len = max(max_tgt_sent_len, curr_tgt_sent_len)
+            sentence_ids_batch.append(sentence_ids)
+            sentence_ids_to_mask_batch.append(sentence_ids_to_mask)
+            mask_percents.append(mask_percent)
+            lang_tok_id_batch.append(lang_tok_id)
+            sents_in_batch += 1
+            if args.batch_size_indicates_lines and sents_in_batch == args.batch_size:
+                break
+
+        masked_sentence_ids_batch = span_mask_token_id_batch(sentence_ids_to_mask_batch, mask_tok_id, mask_percents, args, [] if document_level_sentence_delimiter_id is None else [document_level_sentence_delimiter_id])
+        encoder_input_batch = [list(masked_sentence_ids) + [eos_tok_id, lang_tok_id] for masked_sentence_ids, lang_tok_id in zip(masked_sentence_ids_batch, lang_tok_id_batch)]
+        decoder_input_batch = [[lang_tok_id] + list(sentence_ids) for sentence_ids, lang_tok_id in zip(sentence_ids_batch, lang_tok_id_batch)]
+        decoder_label_batch = [list(sentence_ids) + [eos_tok_id] for sentence_ids in sentence_ids_batch]
+
+        input_ids = pad_token_ids(encoder_input_batch, tok.pad_token_id, args.hard_truncate_length)
+        input_masks = (input_ids != tok.pad_token_id).int()
+        decoder_input_ids = pad_token_ids(decoder_input_batch, tok.pad_token_id, args.hard_truncate_length)
+        labels = pad_token_ids(decoder_label_batch, tok.pad_token_id, args.hard_truncate_length)
+        yield input_ids, input_masks, decoder_input_ids, labels
 
 def generate_batches_lm(tok, args, files, rank): ## Address compatibilities of the meta tokens when using official models
     """Generates the source, target and source attention masks for denoising. Long sequences are truncated and short sequences are ignored."""
@@ -568,9 +1038,9 @@ def generate_batches_lm(tok, args, files, rank): ## Address compatibilities of t
     language_file_dict = {}
     probs = {}
     for l in language_list:
-        file_content = open(files[l]+"."+"%02d" % rank).readlines()
-        probs[l] = len(file_content)
-        language_file_dict[l] = yield_corpus_indefinitely_mono(file_content, l)
+        offsets = load_line_offsets(files[l]+"."+"%02d" % rank)
+        probs[l] = len(offsets) - 1
+        language_file_dict[l] = yield_corpus_indefinitely_mono(files[l]+"."+"%02d" % rank, offsets, l)
     probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
     probs = probs_temp
     probs_temp = {lang: probs[lang]**(1.0/args.data_sampling_temperature) for lang in probs} ## Temperature sampling probabilities.
@@ -742,6 +1212,10 @@ def generate_batches_eval_bilingual(tok, args, file, slang):
 
 def generate_batches_bilingual(tok, args, files, rank):
     """Generates the source, target and source attention masks for the training set. The source and target sentences are ignored if empty and are truncated if longer than a threshold. The batch size in this context is the maximum number of tokens in the batch post padding."""
+    if args.use_binarized_shards and not args.tokenization_sampling: ## Binarized shards contain a single deterministic segmentation so stochastic tokenization has to go through the tokenizer.
+        yield from generate_batches_bilingual_binarized(tok, args, files, rank)
+        return
+
     if args.tokenization_sampling:
         print("Stochastic tokenizer will be used.")
         if "bart" in args.tokenizer_name_or_path:
@@ -767,11 +1241,10 @@ def generate_batches_bilingual(tok, args, files, rank):
     language_file_dict = {}
     probs = {}
     for l in language_list:
-        src_file_content = open(files[l][0]+"."+"%02d" % rank).readlines()
-        tgt_file_content = open(files[l][1]+"."+"%02d" % rank).readlines()
-        probs[l] = len(src_file_content)
-        file_content = list(zip(src_file_content, tgt_file_content))
-        language_file_dict[l] = yield_corpus_indefinitely_bi(file_content, l)
+        src_offsets = load_line_offsets(files[l][0]+"."+"%02d" % rank)
+        tgt_offsets = load_line_offsets(files[l][1]+"."+"%02d" % rank)
+        probs[l] = len(src_offsets) - 1
+        language_file_dict[l] = yield_corpus_indefinitely_bi(files[l][0]+"."+"%02d" % rank, src_offsets, files[l][1]+"."+"%02d" % rank, tgt_offsets, l)
     print("Corpora stats:", probs)
     probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
     probs = probs_temp
@@ -781,11 +1254,16 @@ def generate_batches_bilingual(tok, args, files, rank):
     probs = [probs_temp[lang] for lang in language_list]
     num_langs = len(language_list)
     language_indices = list(range(num_langs))
+    if args.length_bucketing:
+        yield from generate_batches_bilingual_bucketed(tok, args, language_file_dict, language_list, probs, mp_val_or_range, mask_tok)
+        return
     while batch_count != args.num_batches:
         curr_batch_count = 0
         encoder_input_batch = []
         decoder_input_batch = []
         decoder_label_batch = []
+        src_sent_splits = []
+        mask_percents = []
         batch_count += 1
         max_src_sent_len = 0
         max_tgt_sent_len = 0
@@ -854,6 +1332,7 @@ def generate_batches_bilingual(tok, args, files, rank):
                         src_sent_parent = " ".join(src_sent_split_parent)
                         src_sent_len_parent = args.max_src_length
                         
+            mask_percent = 0.0 ## Masking is done for the whole batch at once after the batch is formed. Masking never makes a sentence longer (except for the rare mask insertions) so we use the length of the unmasked sentence.
             if (slang == tlang and not args.is_summarization) or args.source_masking_for_bilingual: ## Copying task should DEFINITELY use source masking unless we are doing summarization. We wont bother using this condition for cross distillation. In fact a single condition based on a flag should be sufficient but I am too lazy to make a change. Come fight me if you disagree.
                 if args.source_masking_for_bilingual:
                     mask_percent = random.uniform(0.0, mp_val_or_range[0]) ## Do less masking
@@ -862,24 +1341,6 @@ def generate_batches_bilingual(tok, args, files, rank):
                         mask_percent = mp_val_or_range
                     else:
                         mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
-                mask_count = 0
-                max_mask_count = int(mask_percent*src_sent_len)
-                spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
-                curr_sent_len = src_sent_len
-                while mask_count < max_mask_count:
-                    try:
-                        span_to_mask = spans_to_mask[0]
-                        del spans_to_mask[0]
-                        if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
-                            continue
-                        idx_to_mask = random.randint(sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1))
-                        if mask_tok not in src_sent_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                            src_sent_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                            mask_count += span_to_mask # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                            curr_sent_len -= (span_to_mask-1)
-                    except:
-                        break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
-                src_sent = " ".join(src_sent_split)
             if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
                 iids = tok(src_sent, return_tensors="pt").input_ids
                 curr_src_sent_len = len(iids[0])
@@ -927,6 +1388,8 @@ def generate_batches_bilingual(tok, args, files, rank):
                     if args.cross_distillation or args.multi_source:
                         encoder_input_batch_parent.append(src_sent_parent + " </s> " + slang_parent)
 
+                src_sent_splits.append(src_sent_split)
+                mask_percents.append(mask_percent)
                 sents_in_batch += 1
                 if sents_in_batch == args.batch_size:
                     break
@@ -961,12 +1424,18 @@ def generate_batches_bilingual(tok, args, files, rank):
                     if args.cross_distillation or args.multi_source:
                         encoder_input_batch_parent.append(src_sent_parent + " </s> " + slang_parent)
 
+                src_sent_splits.append(src_sent_split)
+                mask_percents.append(mask_percent)
                 sents_in_batch += 1
                 
         if len(encoder_input_batch) == 0:
             print("Zero size batch due to an abnormal example. Skipping empty batch.")
             continue    
 
+        if any(mask_percents): ## Sentence pairs which should not be masked have a masking ratio of 0 and are left as is.
+            masked_src_sents = span_mask_sentence_batch(src_sent_splits, mask_tok, mask_percents, args)
+            encoder_input_batch = [masked_src_sent + encoder_input[len(" ".join(src_sent_split)):] for masked_src_sent, encoder_input, src_sent_split in zip(masked_src_sents, encoder_input_batch, src_sent_splits)] ## Replace the unmasked source sentence which is the prefix of the encoder input.
+
         if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
             input_ids = tok(encoder_input_batch, return_tensors="pt", padding=True, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
         else:
@@ -1000,7 +1469,217 @@ def generate_batches_bilingual(tok, args, files, rank):
             #print(input_ids.size(), input_masks.size(), decoder_input_ids.size(), labels.size())
             yield input_ids, input_masks, decoder_input_ids, labels
 
-            
+def generate_batches_bilingual_bucketed(tok, args, language_file_dict, language_list, probs, mp_val_or_range, mask_tok):
+    """This is the length bucketed version of the batching loop in generate_batches_bilingual. Instead of growing a batch one sentence pair at a time, a pool of args.bucketing_pool_size sentence pairs is sampled using the temperature based language sampling probabilities, tokenized at once, sorted by length and cut into batches which fill the token budget. Since sentence pairs of similar lengths end up in the same batch, far fewer padding tokens are needed."""
+    print("Length bucketed batches will be created from pools of", args.bucketing_pool_size, "sentence pairs.")
+    is_official_bart = args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model
+    language_indices = list(range(len(language_list)))
+    batch_count = 0
+    while batch_count != args.num_batches:
+        encoder_input_pool = []
+        decoder_input_pool = []
+        decoder_label_pool = []
+        src_sent_splits = []
+        mask_percents = []
+        if args.cross_distillation or args.multi_source: ## We assume an additional source language.
+            encoder_input_pool_parent = []
+        for language_idx in random.choices(language_indices, probs, k=args.bucketing_pool_size):
+            src_sent, tgt_sent = next(language_file_dict[language_list[language_idx]])
+            if args.cross_distillation or args.multi_source: ## We assume that we use a N-way corpus of 3 languages X, Y and Z. We want to distill Y-Z behavior into X-Z where the Y-Z pair also has additional larger corpora but X-Z does not. As such the source sentence should be a tab separated sentence consisting of X[tab]Y.
+                src_sent = src_sent.split("\t")
+                src_sent_parent = src_sent[0].strip() ## This is the sentence for Y
+                src_sent = src_sent[1] ## This is the sentence for X
+            src_sent_split = src_sent.strip().split(" ")
+            tgt_sent_split = tgt_sent.strip().split(" ")
+            if len(src_sent_split) <= 1 or len(tgt_sent_split) <= 1:
+                continue
+            slangtlang = language_list[language_idx].strip().split("-")
+            if args.cross_distillation or args.multi_source: ## In this case only we provide a hyphen separated triplet to represent languages X, Y and Z.
+                src_sent_split_parent = src_sent_parent.split(" ")
+                if len(src_sent_split_parent) <= 1:
+                    continue
+                slang_parent = slangtlang[0] if args.use_official_pretrained else "<2"+slangtlang[0]+">"
+                slang = slangtlang[1] if args.use_official_pretrained else "<2"+slangtlang[1]+">"
+                tlang = slangtlang[2] if args.use_official_pretrained else "<2"+slangtlang[2]+">"
+                encoder_input_pool_parent.append(" ".join(src_sent_split_parent[:args.max_src_length]) + " </s> " + slang_parent) ## The same sentence length constraint applies to Y as it does to X.
+            else:
+                slang = slangtlang[0] if args.use_official_pretrained else "<2"+slangtlang[0]+">"
+                tlang = slangtlang[1] if args.use_official_pretrained else "<2"+slangtlang[1]+">"
+            src_sent_split = src_sent_split[:args.max_src_length] # Initial truncation
+            src_sent = " ".join(src_sent_split)
+            tgt_sent = " ".join(tgt_sent_split[:args.max_tgt_length]) # Initial truncation
+            mask_percent = 0.0
+            if (slang == tlang and not args.is_summarization) or args.source_masking_for_bilingual: ## Copying task should DEFINITELY use source masking unless we are doing summarization.
+                if args.source_masking_for_bilingual:
+                    mask_percent = random.uniform(0.0, mp_val_or_range[0]) ## Do less masking
+                else:
+                    if type(mp_val_or_range) is float:
+                        mask_percent = mp_val_or_range
+                    else:
+                        mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
+            src_sent_splits.append(src_sent_split)
+            mask_percents.append(mask_percent)
+            if is_official_bart: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
+                encoder_input_pool.append(src_sent)
+                decoder_input_pool.append(tgt_sent)
+            else:
+                encoder_input_pool.append(src_sent + " </s> " + slang)
+                if args.unify_encoder:
+                    decoder_input_pool.append(tgt_sent + " </s> " + tlang)
+                    decoder_label_pool.append(tgt_sent + " </s> " + tlang) ## This should not be used when we unify encoders.
+                else:
+                    decoder_input_pool.append(tlang + " " + tgt_sent)
+                    decoder_label_pool.append(tgt_sent + " </s>")
+                    if args.tokenization_sampling:
+                        decoder_input_pool[-1] += " </s>" ## See the comment in generate_batches_bilingual about why the EOS token is fed as input in the case of stochastic subword segmentation.
+
+        if len(encoder_input_pool) == 0:
+            print("Zero size pool due to abnormal examples. Skipping empty pool.")
+            continue
+        if any(mask_percents): ## Sentence pairs which should not be masked have a masking ratio of 0 and are left as is.
+            masked_src_sents = span_mask_sentence_batch(src_sent_splits, mask_tok, mask_percents, args)
+            encoder_input_pool = [masked_src_sent + encoder_input[len(" ".join(src_sent_split)):] for masked_src_sent, encoder_input, src_sent_split in zip(masked_src_sents, encoder_input_pool, src_sent_splits)] ## Replace the unmasked source sentence which is the prefix of the encoder input.
+        ## The whole pool is tokenized at once. The lengths used for bucketing are exact, unlike the estimates used when batches are grown one sentence pair at a time.
+        input_ids_pool = tok(encoder_input_pool, add_special_tokens=is_official_bart, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+        decoder_input_ids_pool = tok(decoder_input_pool, add_special_tokens=is_official_bart, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+        if is_official_bart or args.tokenization_sampling:
+            labels_pool = [decoder_input_ids[1:] for decoder_input_ids in decoder_input_ids_pool]
+            decoder_input_ids_pool = [decoder_input_ids[:-1] for decoder_input_ids in decoder_input_ids_pool]
+        else:
+            labels_pool = tok(decoder_label_pool, add_special_tokens=False).input_ids
+        lengths = [[len(input_ids) for input_ids in input_ids_pool], [len(labels) for labels in labels_pool]]
+        if args.cross_distillation or args.multi_source:
+            input_ids_pool_parent = tok(encoder_input_pool_parent, add_special_tokens=False, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+            lengths.append([len(input_ids_parent) for input_ids_parent in input_ids_pool_parent])
+
+        for batch_indices in bucket_examples_by_length(np.array(lengths).T, args.batch_size, args.batch_size_indicates_lines):
+            input_ids = pad_token_ids([input_ids_pool[idx] for idx in batch_indices], tok.pad_token_id, args.hard_truncate_length)
+            input_masks = (input_ids != tok.pad_token_id).int()
+            decoder_input_ids = pad_token_ids([decoder_input_ids_pool[idx] for idx in batch_indices], tok.pad_token_id, args.hard_truncate_length)
+            labels = pad_token_ids([labels_pool[idx] for idx in batch_indices], tok.pad_token_id, args.hard_truncate_length)
+            batch_count += 1
+            if args.cross_distillation or args.multi_source:
+                input_ids_parent = pad_token_ids([input_ids_pool_parent[idx] for idx in batch_indices], tok.pad_token_id, args.hard_truncate_length)
+                input_masks_parent = (input_ids_parent != tok.pad_token_id).int()
+                yield [input_ids, input_ids_parent], [input_masks, input_masks_parent], decoder_input_ids, labels
+            else:
+                yield input_ids, input_masks, decoder_input_ids, labels
+            if batch_count == args.num_batches:
+                return
+
+def generate_batches_bilingual_binarized(tok, args, files, rank):
+    """Generates the source, target and source attention masks for the training set from shards binarized via binarize_corpora.py. This is the same as generate_batches_bilingual except that the tokenizer is never called. Truncation and source masking are done at the level of subwords instead of words."""
+    assert not (args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model), "Binarized shards are not supported for the official BART model."
+    assert not (args.cross_distillation or args.multi_source), "Binarized shards are not supported for multi-source training or cross distillation."
+    print("Batches will be generated from binarized shards.")
+    batch_count = 0
+    if args.use_official_pretrained:
+        mask_tok = "<mask>"
+    else:
+        mask_tok = "[MASK]"
+    mask_tok_id = get_token_id(tok, mask_tok)
+    eos_tok_id = get_token_id(tok, "</s>")
+    if len(args.token_masking_probs_range) == 1:
+        mp_val_or_range = args.token_masking_probs_range[0]
+    elif len(args.token_masking_probs_range) == 2:
+        mp_val_or_range = args.token_masking_probs_range
+    if not args.is_summarization or args.source_masking_for_bilingual:
+        print("Masking ratio:", mp_val_or_range)
+
+    language_list = list(files.keys())
+    print("Training for:", language_list)
+    language_file_dict = {}
+    lang_tok_ids = {}
+    probs = {}
+    for l in language_list:
+        src_token_ids, src_offsets = load_binarized_file(files[l][0]+"."+"%02d" % rank)
+        tgt_token_ids, tgt_offsets = load_binarized_file(files[l][1]+"."+"%02d" % rank)
+        probs[l] = len(src_offsets) - 1
+        language_file_dict[l] = yield_binarized_corpus_indefinitely_bi(src_token_ids, src_offsets, tgt_token_ids, tgt_offsets, l)
+        slangtlang = l.strip().split("-")
+        lang_tok_ids[l] = [get_token_id(tok, lang if args.use_official_pretrained else "<2"+lang+">") for lang in slangtlang]
+    print("Corpora stats:", probs)
+    probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
+    probs = probs_temp
+    probs_temp = {lang: probs[lang]**(1.0/args.data_sampling_temperature) for lang in probs} ## Temperature sampling probabilities.
+    probs = probs_temp
+    probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
+    probs = [probs_temp[lang] for lang in language_list]
+    num_langs = len(language_list)
+    language_indices = list(range(num_langs))
+    examples = yield_bilingual_binarized_examples(language_file_dict, language_indices, language_list, probs, lang_tok_ids, mp_val_or_range, args)
+    if args.length_bucketing:
+        print("Length bucketed batches will be created from pools of", args.bucketing_pool_size, "sentence pairs.")
+    dropped_sentence = None ## We will save the sentence pair to be dropped this batch and add it to the next batch.
+    while batch_count != args.num_batches:
+        if args.length_bucketing: ## Draw a large pool of sentence pairs, sort it by length and cut it into batches which fill the token budget.
+            pool = [next(examples) for _ in range(args.bucketing_pool_size)]
+            lengths = [[len(src_sent_ids) + 2, len(tgt_sent_ids) + (2 if args.unify_encoder else 1)] for src_sent_ids, tgt_sent_ids, _, _, _ in pool]
+            batches = [[pool[idx] for idx in batch_indices] for batch_indices in bucket_examples_by_length(lengths, args.batch_size, args.batch_size_indicates_lines)]
+        else: ## Grow the batch one sentence pair at a time until it exceeds the token budget.
+            batch = []
+            max_sent_len = 0
+            while True:
+                if dropped_sentence is not None:
+                    example = dropped_sentence # Reuse the previous sentence pair
+                    dropped_sentence = None
+                else:
+                    example = next(examples)
+                src_sent_ids, tgt_sent_ids, _, _, _ = example
+                curr_sent_len = max(len(src_sent_ids) + 2, len(tgt_sent_ids) + (2 if args.unify_encoder else 1)) ## The EOS and language indicator tokens. Source masking is done for the whole batch at once and never makes a sentence longer except for the rare mask insertions.
+                if not args.batch_size_indicates_lines: ## We will drop this sentence pair for now because we may go over the limit of what the GPU can handle. It may be used in a future iteration.
+                    potential_batch_count = max(max_sent_len, curr_sent_len)*(len(batch)+1)
+                    if potential_batch_count > args.batch_size and len(batch) > 0:
+                        dropped_sentence = example
+                        break
+                max_sent_len = max(max_sent_len, curr_sent_len)
+                batch.append(example)
+                if args.batch_size_indicates_lines and len(batch) == args.batch_size:
+                    break
+            batches = [batch]
+
+        for batch in batches:
+            src_sent_ids_batch = [src_sent_ids for src_sent_ids, _, _, _, _ in batch]
+            mask_percents = [mask_percent for _, _, _, _, mask_percent in batch]
+            if any(mask_percents): ## Sentence pairs which should not be masked have a masking ratio of 0 and are left as is.
+                src_sent_ids_batch = span_mask_token_id_batch(src_sent_ids_batch, mask_tok_id, mask_percents, args)
+            encoder_input_batch = [list(src_sent_ids) + [eos_tok_id, slang_tok_id] for src_sent_ids, (_, _, slang_tok_id, _, _) in zip(src_sent_ids_batch, batch)]
+            if args.unify_encoder:
+                decoder_input_batch = [list(tgt_sent_ids) + [eos_tok_id, tlang_tok_id] for _, tgt_sent_ids, _, tlang_tok_id, _ in batch]
+                decoder_label_batch = decoder_input_batch ## This should not be used when we unify encoders.
+            else:
+                decoder_input_batch = [[tlang_tok_id] + list(tgt_sent_ids) for _, tgt_sent_ids, _, tlang_tok_id, _ in batch]
+                decoder_label_batch = [list(tgt_sent_ids) + [eos_tok_id] for _, tgt_sent_ids, _, _, _ in batch]
+            input_ids = pad_token_ids(encoder_input_batch, tok.pad_token_id, args.hard_truncate_length)
+            input_masks = (input_ids != tok.pad_token_id).int()
+            decoder_input_ids = pad_token_ids(decoder_input_batch, tok.pad_token_id, args.hard_truncate_length)
+            labels = pad_token_ids(decoder_label_batch, tok.pad_token_id, args.hard_truncate_length)
+            batch_count += 1
+            yield input_ids, input_masks, decoder_input_ids, labels
+            if batch_count == args.num_batches:
+                return
+
+def yield_bilingual_binarized_examples(language_file_dict, language_indices, language_list, probs, lang_tok_ids, mp_val_or_range, args):
+    """This method samples sentence pairs from the binarized corpora using the temperature based sampling probabilities, drops pairs that are too short and truncates the rest. It returns the source ids, target ids, source and target language indicator token ids and the source masking ratio (0 for no masking) indefinitely."""
+    while True:
+        language_idx = random.choices(language_indices, probs)[0]
+        src_sent_ids, tgt_sent_ids = next(language_file_dict[language_list[language_idx]])
+        slang_tok_id, tlang_tok_id = lang_tok_ids[language_list[language_idx]]
+        if len(src_sent_ids) <= 1 or len(tgt_sent_ids) <= 1:
+            continue
+        src_sent_ids = src_sent_ids[:args.max_src_length] # Initial truncation
+        tgt_sent_ids = tgt_sent_ids[:args.max_tgt_length] # Initial truncation
+        mask_percent = 0.0
+        if (slang_tok_id == tlang_tok_id and not args.is_summarization) or args.source_masking_for_bilingual: ## Copying task should DEFINITELY use source masking unless we are doing summarization.
+            if args.source_masking_for_bilingual:
+                mask_percent = random.uniform(0.0, mp_val_or_range[0]) ## Do less masking
+            else:
+                if type(mp_val_or_range) is float:
+                    mask_percent = mp_val_or_range
+                else:
+                    mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
+        yield src_sent_ids, tgt_sent_ids, slang_tok_id, tlang_tok_id, mask_percent
+
 def generate_batches_pair(tok, args):
     """Generates the source, target and source attention masks for the training set."""
     src_file = open(args.test_src)
@@ -1137,8 +1816,8 @@ def generate_batches_pair_masked(tok, args): ## TODO: Implement hard truncation
             
 
 
-def generate_batches_for_decoding(tok, args):
-    """Generates the source sentences for the test set."""
+def generate_batches_for_decoding(tok, args, rank=0, world_size=1, line_numbers=None):
+    """Generates the source sentences for the test set along with the line numbers of the sentences in each batch. By default the sentences are batched in the order of the file with args.batch_size sentences per batch. If args.length_sorted_decoding is set then all sentences are tokenized up front, sorted by length and cut into batches of args.max_decode_batch_tokens tokens (or args.batch_size sentences if that is 0) so that short sentences are not padded to the length of long ones. The line numbers are then needed to write the translations back in the original order. When decoding with multiple processes only the lines in the shard of the current rank are batched (see get_decoding_shard_line_numbers) and the line numbers refer to the whole file. If line_numbers is given then only those lines are batched, for example to skip the lines whose translations are already known."""
     if args.tokenization_sampling:
         print("Stochastic tokenizer will be used.")
         if "bart" in args.tokenizer_name_or_path:
@@ -1150,9 +1829,8 @@ def generate_batches_for_decoding(tok, args):
         mask_tok = "<mask>"
     else:
         mask_tok = "[MASK]"
-    src_file = open(args.test_src)
+    is_official_bart = args.use_official_pretrained and "bart" in args.model_path and "mbart" not in args.model_path
     slang = args.slang
-    curr_batch_count = 0
     encoder_input_batch = []
     if args.multi_source: ## Additional source batch and length info
         encoder_input_batch_parent = []
@@ -1168,9 +1846,12 @@ def generate_batches_for_decoding(tok, args):
         mp_val_or_range = args.token_masking_probs_range
     print("Masking ratio:", mp_val_or_range)
 
-    for src_line in src_file:
-        start = time.time()
-        src_sent = src_line.strip()
+    src_sent_splits = []
+    mask_percents = []
+    src_lines = open(args.test_src).readlines()
+    shard_line_numbers = get_decoding_shard_line_numbers(len(src_lines), rank, world_size, args.decoding_shard_strategy) if line_numbers is None else line_numbers
+    for line_number in shard_line_numbers:
+        src_sent = src_lines[line_number].strip()
         if args.multi_source: ## We assume that we use a N-way corpus of 3 languages X, Y and Z. We want to distill Y-Z behavior into X-Z where the Y-Z pair also has additional larger corpora but X-Z does not. As such the source sentence should be a tab separated sentence consisting of X[tab]Y.
             src_sent = src_sent.split("\t")
             src_sent_parent = src_sent[0].strip() ## This is the sentence for Y
@@ -1182,31 +1863,15 @@ def generate_batches_for_decoding(tok, args):
             src_sent = " ".join(src_sent_split)
             sent_len = args.max_src_length
         
-        if args.mask_input:
+        if args.mask_input: ## Masking is done for all sentences at once before they are tokenized.
             if type(mp_val_or_range) is float:
                 mask_percent = mp_val_or_range
             else:
                 mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
-            mask_count = 0
-            max_mask_count = int(mask_percent*sent_len)
-            spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
-            curr_sent_len = sent_len
-            while mask_count < max_mask_count:
-                try:
-                    span_to_mask = spans_to_mask[0]
-                    del spans_to_mask[0]
-                    if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
-                        continue
-                    idx_to_mask = random.randint(sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1))
-                    if mask_tok not in src_sent_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                        src_sent_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                        mask_count += span_to_mask # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                        curr_sent_len -= (span_to_mask-1)
-                except:
-                    break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
-            src_sent = " ".join(src_sent_split)
+            src_sent_splits.append(src_sent_split)
+            mask_percents.append(mask_percent)
         
-        if args.use_official_pretrained and "bart" in args.model_path and "mbart" not in args.model_path: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
+        if is_official_bart: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
             encoder_input_batch.append(src_sent)
         else:
             encoder_input_batch.append(src_sent + " </s> " + lang)
@@ -1220,46 +1885,45 @@ def generate_batches_for_decoding(tok, args):
                 sent_len_parent = args.max_src_length
 
             encoder_input_batch_parent.append(src_sent_parent + " </s> " + lang_parent)
-            
-        curr_batch_count += 1
-        if curr_batch_count == args.batch_size:
-            if args.use_official_pretrained and "bart" in args.model_path and "mbart" not in args.model_path: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
-                input_ids = tok(encoder_input_batch, return_tensors="pt", padding=True).input_ids
-            else:
-                input_ids = tok(encoder_input_batch, add_special_tokens=False, return_tensors="pt", padding=True).input_ids
-            if args.hard_truncate_length > 0 and len(input_ids[0]) > args.hard_truncate_length:
-                input_ids = input_ids[:,:args.hard_truncate_length]
-            input_masks = input_ids != tok.pad_token_id
-            end = time.time()
-            if args.multi_source: ## Process the batch for the additional source as well.
-                input_ids_parent = tok(encoder_input_batch_parent, add_special_tokens=False, return_tensors="pt", padding=True).input_ids
-                if args.hard_truncate_length > 0 and len(input_ids_parent[0]) > args.hard_truncate_length:
-                    input_ids_parent = input_ids_parent[:,:args.hard_truncate_length]
-                input_masks_parent = (input_ids_parent != tok.pad_token_id).int()
-                yield [input_ids, input_ids_parent], [input_masks, input_masks_parent]
-            else:
-                yield input_ids, input_masks
-            curr_batch_count = 0
-            encoder_input_batch = []
-            if args.multi_source: ## Additional source batch and length info
-                encoder_input_batch_parent = []
+    
+    if args.mask_input: ## Replace the unmasked source sentence which is the prefix of the encoder input.
+        encoder_input_batch = [masked_src_sent + encoder_input[len(" ".join(src_sent_split)):] for masked_src_sent, encoder_input, src_sent_split in zip(span_mask_sentence_batch(src_sent_splits, mask_tok, mask_percents, args), encoder_input_batch, src_sent_splits)]
+
+    if args.length_sorted_decoding:
+        input_ids_all = tok(encoder_input_batch, add_special_tokens=is_official_bart, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+        lengths = [[len(input_ids) for input_ids in input_ids_all]]
+        if args.multi_source:
+            input_ids_all_parent = tok(encoder_input_batch_parent, add_special_tokens=False, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+            lengths.append([len(input_ids_parent) for input_ids_parent in input_ids_all_parent])
+        if args.max_decode_batch_tokens > 0:
+            batches = bucket_examples_by_length(np.array(lengths).T, args.max_decode_batch_tokens, shuffle=False)
+        else:
+            batches = bucket_examples_by_length(np.array(lengths).T, args.batch_size, batch_size_indicates_lines=True, shuffle=False)
+        print("Decoding", len(encoder_input_batch), "sentences sorted by length in", len(batches), "batches.")
+    else:
+        batches = [np.arange(batch_start, min(batch_start+args.batch_size, len(encoder_input_batch))) for batch_start in range(0, len(encoder_input_batch), args.batch_size)]
 
-    if len(encoder_input_batch) != 0:
-        if args.use_official_pretrained and "bart" in args.model_path and "mbart" not in args.model_path: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
-            input_ids = tok(encoder_input_batch, return_tensors="pt", padding=True, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+    for batch_indices in batches:
+        if args.length_sorted_decoding: ## Already tokenized.
+            input_ids = pad_token_ids([input_ids_all[idx] for idx in batch_indices], tok.pad_token_id, args.hard_truncate_length)
+        elif is_official_bart: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
+            input_ids = tok([encoder_input_batch[idx] for idx in batch_indices], return_tensors="pt", padding=True, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
         else:
-            input_ids = tok(encoder_input_batch, add_special_tokens=False, return_tensors="pt", padding=True, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+            input_ids = tok([encoder_input_batch[idx] for idx in batch_indices], add_special_tokens=False, return_tensors="pt", padding=True, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
         if args.hard_truncate_length > 0 and len(input_ids[0]) > args.hard_truncate_length:
             input_ids = input_ids[:,:args.hard_truncate_length]
         input_masks = input_ids != tok.pad_token_id
         if args.multi_source: ## Process the batch for the additional source as well.
-            input_ids_parent = tok(encoder_input_batch_parent, add_special_tokens=False, return_tensors="pt", padding=True, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+            if args.length_sorted_decoding: ## Already tokenized.
+                input_ids_parent = pad_token_ids([input_ids_all_parent[idx] for idx in batch_indices], tok.pad_token_id, args.hard_truncate_length)
+            else:
+                input_ids_parent = tok([encoder_input_batch_parent[idx] for idx in batch_indices], add_special_tokens=False, return_tensors="pt", padding=True, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
             if args.hard_truncate_length > 0 and len(input_ids_parent[0]) > args.hard_truncate_length:
                 input_ids_parent = input_ids_parent[:,:args.hard_truncate_length]
             input_masks_parent = (input_ids_parent != tok.pad_token_id).int()
-            yield [input_ids, input_ids_parent], [input_masks, input_masks_parent]
+            yield [input_ids, input_ids_parent], [input_masks, input_masks_parent], [shard_line_numbers[idx] for idx in batch_indices]
         else:
-            yield input_ids, input_masks
+            yield input_ids, input_masks, [shard_line_numbers[idx] for idx in batch_indices]
 
 def generate_batches_for_decoding_lm(tok, args):
     """Generates the source sentences for the test set."""
@@ -1357,3 +2021,79 @@ def generate_batches_monolingual_masked_or_bilingual(tok, args, rank, files, tra
         return generate_batches_bilingual(tok, args, train_files, rank)
     else:
         return generate_batches_monolingual_masked(tok, args, files, rank)
+
+class BatchGenerationDataset(IterableDataset):
+    """Wraps a batch generator so that it can be run inside the worker processes of a DataLoader. Each worker runs its own copy of the generator with its own seed and produces its share of the batches."""
+    def __init__(self, batch_generator, args, rank):
+        super().__init__()
+        self.batch_generator = batch_generator
+        self.args = args
+        self.rank = rank
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = worker_info.id, worker_info.num_workers
+        self.args.num_batches = get_num_batches_for_worker(self.args.num_batches, worker_id, num_workers) ## Each worker has its own copy of args which is also the one the generator will see.
+        seed = self.args.batch_generation_seed + self.rank*num_workers + worker_id ## Every worker on every rank gets a different but reproducible seed.
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        return iter(self.batch_generator())
+
+def get_num_batches_for_worker(num_batches, worker_id, num_workers):
+    """Splits the total number of batches as evenly as possible between the workers. The first few workers get one batch extra if the number of batches is not divisible by the number of workers."""
+    return num_batches//num_workers + (1 if worker_id < num_batches % num_workers else 0)
+
+def generate_batches_in_background(batch_generator, args, rank):
+    """Runs a batch generator in args.num_batch_workers background processes so that masking, tokenization and padding do not block the training step. Ready batches are put in shared memory queues holding at most args.batch_prefetch_factor batches per worker and are pinned if a GPU is available. The DataLoader consumes batches from the workers in a fixed round robin order so the sequence of batches is deterministic for a given seed and number of workers. batch_generator should be a function without arguments which returns a batch generator. If the number of workers is 0 then the batches are generated inline like before."""
+    if args.num_batch_workers <= 0:
+        return batch_generator()
+    print("Batches will be generated by", args.num_batch_workers, "background workers.")
+    return DataLoader(BatchGenerationDataset(batch_generator, args, rank), batch_size=None, num_workers=args.num_batch_workers, prefetch_factor=args.batch_prefetch_factor, pin_memory=torch.cuda.is_available())
+
+def snapshot_state_to_cpu(state, snapshots=None):
+    """This method makes a copy of a (nested) state dict in which every tensor is copied to the CPU. The copy is not affected by the optimizer steps which follow. Tensors which share memory (for example the parameters in model.state_dict() and model.module.state_dict()) are copied only once and the copies also share memory."""
+    if snapshots is None:
+        snapshots = {}
+    if torch.is_tensor(state):
+        key = (state.data_ptr(), state.dtype, state.device, tuple(state.size()), tuple(state.stride()))
+        if key not in snapshots:
+            snapshots[key] = state.detach().to("cpu", copy=True)
+        return snapshots[key]
+    elif isinstance(state, dict):
+        return type(state)((key, snapshot_state_to_cpu(value, snapshots)) for key, value in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state_to_cpu(value, snapshots) for value in state)
+    else:
+        return state
+
+class AsyncCheckpointSaver:
+    """Saves checkpoints in a background thread so that training does not wait for the disk. The states are first snapshotted to the CPU which is the only part of saving that blocks training. Each file is written to a temporary file which is then renamed so that a crash during saving never leaves a partially written checkpoint behind. Only one save is in flight at a time so a new save waits for the previous one to be written."""
+    def __init__(self):
+        self.thread = None
+        self.exception = None
+
+    def save(self, states_and_file_names):
+        """Snapshots a list of (state, file_name) pairs and writes them in the background."""
+        self.wait()
+        snapshots = {}
+        states_and_file_names = [(snapshot_state_to_cpu(state, snapshots), file_name) for state, file_name in states_and_file_names]
+        self.thread = threading.Thread(target=self.write, args=(states_and_file_names,), daemon=True)
+        self.thread.start()
+
+    def write(self, states_and_file_names):
+        try:
+            for state, file_name in states_and_file_names:
+                torch.save(state, file_name+".tmp")
+                os.replace(file_name+".tmp", file_name)
+        except Exception as e: ## Raised in the training process when we next wait for the saver.
+            self.exception = e
+
+    def wait(self):
+        """Blocks till the previous save has been written to disk."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.exception is not None:
+            exception, self.exception = self.exception, None
+            raise exception
@@ -26,6 +26,7 @@ import os
 import sys
 import argparse
 import time
+import copy
 os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"   # see issue #152
 ##
 
@@ -34,6 +35,9 @@ import transformers
 from transformers import AutoTokenizer, MBartTokenizer, MBart50Tokenizer, BartTokenizer
 from transformers import MBartForConditionalGeneration, BartForConditionalGeneration, MBartConfig, get_linear_schedule_with_warmup
 from transformers import AdamW
+from transformers.models.mbart.export_mbart import export_mbart
+from transformers.models.mbart.speculative_mbart import MBartSpeculativeDecoder
+from transformers.models.mbart.streaming_mbart import MBartStreamingDecoder
 ##
 
 ## Pytorch imports
@@ -70,10 +74,113 @@ rcParams['font.sans-serif'] = ['Source Han Sans TW',
 ##
 
 
+def decode_test_set(model, tok, args, rank, device, test_tgt, vocabulary_shortlist=None, early_exit=False, speculative_decoder=None, translation_memory=None):
+    """This method translates the lines of the test set assigned to the current process and writes the translations to test_tgt. With multiple processes each process writes its own partial file and the main process merges them at the end. If vocabulary_shortlist (see load_vocabulary_shortlist) is given then the output projection of each batch is restricted to a shortlist built from its source tokens. If early_exit is set then the decoder exits early as per args.early_exit_threshold and args.early_exit_criterion and the average number of decoder layers used per token is printed. If a speculative_decoder (a MBartSpeculativeDecoder of the model) is given then it is used instead of generate and the fraction of the proposals of the draft model which were accepted is printed. If a translation_memory (see TranslationMemory) is given then lines whose translations it has are not decoded and the new translations are added to it. With a translation memory or args.deduplicate_test_src only the first of identical source lines is decoded and its translations are reused for the others. Returns the best translation of each line (of all lines on the main process) for computing BLEU."""
+    if args.world_size > 1: ## Each process decodes its own shard of the test set into its own file. These are merged at the end.
+        outf = open(test_tgt+"."+"%02d" % rank, 'w')
+    else:
+        outf = open(test_tgt, 'w')
+    hyp = []
+    ctr = 0
+    decoding_start = time.time()
+    translations_by_line = {} ## Batches may not be in the order of the input file (see --length_sorted_decoding) so translations wait here till all translations of preceding lines have been written.
+    shard_line_numbers = get_decoding_shard_line_numbers(len(open(args.test_src).readlines()), rank, args.world_size, args.decoding_shard_strategy) ## The lines of the test set which this process will decode.
+    next_line = 0
+    shortlist_sizes = []
+    if early_exit:
+        model.early_exit_num_layers_used, model.early_exit_num_steps = 0, 0
+    line_numbers_to_decode = shard_line_numbers
+    duplicate_line_numbers = {} ## The later lines with the same source as a line which is decoded or found in the translation memory.
+    if translation_memory is not None or args.deduplicate_test_src:
+        src_lines = [src_line.strip() for src_line in open(args.test_src)]
+        first_line_numbers = {}
+        for line_number in shard_line_numbers:
+            if src_lines[line_number] in first_line_numbers:
+                duplicate_line_numbers[first_line_numbers[src_lines[line_number]]].append(line_number)
+            else:
+                first_line_numbers[src_lines[line_number]] = line_number
+                duplicate_line_numbers[line_number] = []
+        line_numbers_to_decode = list(duplicate_line_numbers)
+        if translation_memory is not None:
+            remembered_translations = translation_memory.get([src_lines[line_number] for line_number in line_numbers_to_decode])
+            for line_number in line_numbers_to_decode:
+                if src_lines[line_number] in remembered_translations:
+                    for same_line_number in [line_number] + duplicate_line_numbers[line_number]:
+                        translations_by_line[same_line_number] = remembered_translations[src_lines[line_number]]
+            line_numbers_to_decode = [line_number for line_number in line_numbers_to_decode if line_number not in translations_by_line]
+        print("Decoding", len(line_numbers_to_decode), "out of", len(shard_line_numbers), "lines on rank", rank, "since", len(shard_line_numbers)-len(duplicate_line_numbers), "lines are duplicates and", len(duplicate_line_numbers)-len(line_numbers_to_decode), "were found in the translation memory.")
+    for input_ids, input_masks, line_numbers in (generate_batches_for_decoding(tok, args, rank, args.world_size, line_numbers_to_decode) if len(line_numbers_to_decode) > 0 else []): #infinite_same_sentence(10000):
+        start = time.time()
+        print("Processing batch:", ctr)
+        if args.multi_source:
+            input_ids_parent = input_ids[1]
+            input_ids = input_ids[0]
+            input_masks_parent = input_masks[1]
+            input_masks = input_masks[0]
+        generation_kwargs = {}
+        if vocabulary_shortlist is not None: ## The shortlist covers the tokens of all sources.
+            generation_kwargs["vocabulary_shortlist"] = build_vocabulary_shortlist(torch.cat([input_ids.view(-1), input_ids_parent.view(-1)]) if args.multi_source else input_ids, *vocabulary_shortlist).to(device)
+            shortlist_sizes.append(len(generation_kwargs["vocabulary_shortlist"]))
+        if early_exit:
+            generation_kwargs["early_exit_threshold"] = args.early_exit_threshold
+            generation_kwargs["early_exit_criterion"] = args.early_exit_criterion
+        source_lengths = input_masks.sum(dim=1).double() ## The length limits of each line depend on its own length and not on the padded length of the batch so that its translation does not depend on the other lines in its batch. Thus batching, deduplication and the translation memory do not change the translations.
+        sentence_max_lengths = ((source_lengths*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else torch.full_like(source_lengths, -args.max_decode_length_multiplier)).long().to(device)
+        sentence_min_lengths = ((source_lengths*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else torch.full_like(source_lengths, -args.min_decode_length_multiplier)).long().to(device)
+        if speculative_decoder is not None: ## The draft model proposes tokens which the model verifies.
+            translations = speculative_decoder.generate(input_ids.to(device), attention_mask=input_masks.to(device), min_length=0, sentence_max_lengths=sentence_max_lengths, sentence_min_lengths=sentence_min_lengths, do_sample=args.do_sample, temperature=args.sampling_temperature, top_k=args.top_k, top_p=args.top_p, repetition_penalty=args.repetition_penalty, no_repeat_ngram_size=args.no_repeat_ngram_size, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0])
+        else:
+            with torch.no_grad():
+                translations = model.generate(input_ids.to(device), use_cache=True, num_beams=args.beam_size, min_length=0, sentence_max_lengths=sentence_max_lengths, sentence_min_lengths=sentence_min_lengths, early_stopping=True, do_sample=args.do_sample, temperature=args.sampling_temperature, top_k=args.top_k, top_p=args.top_p, attention_mask=input_masks.to(device), pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, num_return_sequences=args.beam_size if args.return_all_sequences else 1, additional_input_ids=input_ids_parent.to(device) if args.multi_source else None, additional_input_ids_mask=input_masks_parent.to(device) if args.multi_source else None, **generation_kwargs) ## We translate the batch.
+        print(len(input_ids), "in and", len(translations), "out")
+        num_return_sequences = len(translations)//len(input_ids)
+        for idx, line_number in enumerate(line_numbers):
+            translations_by_line[line_number] = [tok.decode(translation[translation != tok.pad_token_id], skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) for translation in translations[idx*num_return_sequences:(idx+1)*num_return_sequences]] ## The padding after the translations which are shorter than the others in the batch is dropped.
+            for same_line_number in duplicate_line_numbers.get(line_number, []):
+                translations_by_line[same_line_number] = translations_by_line[line_number]
+        if translation_memory is not None:
+            translation_memory.put({src_lines[line_number]: translations_by_line[line_number] for line_number in line_numbers})
+        next_line = write_ready_translations(outf, hyp, translations_by_line, shard_line_numbers, next_line)
+        ctr += 1
+    next_line = write_ready_translations(outf, hyp, translations_by_line, shard_line_numbers, next_line) ## Lines after the last decoded one may have come from the translation memory.
+    outf.close()
+    if args.world_size > 1: ## Wait for all processes to finish their shards after which the main process merges them in the original order.
+        dist.barrier()
+        if rank == 0:
+            hyp = merge_decoding_shards(args, args.beam_size if args.return_all_sequences else 1, test_tgt)
+    print("Decoding took", time.time()-decoding_start, "seconds on rank", rank)
+    if len(shortlist_sizes) > 0:
+        print("The average vocabulary shortlist size was", sum(shortlist_sizes)/len(shortlist_sizes), "out of", len(tok), "tokens on rank", rank)
+    if speculative_decoder is not None:
+        print("The model accepted", speculative_decoder.acceptance_rate(), "of the tokens proposed by the draft model on rank", rank)
+    if early_exit and model.early_exit_num_steps > 0:
+        print("The average number of decoder layers used per token was", model.early_exit_num_layers_used/model.early_exit_num_steps, "out of", len(model.model.decoder.layers), "on rank", rank)
+    if translation_memory is not None:
+        print("The translation memory had", translation_memory.hits, "hits and", translation_memory.misses, "misses and", len(shard_line_numbers)-len(duplicate_line_numbers), "lines were duplicates of earlier lines on rank", rank)
+    elif args.deduplicate_test_src:
+        print(len(shard_line_numbers)-len(duplicate_line_numbers), "lines were duplicates of earlier lines on rank", rank)
+    return hyp
+
+def write_ready_translations(outf, hyp, translations_by_line, shard_line_numbers, next_line):
+    """This method writes the translations of the lines starting from shard_line_numbers[next_line] for as long as they are available in translations_by_line, so that the output is in the original order. The best translation of each written line is appended to hyp. Returns the position of the first line which could not be written yet."""
+    while next_line < len(shard_line_numbers) and shard_line_numbers[next_line] in translations_by_line:
+        line_translations = translations_by_line.pop(shard_line_numbers[next_line])
+        for translation in line_translations:
+            outf.write(translation+"\n")
+        outf.flush()
+        hyp.append(line_translations[0]) ## The best translation is used for computing BLEU.
+        next_line += 1
+    return next_line
+
 def model_create_load_decode(gpu, args):
     """The main function which does the overall decoding, visualization etc. Should be split into multiple parts in the future. Currently monolithc intentionally."""
-    rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size. This need not be done using DDP but I am leaving it as is for consistency with my other code. In the future, I plan to support sharding the decoding data into multiple shards which will then be decoded in a distributed fashion.
-    dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size. This need not be done using DDP but I am leaving it as is for consistency with my other code. When decoding with more than one process, each process decodes its own shard of the test set.
+    dist.init_process_group(backend='gloo' if args.cpu else 'nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    if args.cpu: ## The processes share the cores of the node.
+        torch.set_num_threads(max(1, os.cpu_count()//args.gpus))
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda", gpu)
     
     if args.use_official_pretrained:
         if "mbart" in args.model_path:
@@ -101,16 +208,19 @@ def model_create_load_decode(gpu, args):
     if args.use_official_pretrained:
         if "mbart" in args.model_path:
             model = MBartForConditionalGeneration.from_pretrained(args.model_path) ## This is only to avoid having to specify the hyperparams manually assuming you fine-tuned an official model. If you know the hyperparams then dont use this.
+            model.config.static_kv_cache = args.static_kv_cache
         elif "bart" in args.model_path:
             model = BartForConditionalGeneration.from_pretrained(args.model_path) ## This is only to avoid having to specify the hyperparams manually assuming you fine-tuned an official model. If you know the hyperparams then dont use this.
     else:
-        config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings) ## Configuration.
+        config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, attention_implementation=args.attention_implementation, attention_chunk_size=args.attention_chunk_size, static_kv_cache=args.static_kv_cache) ## Configuration.
         model = MBartForConditionalGeneration(config)
     model.eval()
-    torch.cuda.set_device(gpu)
-    
-    model.cuda(gpu)
-    model = DistributedDataParallel(model, device_ids=[gpu])
+    if args.cpu:
+        model = DistributedDataParallel(model)
+    else:
+        torch.cuda.set_device(gpu)
+        model.cuda(gpu)
+        model = DistributedDataParallel(model, device_ids=[gpu])
     
     
     if args.use_official_pretrained and args.locally_fine_tuned_model_path is None: ## If we want to directly decode an official model.
@@ -118,54 +228,90 @@ def model_create_load_decode(gpu, args):
     else:
         if args.use_official_pretrained and args.locally_fine_tuned_model_path is not None: ## If we want to decode a locally fine-tuned version of an official model.
             args.model_path = args.locally_fine_tuned_model_path
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % rank}
+        map_location = "cpu" if args.cpu else {'cuda:%d' % 0: 'cuda:%d' % rank}
         checkpoint_dict = torch.load(args.model_path, map_location=map_location)
         if type(checkpoint_dict) == dict:
             model.load_state_dict(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict['model'], 4, args), args), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization) else False) ## Modification needed if we want to load a partial model trained using multilayer softmaxing.
         else:
             model.module.load_state_dict(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict, 3, args), args), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization) else False) ## Modification needed if we want to load a partial model trained using multilayer softmaxing.
     model.eval()        
+    draft_model = None
+    if args.draft_model_path is not None: ## A smaller model with the same vocabulary, such as a student distilled from this model, proposes the tokens for speculative decoding.
+        draft_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.draft_encoder_layers, decoder_layers=args.draft_decoder_layers, encoder_attention_heads=args.draft_encoder_attention_heads, decoder_attention_heads=args.draft_decoder_attention_heads, encoder_ffn_dim=args.draft_encoder_ffn_dim, decoder_ffn_dim=args.draft_decoder_ffn_dim, d_model=args.draft_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, attention_implementation=args.attention_implementation, attention_chunk_size=args.attention_chunk_size) ## The draft model is a plain model.
+        draft_model = MBartForConditionalGeneration(draft_config).to(device)
+        draft_checkpoint_dict = torch.load(args.draft_model_path, map_location="cpu" if args.cpu else {'cuda:%d' % 0: 'cuda:%d' % rank})
+        if type(draft_checkpoint_dict) == dict: ## The model in full checkpoints was saved with the DDP wrapper.
+            draft_checkpoint_dict = {(key[len("module."):] if key.startswith("module.") else key): value for key, value in draft_checkpoint_dict['model'].items()}
+        draft_model.load_state_dict(draft_checkpoint_dict)
+        draft_model.eval()
+        print("Loaded the draft model for speculative decoding.")
+    if args.cpu_inference: ## Dynamic int8 quantization of all linear layers, that is the attention projections, the feed forward layers and the lm head. Their weights are stored in int8 and the activations are quantized on the fly.
+        fp32_model = copy.deepcopy(model.module) if args.decode_type == "decode" and args.test_ref is not None else None ## Only kept to report the BLEU without quantization next to the BLEU with quantization.
+        torch.quantization.quantize_dynamic(model.module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        if draft_model is not None:
+            torch.quantization.quantize_dynamic(draft_model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        print("Quantized the linear layers to int8.")
     ctr = 0
-    outf = open(args.test_tgt, 'w')
+    if args.decode_type != "decode" and args.decode_type != "simultaneous" and args.decode_type != "export": ## Decoding opens its own output files and exporting writes none.
+        outf = open(args.test_tgt, 'w')
     if args.decode_type == "decode": ## Standard NMT decoding.
         print("Decoding file")
-        hyp = []
         if args.test_ref is not None:
             refs = [[refline.strip() for refline in open(args.test_ref)]]
-        for input_ids, input_masks in generate_batches_for_decoding(tok, args): #infinite_same_sentence(10000):
-            start = time.time()
-            print("Processing batch:", ctr)
-            if args.multi_source:
-                input_ids_parent = input_ids[1]
-                input_ids = input_ids[0]
-                input_masks_parent = input_masks[1]
-                input_masks = input_masks[0]
-            with torch.no_grad():
-                translations = model.module.generate(input_ids.to(gpu), use_cache=True, num_beams=args.beam_size, max_length=int((len(input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=input_masks.to(gpu), pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, num_return_sequences=args.beam_size if args.return_all_sequences else 1, additional_input_ids=input_ids_parent.to(gpu) if args.multi_source else None, additional_input_ids_mask=input_masks_parent.to(gpu) if args.multi_source else None) ## We translate the batch.
-            print(len(input_ids), "in and", len(translations), "out")
-            for input_id, translation in zip(input_ids, translations):
-                translation  = tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) 
-                input_id  = tok.decode(input_id, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) ### Get the raw sentences.
-                outf.write(translation+"\n")
-                outf.flush()
-                hyp.append(translation)
-            ctr += 1
-        if args.test_ref is not None:
+        vocabulary_shortlist = load_vocabulary_shortlist(tok, args) if args.vocabulary_shortlist else None
+        early_exit = args.early_exit_threshold is not None
+        speculative_decoder = MBartSpeculativeDecoder(model.module, draft_model, args.num_draft_tokens) if draft_model is not None else None
+        translation_memory = None
+        if args.translation_memory is not None:
+            if args.do_sample or args.mask_input or args.tokenization_sampling:
+                print("The translation memory will not be used because sampling, input masking or stochastic tokenization make the translations random.")
+            else:
+                translation_memory = TranslationMemory(args.translation_memory, get_translation_memory_namespace(args), args.translation_memory_max_entries)
+        decoding_start = time.time()
+        hyp = decode_test_set(model.module, tok, args, rank, device, args.test_tgt, vocabulary_shortlist, early_exit, speculative_decoder, translation_memory)
+        if translation_memory is not None:
+            translation_memory.close()
+        decoding_time = time.time()-decoding_start
+        if args.test_ref is not None and rank == 0:
             sbleu = get_sacrebleu(refs, hyp)
             print("BLEU score is:", sbleu)
+        if early_exit and args.test_ref is not None: ## Decode once more with all decoder layers so that the BLEU and latency trade-off of exiting early is visible.
+            print("Decoding file without early exit")
+            decoding_start = time.time()
+            all_layers_hyp = decode_test_set(model.module, tok, args, rank, device, args.test_tgt+".all_layers", vocabulary_shortlist)
+            all_layers_decoding_time = time.time()-decoding_start
+            if rank == 0:
+                print("BLEU score with early exit is:", sbleu, "in", decoding_time, "seconds and without it is:", get_sacrebleu(refs, all_layers_hyp), "in", all_layers_decoding_time, "seconds")
+        if speculative_decoder is not None and args.test_ref is not None: ## Decode once more with the model alone so that the speed up is visible. The translations are the same with greedy decoding.
+            print("Decoding file without the draft model")
+            decoding_start = time.time()
+            no_draft_hyp = decode_test_set(model.module, tok, args, rank, device, args.test_tgt+".no_draft")
+            no_draft_decoding_time = time.time()-decoding_start
+            if rank == 0:
+                print("BLEU score with the draft model is:", sbleu, "in", decoding_time, "seconds and without it is:", get_sacrebleu(refs, no_draft_hyp), "in", no_draft_decoding_time, "seconds")
+        if args.vocabulary_shortlist and args.test_ref is not None: ## Decode once more with the full vocabulary so that the accuracy lost by shortlisting is visible.
+            print("Decoding file without the vocabulary shortlist")
+            full_vocabulary_hyp = decode_test_set(model.module, tok, args, rank, device, args.test_tgt+".full_vocabulary")
+            if rank == 0:
+                print("BLEU score with the vocabulary shortlist is:", sbleu, "and without it is:", get_sacrebleu(refs, full_vocabulary_hyp))
+        if args.cpu_inference and args.test_ref is not None: ## Decode once more without quantization so that the accuracy lost by quantization is visible.
+            print("Decoding file without quantization")
+            fp32_hyp = decode_test_set(fp32_model, tok, args, rank, device, args.test_tgt+".fp32", vocabulary_shortlist, early_exit)
+            if rank == 0:
+                print("BLEU score with int8 quantization is:", sbleu, "and without quantization is:", get_sacrebleu(refs, fp32_hyp))
     elif args.decode_type == "score" or args.decode_type == "teacher_forced_decoding": ## Here we will either score a sentence and its translation. The score will be the NLL loss. If not scoring then we will use the softmax to generate translations.
         print("Scoring translations or teacher forced decoding. Will print the log probability or (oracle) translations.")
         hyp = []
         if args.test_ref is not None:
             refs = [[refline.strip() for refline in open(args.test_ref)]]
         for input_ids, input_masks, decoder_input_ids, decoder_masks, labels in generate_batches_pair(tok, args):
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu))
+            mod_compute = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device))
             logits = mod_compute.logits
             softmax = torch.nn.functional.log_softmax(logits, dim=-1)
             print(softmax.size())
             if args.decode_type == "teacher_forced_decoding": ## Use the softmax for prediction instead of computing NLL loss.
                 translations = torch.argmax(softmax, dim=-1)
-                tgt_masks = (labels != tok.pad_token_id).int().to(gpu)
+                tgt_masks = (labels != tok.pad_token_id).int().to(device)
                 translations = translations * tgt_masks
                 print(translations.size())
                 for input_id, translation in zip(input_ids, translations):
@@ -175,7 +321,7 @@ def model_create_load_decode(gpu, args):
                     outf.flush()
                     hyp.append(translation)
             else: ## Return the label smoothed loss.
-                logprobs = label_smoothed_nll_loss(softmax, labels.to(gpu), args.label_smoothing, ignore_index=tok.pad_token_id)
+                logprobs = label_smoothed_nll_loss(softmax, labels.to(device), args.label_smoothing, ignore_index=tok.pad_token_id)
                 for logprob in logprobs:
                     print(logprob)
                     outf.write(str(logprob)+"\n")
@@ -201,10 +347,10 @@ def model_create_load_decode(gpu, args):
                     outf.flush()
                 final_alignment_pos = ""
                 final_alignment_str = ""
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu))
+            mod_compute = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device))
             logits = mod_compute.logits
             softmax = torch.nn.functional.log_softmax(logits, dim=-1)
-            logprobs = nll_loss(softmax, labels.to(gpu), ignore_index=tok.pad_token_id)
+            logprobs = nll_loss(softmax, labels.to(device), ignore_index=tok.pad_token_id)
             minprob = 1000
             minpos = 0
             for log_prob, dec_p in zip(logprobs, dec_pos):
@@ -218,13 +364,13 @@ def model_create_load_decode(gpu, args):
     elif args.decode_type == "get_enc_representations" or args.decode_type == "get_dec_representations": ## We want to extract the encoder or decoder representations for a given layer.
         print("Getting encoder or decoder representations for layer", args.layer_id, ". Will save representations for each input line.")
         for input_ids, input_masks, decoder_input_ids, decoder_masks, labels in generate_batches_pair(tok, args):
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu), output_hidden_states=True)
+            mod_compute = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device), output_hidden_states=True)
             #print(input_masks)
             if args.decode_type == "get_enc_representations":
-                pad_mask = input_ids.to(gpu).eq(tok.pad_token_id).unsqueeze(2)
+                pad_mask = input_ids.to(device).eq(tok.pad_token_id).unsqueeze(2)
                 hidden_state = mod_compute.encoder_hidden_states[args.layer_id]
             else:
-                pad_mask = decoder_input_ids.to(gpu).eq(tok.pad_token_id).unsqueeze(2)
+                pad_mask = decoder_input_ids.to(device).eq(tok.pad_token_id).unsqueeze(2)
                 hidden_state = mod_compute.decoder_hidden_states[args.layer_id]
             hidden_state.masked_fill_(pad_mask, 0.0)
             print(hidden_state.size())
@@ -236,7 +382,7 @@ def model_create_load_decode(gpu, args):
     elif args.decode_type == "get_attention": ## We want to extract and visualize the self attention and cross attentions for a particular layer and particular head. TODO make this work with all layers and all heads in a single plot. Currently my IQ is low so I am unable to achieve it.
         sentence_id = 0
         for input_ids, input_masks, decoder_input_ids, decoder_masks, labels in generate_batches_pair(tok, args): 
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu), output_attentions=True)
+            mod_compute = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device), output_attentions=True)
             if args.layer_id != -1 and args.att_head_id != -1: ## We will be extracting attention info for specific layers and heads.
                 print("Getting attention for layer ", args.layer_id, " and head ", args.att_head_id)
                 encoder_attentions = mod_compute.encoder_attentions[args.layer_id]
@@ -311,8 +457,45 @@ def model_create_load_decode(gpu, args):
                     ## Enc Dec plot
                     plot_attention(encdec_info, input_sent_x, tgt_sent_y, model.module.config.encoder_layers, model.module.config.encoder_attention_heads, args.test_tgt+".sentence-"+str(sentence_id)+".enc_dec.png", "Encoder Decoder Attention")
                     sentence_id += 1
+    elif args.decode_type == "simultaneous": ## Simulate simultaneous translation where the source tokens arrive one at a time and target tokens are emitted as soon as the wait-k policy allows. The latency metrics are averaged over sentences.
+        print("Simultaneous decoding with wait-k", args.wait_k if args.simultaneous_wait_k == -1 else args.simultaneous_wait_k)
+        streaming_decoder = MBartStreamingDecoder(model.module, decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], wait_k=None if args.simultaneous_wait_k == -1 else args.simultaneous_wait_k, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0])
+        translations_by_line = {}
+        latencies = []
+        for input_ids, input_masks, line_numbers in generate_batches_for_decoding(tok, args, rank, args.world_size): ## Each process decodes its own shard of the lines.
+            for input_id, input_mask, line_number in zip(input_ids, input_masks, line_numbers):
+                input_id = input_id[input_mask.bool()].tolist() ## Drop the padding.
+                streaming_decoder.reset()
+                streaming_decoder.max_length = int((len(input_id)*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier)
+                streaming_decoder.min_length = int((len(input_id)*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier)
+                for source_token_id in input_id: ## In a real system these would arrive from the speech recognizer or the user.
+                    streaming_decoder.read([source_token_id])
+                streaming_decoder.finish()
+                translations_by_line[line_number] = tok.decode(streaming_decoder.target_ids, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False)
+                latencies.append(streaming_decoder.latency())
+        hyp = [translations_by_line[line_number] for line_number in sorted(translations_by_line)]
+        with open(args.test_tgt+"."+"%02d" % rank if args.world_size > 1 else args.test_tgt, 'w') as outf:
+            for translation in hyp:
+                outf.write(translation+"\n")
+        latency_metrics = ["average_lagging", "average_proportion", "differentiable_average_lagging", "average_computation_time"]
+        latency_sums = torch.tensor([sum(latency[metric] for latency in latencies) for metric in latency_metrics] + [len(latencies)], dtype=torch.float64, device=device)
+        if args.world_size > 1: ## The main process merges the partial files in the original order and the latency metrics are averaged over the sentences of all processes.
+            dist.all_reduce(latency_sums)
+            if rank == 0:
+                hyp = merge_decoding_shards(args)
+        if rank == 0:
+            for metric, latency_sum in zip(latency_metrics, latency_sums.tolist()):
+                print("Mean", metric, "is:", latency_sum/max(latency_sums[-1].item(), 1))
+            if args.test_ref is not None:
+                refs = [[refline.strip() for refline in open(args.test_ref)]]
+                print("BLEU score is:", get_sacrebleu(refs, hyp))
+    elif args.decode_type == "export": ## Export the model into an encoder graph and a decoder graph which decodes one token at a time given the keys and values of the previous tokens. These can be used to decode on CPUs without the python model code. See MBartExportedModel in transformers/src/transformers/models/mbart/export_mbart.py.
+        if rank == 0:
+            export_mbart(model.module, args.export_dir, export_format=args.export_format)
+            print("Exported the model to", args.export_dir)
                 
-    outf.close()
+    if args.decode_type != "decode" and args.decode_type != "simultaneous" and args.decode_type != "export":
+        outf.close()
     
     
     dist.destroy_process_group()
@@ -329,6 +512,53 @@ def run_demo():
                         help='IP address of the main node')
     parser.add_argument('-p', '--port', default='26023', type=str, 
                         help='Port main node')
+    parser.add_argument('--cpu', action='store_true', 
+                        help='Should we decode on the CPU? The gloo backend is used instead of nccl and the gpus argument indicates the number of processes per node.')
+    parser.add_argument('--cpu_inference', action='store_true', 
+                        help='Should we decode on the CPU with dynamic int8 quantization? This implies --cpu. The weights of all linear layers (attention projections, feed forward layers and the lm head) are quantized to int8 after the model is loaded, which makes decoding on CPUs considerably faster. If a reference is given then the test set is decoded once more without quantization and both BLEU scores are printed so that the loss in quality is visible. The unquantized translations are written to test_tgt.fp32.')
+    parser.add_argument('--simultaneous_wait_k', default=-1, type=int, 
+                        help='The k of the wait-k policy when the decode_type is simultaneous. The source is read one token at a time and the i-th target token is emitted (greedily) as soon as i+k-1 source tokens are read. The default -1 means that the wait_k of the model is used. A different value is useful for decoding a model with a unidirectional encoder trained for full sentence translation with a test time wait-k. The average lagging, average proportion and differentiable average lagging (in source tokens) and the computation time per target token are printed.')
+    parser.add_argument('--export_dir', default=None, type=str, 
+                        help='The folder to which the model should be exported when the decode_type is export. The encoder and the decoder with past are saved as separate graphs along with the model config.')
+    parser.add_argument('--export_format', default='torchscript', type=str, choices=['torchscript', 'onnx'],
+                        help='Should the model be exported as torchscript or onnx graphs? Wait-k, unidirectional encoders, positional encodings and the merge_before_attention and merge_after_attention multi-source methods (and their self relevance variants) are supported. Onnx graphs can be run with onnxruntime.')
+    parser.add_argument('--vocabulary_shortlist', action='store_true', 
+                        help='Should we restrict the output projection to a shortlist of target tokens for each batch when the decode_type is decode? The shortlist contains the source tokens, their lexical translations (see --shortlist_lexical_table), the most frequent target tokens (see --shortlist_frequent_tokens_file) and the special tokens. The lm head is sliced once per batch so each decoding step projects onto a few thousand tokens instead of the whole vocabulary which is considerably faster on CPUs for large vocabularies. Only for MBart models. If a reference is given then the test set is decoded once more with the full vocabulary and both BLEU scores are printed. The full vocabulary translations are written to test_tgt.full_vocabulary.')
+    parser.add_argument('--shortlist_lexical_table', default=None, type=str, 
+                        help='A lexical translation table for the vocabulary shortlist where each line is "source_token target_token probability" and the tokens are subwords of the tokenizer. Such a table can be obtained by running an aligner such as fast_align on the tokenized training data.')
+    parser.add_argument('--shortlist_lexical_top_k', default=50, type=int, 
+                        help='The number of most probable lexical translations of each source token which go into the vocabulary shortlist.')
+    parser.add_argument('--shortlist_frequent_tokens_file', default=None, type=str, 
+                        help='A target language file whose most frequent tokens are always in the vocabulary shortlist.')
+    parser.add_argument('--shortlist_num_frequent_tokens', default=1000, type=int, 
+                        help='The number of most frequent target language tokens which are always in the vocabulary shortlist.')
+    parser.add_argument('--early_exit_threshold', default=None, type=float, 
+                        help='Should the decoder exit early when the decode_type is decode? Needs a model trained with --multilayer_softmaxing. At each decoding step the softmax is computed after each decoder layer and the remaining layers are skipped as soon as it satisfies this threshold (see --early_exit_criterion) for all sentences and beams in the batch, so smaller batches exit earlier. The keys and values of the skipped layers are computed from the hidden states of the exit layer. The average number of decoder layers used per token is printed. If a reference is given then the test set is decoded once more with all layers and both BLEU scores and decoding times are printed. Those translations are written to test_tgt.all_layers.')
+    parser.add_argument('--early_exit_criterion', default='confidence', type=str, choices=['confidence', 'entropy'],
+                        help='With confidence the decoder exits once the highest probability of the softmax is at least --early_exit_threshold, for example 0.9. With entropy it exits once the entropy of the softmax is at most --early_exit_threshold, for example 0.5.')
+    parser.add_argument('--draft_model_path', default=None, type=str, 
+                        help='Path to a smaller model with the same vocabulary, such as a student trained with --distillation, for speculative decoding when the decode_type is decode. The draft model proposes --num_draft_tokens tokens which the model verifies in a single decoder pass. With greedy decoding the translations are exactly those of the model alone and with --do_sample they follow the same distribution. The beam_size must be 1 and it can not be combined with --return_all_sequences, --vocabulary_shortlist or --early_exit_threshold. Multi-source and wait-k models are not supported. A round stops at the first proposal which any sentence of the batch rejects so that the sentences stay of the same length, which means that the acceptance rate and the speedup collapse with large batches. Use a small --batch_size such as 1 to 4 rather than the default of 32. The architecture of the draft model is given by the draft_* arguments. If a reference is given then the test set is decoded once more without the draft model and both BLEU scores and decoding times are printed. Those translations are written to test_tgt.no_draft.')
+    parser.add_argument('--num_draft_tokens', default=4, type=int, help="The number of tokens proposed by the draft model in each round of speculative decoding.")
+    parser.add_argument('--draft_encoder_layers', default=3, type=int, help="The value for number of encoder layers of the draft model")
+    parser.add_argument('--draft_decoder_layers', default=1, type=int, help="The value for number of decoder layers of the draft model")
+    parser.add_argument('--draft_encoder_attention_heads', default=8, type=int, help="The value for number of encoder attention heads of the draft model")
+    parser.add_argument('--draft_decoder_attention_heads', default=8, type=int, help="The value for number of decoder attention heads of the draft model")
+    parser.add_argument('--draft_encoder_ffn_dim', default=2048, type=int, help="The value for encoder ff hidden dim of the draft model")
+    parser.add_argument('--draft_decoder_ffn_dim', default=2048, type=int, help="The value for decoder ff hidden dim of the draft model")
+    parser.add_argument('--draft_d_model', default=512, type=int, help="The value for model hidden size of the draft model")
+    parser.add_argument('--do_sample', action='store_true', 
+                        help='Should we sample the translations instead of decoding with beam search or greedily? Use a beam_size of 1 for plain sampling.')
+    parser.add_argument('--sampling_temperature', default=1.0, type=float, help="The temperature of the softmax when sampling.")
+    parser.add_argument('--top_k', default=0, type=int, help="Sample from the top k tokens only. 0 means all tokens.")
+    parser.add_argument('--top_p', default=1.0, type=float, help="Sample from the smallest set of tokens whose probability is at least top_p (nucleus sampling). 1.0 means all tokens.")
+    parser.add_argument('--translation_memory', default=None, type=str, 
+                        help='Path to an sqlite file which persistently stores the translations of the source lines across decoding runs. Lines whose translations are in it are not decoded. Translations are only reused if the model checkpoint (by its md5 checksum), the source and target languages and all decoding hyperparameters such as the beam size and the length penalty are the same. Identical source lines in the test set are decoded only once. The numbers of hits and misses are printed at the end. It is not used when sampling, masking the input or with stochastic tokenization because the translations are random then.')
+    parser.add_argument('--translation_memory_max_entries', default=1000000, type=int, 
+                        help='The maximum number of source lines whose translations are kept in the translation memory. The least recently used ones are evicted first.')
+    parser.add_argument('--deduplicate_test_src', action='store_true', 
+                        help='Should identical source lines in the test set be decoded only once? This is always done when a translation memory is used.')
+    parser.add_argument('--decoding_shard_strategy', default='contiguous', type=str, choices=['contiguous', 'strided'],
+                        help='When decoding with more than one process, each process decodes a shard of the test set and the main process merges the translations. Contiguous means that each process gets a contiguous block of lines. Strided means that process i gets lines i, i+N, i+2N and so on which balances the load better if the lengths of sentences vary with their position in the file.')
     parser.add_argument('--use_official_pretrained', action='store_true', 
                         help='Use this flag if you want the config to be the same as an official pre-trained model. This is just to avoid manually setting the config. The actual model parameters will be overwritten if you specified locally_fine_tuned_model_path. This is hacky so sue me.')
     parser.add_argument('--locally_fine_tuned_model_path', default=None, type=str, 
@@ -337,6 +567,10 @@ def run_demo():
                         help='Path to the model to decode')
     parser.add_argument('--batch_size', default=32, type=int, 
                         help='Batch size in terms of number of sentences')
+    parser.add_argument('--length_sorted_decoding', action='store_true', 
+                        help='Should we sort the input sentences by their tokenized lengths before batching them? Sentences of similar lengths end up in the same batch so that short sentences are not padded to the length of long ones, which makes decoding considerably faster. The translations are written in the original order regardless.')
+    parser.add_argument('--max_decode_batch_tokens', default=0, type=int, 
+                        help='The maximum number of source tokens (including padding) in a batch when using --length_sorted_decoding. If this is 0 then each batch contains --batch_size sentences.')
     parser.add_argument('--beam_size', default=4, type=int, 
                         help='Size of beam search')
     parser.add_argument('--repetition_penalty', default=1.0, type=float, 
@@ -370,13 +604,14 @@ def run_demo():
     parser.add_argument('--encoder_ffn_dim', default=2048, type=int, help="The value for encoder ff hidden dim")
     parser.add_argument('--d_model', default=512, type=int, help="The value for model hidden size")
     parser.add_argument('--max_decode_length_multiplier', default=2.0, type=float, 
-                        help='This multiplied by the source sentence length will be the maximum decoding length. If you want to directly specify a particular value then set this to the negative of that value.')
+                        help='This multiplied by the source sentence length will be the maximum decoding length. If you want to directly specify a particular value then set this to the negative of that value. The length of each sentence is used and not the padded length of its batch. Translations which reach the maximum length end with the EOS token.')
     parser.add_argument('--min_decode_length_multiplier', default=0.1, type=float, 
-                        help='This multiplied by the source sentence length will be the minimum decoding length. If you want to directly specify a particular value then set this to the negative of that value.')
+                        help='This multiplied by the source sentence length will be the minimum decoding length. If you want to directly specify a particular value then set this to the negative of that value. The length of each sentence is used and not the padded length of its batch.')
     parser.add_argument('--hard_truncate_length', default=512, type=int, 
                         help='Should we perform a hard truncation of the batch? This will be needed to eliminate cuda caching errors for when sequence lengths exceed a particular limit. This means self attention matrices will be massive and I used to get errors. Choose this value empirically.')
     parser.add_argument('--token_masking_lambda', default=3.5, type=float, help="The value for the poisson sampling lambda value")
     parser.add_argument('--token_masking_probs_range', nargs='+', type=float, default=[0.3], help="The range of probabilities with which the token will be masked. If you want a fixed probability then specify one argument else specify ONLY 2.")
+    parser.add_argument('--mask_individual_tokens', action='store_true', help="Should we replace each masked token with a mask token (token masking) instead of replacing poisson length spans with a single mask token (text infilling)? The masking ratio is the same in both cases.")
     parser.add_argument('--tokenization_sampling', action='store_true', 
                         help='Should we use stoachastic tokenization aka BPE dropout or Subword regularization?')
     parser.add_argument('--tokenization_nbest_list_size', type=int, default=64, 
@@ -385,6 +620,12 @@ def run_demo():
                         help='The value of sentence piece regularization amount controlled via alpha or the amount of BPE dropout controlled by dropout.')
     parser.add_argument('--positional_encodings', action='store_true', 
                         help='If true then we will use positional encodings instead of learned positional embeddings.')
+    parser.add_argument('--attention_implementation', default='eager', type=str, choices=['eager', 'sdpa', 'chunked'],
+                        help='The attention kernel. eager materializes the full attention weights. sdpa uses the fused scaled dot product attention of pytorch which needs much less memory for long sequences. chunked processes attention_chunk_size queries at a time and is used instead of sdpa if pytorch does not have it. Attention weights are only returned by eager attention so any visualization or analysis of attentions falls back to it.')
+    parser.add_argument('--attention_chunk_size', default=1024, type=int,
+                        help='The number of queries processed at a time by the chunked attention. Smaller values need less memory.')
+    parser.add_argument('--static_kv_cache', action='store_true', 
+                        help='Should we preallocate the decoder key value cache for the maximum decoding length? The keys and values of each decoding step are written into the preallocated cache in place instead of being concatenated to the past keys and values, which avoids reallocating the cache at every step. Reordering the beams is then a single gather over the whole cache.')
     parser.add_argument('--no_embed_norm', action='store_true', 
                         help='If true then we wont normalize embeddings.')
     parser.add_argument('--scale_embedding', action='store_true', 
@@ -402,7 +643,7 @@ def run_demo():
     parser.add_argument('--slang', default='en', type=str, 
                         help='Source language')
     parser.add_argument('--decode_type', default='decode', type=str, 
-                        help='One of decode, score, force_align, get_enc_representation, get_dec_representation, teacher_forced_decoding or get_attention. When getting representations or attentions you must specify the index of the layer which you are interested in. By default the last layer is considered.')
+                        help='One of decode, score, force_align, get_enc_representation, get_dec_representation, teacher_forced_decoding, get_attention, simultaneous or export. When getting representations or attentions you must specify the index of the layer which you are interested in. By default the last layer is considered.')
     parser.add_argument('--tokenizer_name_or_path', default='ai4bharat/indic-bert', type=str, 
                         help='Name of or path to the tokenizer')
     parser.add_argument('--pretrained_tokenizer_name_or_path', default=None, type=str, 
@@ -440,6 +681,15 @@ def run_demo():
     
     args = parser.parse_args()
     assert len(args.token_masking_probs_range) <= 2
+    if args.cpu_inference: ## Quantized decoding is only supported on the CPU.
+        args.cpu = True
+    if args.draft_model_path is not None: ## The speculative decoder does greedy decoding or sampling of a single sequence with the full vocabulary and all decoder layers.
+        if args.beam_size != 1:
+            raise ValueError("Speculative decoding is done with greedy decoding or sampling so the beam_size should be 1.")
+        if args.return_all_sequences:
+            raise ValueError("Speculative decoding returns a single sequence per input so --return_all_sequences can not be used.")
+        if args.vocabulary_shortlist or args.early_exit_threshold is not None:
+            raise ValueError("Speculative decoding can not be combined with --vocabulary_shortlist or --early_exit_threshold.")
     print("IP address is", args.ipaddr)
     #########################################################
     args.world_size = args.gpus * args.nodes                #
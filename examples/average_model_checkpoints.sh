@@ -38,4 +38,8 @@ python average_checkpoints.py --inputs examples/models/nmt_model examples/models
 
 ## Geometric average two checkpoints (actually the same checkpoint twice as this is just an example)
 
-# python average_checkpoints.py --inputs examples/models/nmt_model examples/models/nmt_model --output examples/models/averaged.nmt_model --geometric_mean
\ No newline at end of file
+# python average_checkpoints.py --inputs examples/models/nmt_model examples/models/nmt_model --output examples/models/averaged.nmt_model --geometric_mean
+
+## Exponential moving average of checkpoints in chronological order while reading only one parameter at a time into memory
+
+# python average_checkpoints.py --inputs examples/models/nmt_model.pure_model examples/models/nmt_model.pure_model --output examples/models/averaged.nmt_model.pure_model --streaming --ema_decay 0.9
@@ -115,7 +115,7 @@ def model_create_load_run_save(gpu, args, files, train_files):
         model.attention_dropout = args.attention_dropout ## We should set dropouts manually
         model.activation_dropout = args.activation_dropout ## We should set dropouts manually
     else:
-        config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings) ## Configuration. TODO: Save this configuration somehow.
+        config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, attention_implementation=args.attention_implementation, attention_chunk_size=args.attention_chunk_size) ## Configuration. TODO: Save this configuration somehow.
         model = MBartForConditionalGeneration(config)
     torch.cuda.set_device(gpu)
 
@@ -133,7 +133,7 @@ def model_create_load_run_save(gpu, args, files, train_files):
             parent_model.attention_dropout = args.attention_dropout ## We should set dropouts manually
             parent_model.activation_dropout = args.activation_dropout ## We should set dropouts manually
         else:
-            parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings)
+            parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, attention_implementation=args.attention_implementation, attention_chunk_size=args.attention_chunk_size)
             parent_model = MBartForConditionalGeneration(config)
         parent_model.cuda(gpu)
         parent_model.train() ## We do this to enable dropout but we wont have an optimizer for this so we wont train this model. For now. Future implementations should ask if we want to do co-distill or not. By co-distillation I mean, the parent will learn together with the child.
@@ -217,8 +217,9 @@ def model_create_load_run_save(gpu, args, files, train_files):
         print("Using a multistep optimizer where gradients will be accumulated over", args.multistep_optimizer_steps, "batches.")
     num_batches_this_optimizer_step = 0
     losses = 0
+    checkpoint_saver = AsyncCheckpointSaver() ## Checkpoints are written to disk in the background while training continues.
     
-    for input_ids, input_masks, decoder_input_ids, labels in generate_batches_monolingual_masked_or_bilingual(tok, args, rank, files, train_files, ctr): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked. Since this is pretraining we do not do any evaluations even if we train on parallel corpora.
+    for input_ids, input_masks, decoder_input_ids, labels in generate_batches_in_background(functools.partial(generate_batches_monolingual_masked_or_bilingual, tok, args, rank, files, train_files, ctr), args, rank): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked. Since this is pretraining we do not do any evaluations even if we train on parallel corpora.
         start = time.time()
         optimizer.zero_grad() ## Empty the gradients before any computation.
         
@@ -231,24 +232,13 @@ def model_create_load_run_save(gpu, args, files, train_files):
                 # random parameters and gradients are synchronized in backward passes.
                 # Therefore, saving it in one process is sufficient.
                 checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-                torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
-                torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model")
+                files_to_save = [(checkpoint_dict, CHECKPOINT_PATH), (model.module.state_dict(), CHECKPOINT_PATH+".pure_model")] ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
                 if ctr % args.no_eval_save_every == 0: ## If no evaluation will be done then I consider it prudent to save the model every 10000 checkpoints by default. Change this to whatever value you want.
-                    torch.save(checkpoint_dict, CHECKPOINT_PATH + "."+str(ctr)) 
-                    torch.save(model.module.state_dict(), CHECKPOINT_PATH+ "."+str(ctr)+".pure_model")
-
-            # Use a barrier() to make sure that process 1 loads the model after process
-            # 0 saves it.
-            dist.barrier()
-            # configure map_location properly
-            print("Loading from checkpoint")
-            map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
-            sys.stdout.flush()
-            checkpoint_dict = torch.load(CHECKPOINT_PATH, map_location=map_location)
-            model.load_state_dict(checkpoint_dict['model'])
-            optimizer.load_state_dict(checkpoint_dict['optimizer'])
-            scheduler.load_state_dict(checkpoint_dict['scheduler'])
+                    files_to_save.extend([(checkpoint_dict, CHECKPOINT_PATH + "."+str(ctr)), (model.module.state_dict(), CHECKPOINT_PATH+ "."+str(ctr)+".pure_model")])
+                checkpoint_saver.save(files_to_save) ## Only the copy to the CPU blocks training. There is no need to reload the checkpoint in the other processes because DDP keeps the model and optimizer states identical across processes.
             
+        if rank == 0: ## Computed on the batch while it is still on the CPU so that reading the counts does not wait for the GPU.
+            writer.add_scalar("padding efficiency", compute_padding_efficiency(input_masks, labels, tok.pad_token_id), ctr) ## The fraction of encoder and decoder tokens which are not padding.
         input_ids=input_ids.to(gpu) ## Move to gpu
         input_masks=input_masks.to(gpu) ## Move to gpu
         decoder_input_ids=decoder_input_ids.to(gpu) ## Move to gpu
@@ -435,8 +425,8 @@ def model_create_load_run_save(gpu, args, files, train_files):
     
     if rank == 0:
         checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-        torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save one last time.
-        torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model") ## We will distribute this model and/or use it for fine tuning.
+        checkpoint_saver.save([(checkpoint_dict, CHECKPOINT_PATH), (model.module.state_dict(), CHECKPOINT_PATH+".pure_model")]) ## Save one last time. We will distribute the pure model and/or use it for fine tuning.
+        checkpoint_saver.wait()
 
     dist.destroy_process_group()
 
@@ -480,6 +470,10 @@ def run_demo():
                         help='Comma separated string of source language file prefixes. Make sure that these are split into N groups where N is the number of GPUs you plan to use.')
     parser.add_argument('--positional_encodings', action='store_true', 
                         help='If true then we will use positional encodings instead of learned positional embeddings.')
+    parser.add_argument('--attention_implementation', default='eager', type=str, choices=['eager', 'sdpa', 'chunked'],
+                        help='The attention kernel. eager materializes the full attention weights. sdpa uses the fused scaled dot product attention of pytorch which needs much less memory for long sequences. chunked processes attention_chunk_size queries at a time and is used instead of sdpa if pytorch does not have it. Attention weights are only returned by eager attention so any visualization or analysis of attentions falls back to it.')
+    parser.add_argument('--attention_chunk_size', default=1024, type=int,
+                        help='The number of queries processed at a time by the chunked attention. Smaller values need less memory.')
     parser.add_argument('--no_embed_norm', action='store_true', 
                         help='If true then we wont normalize embeddings.')
     parser.add_argument('--scale_embedding', action='store_true', 
@@ -521,6 +515,10 @@ def run_demo():
                         help='Maximum number of tokens in batch')
     parser.add_argument('--batch_size_indicates_lines', action='store_true', 
                         help='Should we batch as a fixed number of lines?')
+    parser.add_argument('--length_bucketing', action='store_true', 
+                        help='Should we create batches of sentence pairs with similar lengths? A pool of sentence pairs is sampled, sorted by source and target length and cut into batches that fill the token budget, after which the batches are shuffled. This reduces padding considerably. Only applies to parallel corpora.')
+    parser.add_argument('--bucketing_pool_size', default=20000, type=int, 
+                        help='The number of sentence pairs sampled into the pool which is sorted and cut into batches when using length bucketing. Larger pools lead to less padding but take longer to tokenize. This should be much larger than the number of sentence pairs in a batch.')
     parser.add_argument('--label_smoothing', default=0.1, type=float, help="The value for label smoothing.")
     parser.add_argument('--lr', default=1e-3, type=float, help="The value for the learning rate")
     parser.add_argument('--weight_decay', default=0.00001, type=float, help="The value for weight decay")
@@ -539,6 +537,7 @@ def run_demo():
     parser.add_argument('--data_sampling_temperature', default=5.0, type=float, help="The value for data sampling temperature")
     parser.add_argument('--token_masking_lambda', default=3.5, type=float, help="The value for the poisson sampling lambda value")
     parser.add_argument('--token_masking_probs_range', nargs='+', type=float, default=[0.3], help="The range of probabilities with which the token will be masked. If you want a fixed probability then specify one argument else specify ONLY 2.")
+    parser.add_argument('--mask_individual_tokens', action='store_true', help="Should we replace each masked token with a mask token (token masking) instead of replacing poisson length spans with a single mask token (text infilling)? The masking ratio is the same in both cases.")
     parser.add_argument('--max_gradient_clip_value', default=1.0, type=float, help="The max value for gradient norm")
     parser.add_argument('--softmax_temperature', default=1.0, type=float, help="The value for the softmax temperature")
     parser.add_argument('--distillation_temperature', default=1.0, type=float, help="The value for the softmax temperature during distillation")
@@ -554,6 +553,14 @@ def run_demo():
                         help='What should be the parameter tying configuration? 1-1-1-1-1-1 means 6 layers where all are shared. 1-1-2-2-3-3 means 6 layers, 3 unique layers and each one is recurred twice before passing to another layer. 1-2-3-1-2-3 means 6 layers, 3 unique layers and recurrence is done twice after all layers have been passed through. The default None implies a 1-2-3-4-...-N setup')
     parser.add_argument('--shard_files', action='store_true', 
                         help='Should we shard the training data? Set to true only if the data is not already pre-sharded.')
+    parser.add_argument('--use_binarized_shards', action='store_true', 
+                        help='Should we create batches from shards that have been tokenized beforehand via binarize_corpora.py? This avoids calling the tokenizer during training. Stochastic tokenization (tokenization_sampling) will still use the tokenizer.')
+    parser.add_argument('--num_batch_workers', default=0, type=int, 
+                        help='The number of background processes per GPU which will generate batches. 0 means that batches are generated in the training process itself. Use more workers if the GPU is waiting for masking, tokenization and padding.')
+    parser.add_argument('--batch_prefetch_factor', default=2, type=int, 
+                        help='The number of ready batches each background worker is allowed to keep in its queue.')
+    parser.add_argument('--batch_generation_seed', default=621313, type=int, 
+                        help='The seed for the background batch workers. Each worker of each GPU gets a different seed derived from this one so the batches are the same for a given seed and number of workers.')
     parser.add_argument('--multilayer_softmaxing', action='store_true', 
                         help='Should we apply a softmax for each decoder layer? Unsupported for distillation. Only for vanilla training.')
     parser.add_argument('--remap_encoder', default='', type=str, 
@@ -117,7 +117,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         model.attention_dropout = args.attention_dropout ## We should set dropouts manually
         model.activation_dropout = args.activation_dropout ## We should set dropouts manually
     else:
-        config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings) ## Configuration. TODO: Save this configuration somehow.
+        config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, attention_implementation=args.attention_implementation, attention_chunk_size=args.attention_chunk_size) ## Configuration. TODO: Save this configuration somehow.
         model = MBartForConditionalGeneration(config)
     model.train()
     
@@ -132,7 +132,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
             parent_model.attention_dropout = args.attention_dropout ## We should set dropouts manually
             parent_model.activation_dropout = args.activation_dropout ## We should set dropouts manually
         else:
-            parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings)
+            parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, attention_implementation=args.attention_implementation, attention_chunk_size=args.attention_chunk_size)
             parent_model = MBartForConditionalGeneration(config)
         parent_model.cuda(gpu)
         parent_model.train() ## We do this to enable dropout but we wont have an optimizer for this so we wont train this model. For now. Future implementations should ask if we want to do co-distill or not. By co-distillation I mean, the parent will learn together with the child.
@@ -234,6 +234,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         print("Using a multistep optimizer where gradients will be accumulated over", args.multistep_optimizer_steps, "batches.")
     num_batches_this_optimizer_step = 0
     losses = 0
+    checkpoint_saver = AsyncCheckpointSaver() ## Checkpoints are written to disk in the background while training continues.
     global_sbleu_history = [] ## To save the global evaluation metric history.
     max_global_sbleu = 0 ## Maximum global evaluation metric score.
     max_global_sbleu_step = 0 ## Step at which we achieved the maximum global evaluation metric score.
@@ -248,11 +249,12 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         scores = {dev_pair: 0 for dev_pair in dev_files} ## The rouge scorer works at the sentence level so we have to add all individual scores per sentence and this dictionary keeps track of the score. This dictionary may not be needed.
     else:
         refs = {dev_pair: [[refline.strip() for refline in open(dev_files[dev_pair][1])][:args.max_eval_batches*args.dev_batch_size]] for dev_pair in dev_files} ## Get all references for each input. Select up to args.max_eval_batches*args.dev_batch_size examples.
-    for input_ids, input_masks, decoder_input_ids, labels in generate_batches_bilingual(tok, args, train_files, rank): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked.
+    for input_ids, input_masks, decoder_input_ids, labels in generate_batches_in_background(functools.partial(generate_batches_bilingual, tok, args, train_files, rank), args, rank): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked.
         start = time.time()
         if ctr % args.eval_every == 0 and num_batches_this_optimizer_step == 0: ## We have to evaluate our model every eval_every steps.
             CHECKPOINT_PATH = args.model_path
             if rank == 0: ## Evaluation will be done only on the prime/master process which is at rank 0. Other processes will sleep.
+                files_to_save = [] ## All files are saved together after evaluation.
                 if not args.no_eval: ## If we dont care about early stopping and only on training for a bazillion batches then you can save time by skipping evaluation.
                     print("Running eval on dev set(s)")
                     if args.mixed_wait_k:
@@ -312,8 +314,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                             max_individual_sbleu[dev_pair] = sbleu
                             max_individual_sbleu_step[dev_pair] = curr_eval_step
                             print("New peak reached for", dev_pair,". Saving.")
-                            torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr))
-                            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr)+".pure_model") ## Pure model without any ddp markers or optimizer info.
+                            files_to_save.extend([(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr)), (model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr)+".pure_model")]) ## Pure model without any ddp markers or optimizer info.
 
                     ## Global stats
                     sbleu = sum(sbleus.values())/len(sbleus) ## The global score.
@@ -324,8 +325,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                         max_global_sbleu = sbleu
                         max_global_sbleu_step = curr_eval_step
                         print("New peak reached. Saving.")
-                        torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr))
-                        torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr)+".pure_model") ## Pure model without any ddp markers or optimizer info.
+                        files_to_save.extend([(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr)), (model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr)+".pure_model")]) ## Pure model without any ddp markers or optimizer info.
                     if curr_eval_step - max_global_sbleu_step > (args.early_stop_checkpoints + annealing_attempt*args.additional_early_stop_checkpoints_per_anneal_step): ## If the global scores have not improved for more than early_stop_checkpoints + some additional checkpoints to wait for till annealing is done then we stop training.
                         if annealing_attempt < args.max_annealing_attempts: ## We will only downscale the LR a fixed number of times. Each time we downscale the number of checkpoints to wait for declaring convergence will increase by a fixed value.
                             annealing_attempt += 1
@@ -349,31 +349,26 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                     if ctr % args.no_eval_save_every == 0:
                         print("No evaluation based early stopping so saving every", args.no_eval_save_every, "checkpoints.")
                         checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-                        torch.save(checkpoint_dict, CHECKPOINT_PATH+"."+str(ctr))
-                        torch.save(model.state_dict(), CHECKPOINT_PATH+"."+str(ctr)+".pure_model")
+                        files_to_save.extend([(checkpoint_dict, CHECKPOINT_PATH+"."+str(ctr)), (model.state_dict(), CHECKPOINT_PATH+"."+str(ctr)+".pure_model")])
                 print("Saving the model")
                 sys.stdout.flush()
                 # All processes should see same parameters as they all start from same
                 # random parameters and gradients are synchronized in backward passes.
                 # Therefore, saving it in one process is sufficient.
                 checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-                torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
-                torch.save(model.state_dict(), CHECKPOINT_PATH+".pure_model")
+                files_to_save.extend([(checkpoint_dict, CHECKPOINT_PATH), (model.state_dict(), CHECKPOINT_PATH+".pure_model")]) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
+                checkpoint_saver.save(files_to_save) ## Only the copy to the CPU blocks training.
                 
 
-            # Use a barrier() to make sure that process 1 loads the model after process
-            # 0 saves it.
+            # Use a barrier() to make sure that the other processes wait for the evaluation on process 0.
             dist.barrier()
             if quit_condition[0].cpu().numpy() == -1: ## All processes will see the same value which is always updated by rank 0 processes.
                 break ## Everyone quits.
-            # configure map_location properly
-            print("Loading from checkpoint")
-            sys.stdout.flush()
-            map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
-            checkpoint_dict = torch.load(CHECKPOINT_PATH, map_location=map_location)
-            model.load_state_dict(checkpoint_dict['model'])
-            optimizer.load_state_dict(checkpoint_dict['optimizer'])
-            scheduler.load_state_dict(checkpoint_dict['scheduler'])
+            ## There is no need to reload the checkpoint because DDP keeps the model and optimizer states identical across processes. The only exception is the learning rate which may have been annealed on process 0 so the other processes advance their schedulers to the same step.
+            scheduler_step = torch.tensor([scheduler.last_epoch]).to(gpu)
+            dist.broadcast(scheduler_step, 0)
+            while scheduler.last_epoch < scheduler_step.item():
+                scheduler.step()
         
         dist.barrier()
         if args.cross_distillation or args.multi_source: ## The returned input ids and input masks are actually a list of two items each. The first item is to be fed to the parent model and the second item is to be fed to the child model.
@@ -384,6 +379,8 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
             input_masks=input_masks[0]
             input_masks_parent = input_masks_parent.to(gpu) ## Move to gpu
         
+        if rank == 0: ## Computed on the batch while it is still on the CPU so that reading the counts does not wait for the GPU.
+            writer.add_scalar("padding efficiency", compute_padding_efficiency(input_masks, labels, tok.pad_token_id), ctr) ## The fraction of encoder and decoder tokens which are not padding.
         input_ids=input_ids.to(gpu) ## Move to gpu
         input_masks=input_masks.to(gpu) ## Move to gpu
         decoder_input_ids=decoder_input_ids.to(gpu) ## Move to gpu
@@ -560,8 +557,8 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         print("The best bleu was:", max_global_sbleu)
         print("The corresponding step was:", max_global_sbleu_step*args.eval_every)
         checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-        torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save one last time.
-        torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model") ## Pure model without any ddp markers or optimizer info.
+        checkpoint_saver.save([(checkpoint_dict, CHECKPOINT_PATH), (model.module.state_dict(), CHECKPOINT_PATH+".pure_model")]) ## Save one last time. The pure model has no ddp markers or optimizer info.
+        checkpoint_saver.wait()
     dist.barrier() ## Wait till all processes reach this point so that the prime process saves the final checkpoint.
     dist.destroy_process_group() ## Everything that has a beginning has an end, Neo!
     
@@ -584,6 +581,10 @@ def run_demo():
                         help='Should we freeze encoder during fine tuning?')
     parser.add_argument('--positional_encodings', action='store_true', 
                         help='If true then we will use positional encodings instead of learned positional embeddings.')
+    parser.add_argument('--attention_implementation', default='eager', type=str, choices=['eager', 'sdpa', 'chunked'],
+                        help='The attention kernel. eager materializes the full attention weights. sdpa uses the fused scaled dot product attention of pytorch which needs much less memory for long sequences. chunked processes attention_chunk_size queries at a time and is used instead of sdpa if pytorch does not have it. Attention weights are only returned by eager attention so any visualization or analysis of attentions falls back to it.')
+    parser.add_argument('--attention_chunk_size', default=1024, type=int,
+                        help='The number of queries processed at a time by the chunked attention. Smaller values need less memory.')
     parser.add_argument('--no_embed_norm', action='store_true', 
                         help='If true then we wont normalize embeddings.')
     parser.add_argument('--scale_embedding', action='store_true', 
@@ -605,6 +606,7 @@ def run_demo():
     parser.add_argument('--data_sampling_temperature', default=5.0, type=float, help="The value for the data sampling temperature")
     parser.add_argument('--token_masking_lambda', default=3.5, type=float, help="The value for the poisson sampling lambda value")
     parser.add_argument('--token_masking_probs_range', nargs='+', type=float, default=[0.3], help="The range of probabilities with which the token will be masked. If you want a fixed probability then specify one argument else specify ONLY 2.")
+    parser.add_argument('--mask_individual_tokens', action='store_true', help="Should we replace each masked token with a mask token (token masking) instead of replacing poisson length spans with a single mask token (text infilling)? The masking ratio is the same in both cases.")
     parser.add_argument('--repetition_penalty', default=1.0, type=float, 
                         help='To prevent repetition during decoding. 1.0 means no repetition. 1.2 was supposed to be a good value for some settings according to some researchers.')
     parser.add_argument('--no_repeat_ngram_size', default=0, type=int, 
@@ -653,6 +655,10 @@ def run_demo():
                         help='Train batch sizes in tokens')
     parser.add_argument('--batch_size_indicates_lines', action='store_true', 
                         help='Should we batch as a fixed number of lines?')
+    parser.add_argument('--length_bucketing', action='store_true', 
+                        help='Should we create batches of sentence pairs with similar lengths? A pool of sentence pairs is sampled, sorted by source and target length and cut into batches that fill the token budget, after which the batches are shuffled. This reduces padding considerably. Only applies to parallel corpora.')
+    parser.add_argument('--bucketing_pool_size', default=20000, type=int, 
+                        help='The number of sentence pairs sampled into the pool which is sorted and cut into batches when using length bucketing. Larger pools lead to less padding but take longer to tokenize. This should be much larger than the number of sentence pairs in a batch.')
     parser.add_argument('--dev_batch_size', default=1024, type=int, 
                         help='Dev batch sizes in lines')
     parser.add_argument('--max_src_length', default=256, type=int, 
@@ -719,6 +725,14 @@ def run_demo():
                         help='Should we maximize softmax entropy? If the value is anything between 0 and 1 then yes. If its -1.0 then no maximization will be done.')
     parser.add_argument('--shard_files', action='store_true', 
                         help='Should we shard the training data? Set to true only if the data is not already pre-sharded.')
+    parser.add_argument('--use_binarized_shards', action='store_true', 
+                        help='Should we create batches from shards that have been tokenized beforehand via binarize_corpora.py? This avoids calling the tokenizer during training. Stochastic tokenization (tokenization_sampling) will still use the tokenizer.')
+    parser.add_argument('--num_batch_workers', default=0, type=int, 
+                        help='The number of background processes per GPU which will generate batches. 0 means that batches are generated in the training process itself. Use more workers if the GPU is waiting for masking, tokenization and padding.')
+    parser.add_argument('--batch_prefetch_factor', default=2, type=int, 
+                        help='The number of ready batches each background worker is allowed to keep in its queue.')
+    parser.add_argument('--batch_generation_seed', default=621313, type=int, 
+                        help='The seed for the background batch workers. Each worker of each GPU gets a different seed derived from this one so the batches are the same for a given seed and number of workers.')
     parser.add_argument('--multi_source', action='store_true', 
                         help='Are we doing multisource NMT? In that case you should specify the train_src as a hyphen separated pair indicating the parent language and the child language. You should also ensure that the source file is a tab separated file where each line contains "the parent pair source sentence[tab]child pair source sentence".')
     parser.add_argument('--multilayer_softmaxing', action='store_true', 
@@ -348,7 +348,7 @@ if is_torch_available():
         "TextDataset",
         "TextDatasetForNextSentencePrediction",
     ]
-    _import_structure["generation_beam_search"] = ["BeamScorer", "BeamSearchScorer"]
+    _import_structure["generation_beam_search"] = ["BeamScorer", "BeamSearchScorer", "TensorBeamSearchScorer"]
     _import_structure["generation_logits_process"] = [
         "HammingDiversityLogitsProcessor",
         "LogitsProcessor",
@@ -359,6 +359,7 @@ if is_torch_available():
         "NoRepeatNGramLogitsProcessor",
         "PrefixConstrainedLogitsProcessor",
         "RepetitionPenaltyLogitsProcessor",
+        "SentenceLengthLogitsProcessor",
         "TemperatureLogitsWarper",
         "TopKLogitsWarper",
         "TopPLogitsWarper",
@@ -1471,7 +1472,7 @@ if TYPE_CHECKING:
             TextDataset,
             TextDatasetForNextSentencePrediction,
         )
-        from .generation_beam_search import BeamScorer, BeamSearchScorer
+        from .generation_beam_search import BeamScorer, BeamSearchScorer, TensorBeamSearchScorer
         from .generation_logits_process import (
             HammingDiversityLogitsProcessor,
             LogitsProcessor,
@@ -1482,6 +1483,7 @@ if TYPE_CHECKING:
             NoRepeatNGramLogitsProcessor,
             PrefixConstrainedLogitsProcessor,
             RepetitionPenaltyLogitsProcessor,
+            SentenceLengthLogitsProcessor,
             TemperatureLogitsWarper,
             TopKLogitsWarper,
             TopPLogitsWarper,
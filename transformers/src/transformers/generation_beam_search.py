@@ -160,6 +160,7 @@ class BeamSearchScorer(BeamScorer):
         num_beam_hyps_to_keep: Optional[int] = 1,
         num_beam_groups: Optional[int] = 1,
     ):
+        self.batch_size = batch_size
         self.max_length = max_length
         self.num_beams = num_beams
         self.device = device
@@ -336,6 +337,244 @@ class BeamSearchScorer(BeamScorer):
         )
 
 
+class TensorBeamSearchScorer(BeamScorer):
+    r"""
+    :class:`transformers.BeamScorer` implementing standard beam search decoding like
+    :class:`~transformers.BeamSearchScorer` but with tensor operations over the whole batch instead of Python loops
+    over the sentences and their beam candidates. The finished hypotheses of all sentences are kept in preallocated
+    tensors along with their length penalized scores, which are computed for the whole batch at once. The sequences and
+    scores it returns are identical to those of :class:`~transformers.BeamSearchScorer`, including the order in which
+    hypotheses with equal scores are kept and returned.
+
+    Args:
+        batch_size (:obj:`int`):
+            Batch Size of :obj:`input_ids` for which standard beam search decoding is run in parallel.
+        max_length (:obj:`int`):
+            The maximum length of the sequence to be generated.
+        num_beams (:obj:`int`):
+            Number of beams for beam search.
+        device (:obj:`torch.device`):
+            Defines the device type (*e.g.*, :obj:`"cpu"` or :obj:`"cuda"`) on which this instance of
+            :obj:`TensorBeamSearchScorer` will be allocated.
+        length_penalty (:obj:`float`, `optional`, defaults to 1.0):
+            Exponential penalty to the length. 1.0 means no penalty. Set to values < 1.0 in order to encourage the
+            model to generate shorter sequences, to a value > 1.0 in order to encourage the model to produce longer
+            sequences.
+        do_early_stopping (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to stop the beam search when at least ``num_beams`` sentences are finished per batch or not.
+        num_beam_hyps_to_keep (:obj:`int`, `optional`, defaults to 1):
+            The number of beam hypotheses that shall be returned upon calling
+            :meth:`~transformer.TensorBeamSearchScorer.finalize`.
+        num_beam_groups (:obj:`int`):
+            Number of groups to divide :obj:`num_beams` into in order to ensure diversity among different groups of
+            beams. See `this paper <https://arxiv.org/pdf/1610.02424.pdf>`__ for more details.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        max_length: int,
+        num_beams: int,
+        device: torch.device,
+        length_penalty: Optional[float] = 1.0,
+        do_early_stopping: Optional[bool] = False,
+        num_beam_hyps_to_keep: Optional[int] = 1,
+        num_beam_groups: Optional[int] = 1,
+    ):
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.num_beams = num_beams
+        self.device = device
+        self.length_penalty = length_penalty
+        self.do_early_stopping = do_early_stopping
+        self.num_beam_hyps_to_keep = num_beam_hyps_to_keep
+        self.num_beam_groups = num_beam_groups
+        self.group_size = self.num_beams // self.num_beam_groups
+
+        if not isinstance(num_beams, int) or num_beams <= 1:
+            raise ValueError(
+                f"`num_beams` has to be an integer strictly greater than 1, but is {num_beams}. For `num_beams` == 1, one should make use of `greedy_search` instead."
+            )
+
+        if not isinstance(num_beam_groups, int) or (num_beam_groups > num_beams) or (num_beams % num_beam_groups != 0):
+            raise ValueError(
+                f"`num_beam_groups` has to be an integer smaller or equal than `num_beams` and `num_beams` "
+                f"has to be divisible by `num_beam_groups`, but is {num_beam_groups} with `num_beams` being {num_beams}."
+            )
+
+        # the `num_beams` best finished hypotheses of each sentence. The scores are kept in double precision since
+        # `BeamHypotheses` computes and compares them as Python floats.
+        self._hyp_tokens = torch.zeros((batch_size, num_beams, max_length), dtype=torch.long, device=self.device)
+        self._hyp_lengths = torch.zeros((batch_size, num_beams), dtype=torch.long, device=self.device)
+        self._hyp_scores = torch.full((batch_size, num_beams), -float("inf"), dtype=torch.float64, device=self.device)
+        # when each hypothesis was added. Of two hypotheses with equal scores the earlier one is dropped first and
+        # returned last.
+        self._hyp_order = torch.full((batch_size, num_beams), -1, dtype=torch.long, device=self.device)
+        self._num_hyps = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+        self._num_added = 0
+        self._done = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+
+    @property
+    def is_done(self) -> bool:
+        return self._done.all()
+
+    def _worst_scores(self) -> torch.FloatTensor:
+        # the empty slots of sentences with fewer than `num_beams` hypotheses have a score of -inf
+        return self._hyp_scores.min(dim=-1).values
+
+    def _add_hypotheses(self, batch_mask: torch.BoolTensor, hyps: torch.LongTensor, sum_logprobs: torch.FloatTensor):
+        """
+        Adds the hypothesis :obj:`hyps[i]` with the sum of log probabilities :obj:`sum_logprobs[i]` to the finished
+        hypotheses of each sentence :obj:`i` for which :obj:`batch_mask[i]` is True, just like
+        :meth:`~transformers.generation_beam_search.BeamHypotheses.add` does for one sentence.
+        """
+        cur_len = hyps.shape[-1]
+        if cur_len > self._hyp_tokens.shape[-1]:
+            self._hyp_tokens = torch.cat(
+                [self._hyp_tokens, self._hyp_tokens.new_zeros(self.batch_size, self.num_beams, cur_len - self._hyp_tokens.shape[-1])],
+                dim=-1,
+            )
+        scores = sum_logprobs.to(device=self.device, dtype=torch.float64) / (cur_len ** self.length_penalty)
+        is_full = self._num_hyps == self.num_beams
+        worst_scores = self._worst_scores()
+        # a full list replaces its worst hypothesis, the earliest added one among equally bad ones
+        worst_slots = torch.where(
+            self._hyp_scores == worst_scores[:, None], self._hyp_order, torch.full_like(self._hyp_order, self._num_added)
+        ).argmin(dim=-1)
+        is_added = batch_mask.to(self.device) & (~is_full | (scores > worst_scores))
+        batch_idx = is_added.nonzero(as_tuple=True)[0]
+        if batch_idx.shape[0] > 0:
+            slot_idx = torch.where(is_full, worst_slots, self._num_hyps)[batch_idx]
+            self._hyp_tokens[batch_idx, slot_idx, :cur_len] = hyps.to(self.device)[batch_idx]
+            self._hyp_lengths[batch_idx, slot_idx] = cur_len
+            self._hyp_scores[batch_idx, slot_idx] = scores[batch_idx]
+            self._hyp_order[batch_idx, slot_idx] = self._num_added
+            self._num_hyps += (is_added & ~is_full).long()
+        self._num_added += 1
+
+    def process(
+        self,
+        input_ids: torch.LongTensor,
+        next_scores: torch.FloatTensor,
+        next_tokens: torch.LongTensor,
+        next_indices: torch.LongTensor,
+        pad_token_id: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+    ) -> Tuple[torch.Tensor]:
+        cur_len = input_ids.shape[-1]
+        batch_size = self.batch_size
+        assert batch_size == (input_ids.shape[0] // self.group_size)
+
+        device = input_ids.device
+        is_open = ~self._done.to(device)
+        if not is_open.all():
+            assert (
+                eos_token_id is not None and pad_token_id is not None
+            ), "generated beams >= num_beams -> eos_token_id and pad_token have to be defined"
+
+        if eos_token_id is not None:
+            is_eos = next_tokens == eos_token_id
+        else:
+            is_eos = torch.zeros_like(next_tokens, dtype=torch.bool)
+        batch_beam_idx = torch.arange(batch_size, device=device)[:, None] * self.group_size + next_indices
+
+        # only eos tokens among the top `group_size` candidates finish a hypothesis. They are added in the order of the
+        # candidates like `BeamSearchScorer` does, one candidate rank at a time for all sentences.
+        is_finished = is_eos[:, : self.group_size] & is_open[:, None]
+        for beam_token_rank in is_finished.any(dim=0).nonzero(as_tuple=True)[0].tolist():
+            self._add_hypotheses(
+                is_finished[:, beam_token_rank],
+                input_ids[batch_beam_idx[:, beam_token_rank]],
+                next_scores[:, beam_token_rank],
+            )
+
+        # the first `group_size` candidates which are not eos tokens continue the beams
+        beam_positions = (~is_eos).long().cumsum(dim=-1) - 1
+        is_next_beam = ~is_eos & (beam_positions < self.group_size)
+        is_short = is_open & (is_next_beam.sum(dim=-1) < self.group_size)
+        if is_short.any():
+            batch_idx = is_short.nonzero(as_tuple=True)[0][0]
+            raise ValueError(
+                f"At most {self.group_size} tokens in {next_tokens[batch_idx]} can be equal to `eos_token_id: {eos_token_id}`. Make sure {next_tokens[batch_idx]} are corrected."
+            )
+        # the other candidates are scattered to an extra column which is dropped
+        beam_positions = torch.where(is_next_beam, beam_positions, torch.full_like(beam_positions, self.group_size))
+
+        def select_next_beams(candidates, done_value):
+            next_beams = candidates.new_zeros((batch_size, self.group_size + 1))
+            next_beams.scatter_(1, beam_positions, candidates)
+            # finished sentences are padded
+            return next_beams[:, : self.group_size].masked_fill(~is_open[:, None], done_value)
+
+        next_beam_scores = select_next_beams(next_scores, 0)
+        next_beam_tokens = select_next_beams(next_tokens, pad_token_id if pad_token_id is not None else 0)
+        next_beam_indices = select_next_beams(batch_beam_idx.to(next_indices.dtype), 0)
+
+        # check if we are done so that we can save a pad step if all(done)
+        best_scores = next_scores.max(dim=-1).values.to(device=self.device, dtype=torch.float64)
+        is_done = self._num_hyps >= self.num_beams
+        if not self.do_early_stopping:
+            is_done = is_done & (self._worst_scores() >= best_scores / (cur_len ** self.length_penalty))
+        self._done = self._done | is_done
+
+        return UserDict(
+            {
+                "next_beam_scores": next_beam_scores.view(-1),
+                "next_beam_tokens": next_beam_tokens.view(-1),
+                "next_beam_indices": next_beam_indices.view(-1),
+            }
+        )
+
+    def finalize(
+        self,
+        input_ids: torch.LongTensor,
+        final_beam_scores: torch.FloatTensor,
+        final_beam_tokens: torch.LongTensor,
+        final_beam_indices: torch.LongTensor,
+        pad_token_id: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+    ) -> Tuple[torch.LongTensor]:
+        batch_size = self.batch_size
+
+        # finalize all open beam hypotheses and add to generated hypotheses
+        is_open = ~self._done
+        for beam_id in range(self.num_beams):
+            batch_beam_idx = torch.arange(batch_size, device=input_ids.device) * self.num_beams + beam_id
+            self._add_hypotheses(is_open, input_ids[batch_beam_idx], final_beam_scores[batch_beam_idx])
+
+        # rank the hypotheses of each sentence: a hypothesis ranks below those with higher scores and those with equal
+        # scores which were added later
+        scores, order = self._hyp_scores, self._hyp_order
+        num_better = (
+            (scores[:, None, :] > scores[:, :, None])
+            | ((scores[:, None, :] == scores[:, :, None]) & (order[:, None, :] > order[:, :, None]))
+        ).sum(dim=-1)
+        best_slots = num_better.argsort(dim=-1)[:, : self.num_beam_hyps_to_keep].reshape(-1)
+        batch_idx = torch.arange(batch_size, device=self.device).repeat_interleave(self.num_beam_hyps_to_keep)
+
+        best_scores = scores[batch_idx, best_slots].to(torch.float32)
+        sent_lengths = self._hyp_lengths[batch_idx, best_slots]
+
+        # prepare for adding eos
+        sent_max_len = min(sent_lengths.max().item() + 1, self.max_length)
+        decoded = self._hyp_tokens[batch_idx, best_slots, :sent_max_len]
+        positions = torch.arange(sent_max_len, device=self.device)[None, :]
+        # shorter batches are padded if needed
+        if sent_lengths.min().item() != sent_lengths.max().item():
+            assert pad_token_id is not None, "`pad_token_id` has to be defined"
+            decoded = decoded.masked_fill(positions > sent_lengths[:, None], pad_token_id)
+
+        # add eos_token_id after the hypotheses which are shorter than max_length
+        if eos_token_id is not None:
+            decoded = decoded.masked_fill(positions == sent_lengths[:, None], eos_token_id)
+        return UserDict(
+            {
+                "sequences": decoded.to(input_ids.device),
+                "sequence_scores": best_scores,
+            }
+        )
+
+
 class BeamHypotheses:
     def __init__(self, num_beams: int, max_length: int, length_penalty: float, early_stopping: bool):
         """
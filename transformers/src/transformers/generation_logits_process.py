@@ -16,7 +16,7 @@
 import inspect
 import math
 from abc import ABC
-from typing import Callable, Iterable, List
+from typing import Callable, Iterable, List, Optional
 
 import numpy as np
 import torch
@@ -89,6 +89,16 @@ class LogitsProcessorList(list):
                 scores = processor(input_ids, scores)
         return scores
 
+    def reorder_state(self, beam_idx: torch.LongTensor):
+        """
+        Lets the processors which keep a state across generation steps (such as
+        :class:`~transformers.NoRepeatNGramLogitsProcessor`) reorder it after beam search has reordered the hypotheses
+        with :obj:`beam_idx`.
+        """
+        for processor in self:
+            if hasattr(processor, "reorder_state"):
+                processor.reorder_state(beam_idx)
+
 
 class MinLengthLogitsProcessor(LogitsProcessor):
     r"""
@@ -118,6 +128,46 @@ class MinLengthLogitsProcessor(LogitsProcessor):
         return scores
 
 
+class SentenceLengthLogitsProcessor(LogitsProcessor):
+    r"""
+    :class:`transformers.LogitsProcessor` enforcing a min-length and a max-length for each sentence of the batch. The
+    score of :obj:`eos_token_id` is set to :obj:`-float("Inf")` below the min-length of a sentence and all other
+    scores are set to :obj:`-float("Inf")` at the last position allowed by its max-length, so that the sequence of each
+    sentence ends with :obj:`eos_token_id` by then. The rows of the scores of the beams or returned sequences of a
+    sentence follow each other.
+
+    Args:
+        min_lengths (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
+            The minimum length of the sequence of each sentence.
+        max_lengths (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
+            The maximum length of the sequence (including :obj:`eos_token_id`) of each sentence.
+        eos_token_id (:obj:`int`):
+            The id of the `end-of-sequence` token.
+    """
+
+    def __init__(self, min_lengths: Optional[torch.LongTensor], max_lengths: Optional[torch.LongTensor], eos_token_id: int):
+        if not isinstance(eos_token_id, int) or eos_token_id < 0:
+            raise ValueError(f"`eos_token_id` has to be a positive integer, but is {eos_token_id}")
+
+        self.min_lengths = min_lengths
+        self.max_lengths = max_lengths
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        cur_len = input_ids.shape[-1]
+        eos_scores = scores[:, self.eos_token_id].clone()
+        if self.min_lengths is not None:
+            below_min_length = (self.min_lengths > cur_len).to(scores.device)
+            below_min_length = below_min_length.repeat_interleave(scores.shape[0] // below_min_length.shape[0])
+            scores[:, self.eos_token_id] = scores[:, self.eos_token_id].masked_fill(below_min_length, -float("inf"))
+        if self.max_lengths is not None:
+            at_max_length = (self.max_lengths <= cur_len + 1).to(scores.device)
+            at_max_length = at_max_length.repeat_interleave(scores.shape[0] // at_max_length.shape[0])
+            scores.masked_fill_(at_max_length[:, None], -float("inf"))
+            scores[:, self.eos_token_id] = torch.where(at_max_length, eos_scores, scores[:, self.eos_token_id]) ## Ending the sequence takes precedence over its min-length.
+        return scores
+
+
 class TemperatureLogitsWarper(LogitsWarper):
     r"""
     :class:`transformers.LogitsWarper` for temperature (exponential scaling output probability distribution).
@@ -235,39 +285,49 @@ class TopKLogitsWarper(LogitsWarper):
         return scores
 
 
-def _get_ngrams(ngram_size: int, prev_input_ids: torch.Tensor, num_hypos: int):
-    generated_ngrams = [{} for _ in range(num_hypos)]
-    for idx in range(num_hypos):
-        gen_tokens = prev_input_ids[idx].tolist()
-        generated_ngram = generated_ngrams[idx]
-        for ngram in zip(*[gen_tokens[i:] for i in range(ngram_size)]):
-            prev_ngram_tuple = tuple(ngram[:-1])
-            generated_ngram[prev_ngram_tuple] = generated_ngram.get(prev_ngram_tuple, []) + [ngram[-1]]
-    return generated_ngrams
-
-
-def _get_generated_ngrams(banned_ngrams, prev_input_ids, ngram_size, cur_len):
-    # Before decoding the next token, prevent decoding of ngrams that have already appeared
-    start_idx = cur_len + 1 - ngram_size
-    ngram_idx = tuple(prev_input_ids[start_idx:cur_len].tolist())
-    return banned_ngrams.get(ngram_idx, [])
-
-
-def _calc_banned_ngram_tokens(
-    ngram_size: int, prev_input_ids: torch.Tensor, num_hypos: int, cur_len: int
-) -> List[Iterable[int]]:
-    """Copied from fairseq for no_repeat_ngram in beam_search"""
-    if cur_len + 1 < ngram_size:
-        # return no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-        return [[] for _ in range(num_hypos)]
-
-    generated_ngrams = _get_ngrams(ngram_size, prev_input_ids, num_hypos)
-
-    banned_tokens = [
-        _get_generated_ngrams(generated_ngrams[hypo_idx], prev_input_ids[hypo_idx], ngram_size, cur_len)
-        for hypo_idx in range(num_hypos)
-    ]
-    return banned_tokens
+def _ngram_prefix_keys(windows: torch.LongTensor, base: int) -> torch.LongTensor:
+    """
+    Maps the n-gram prefixes :obj:`windows` of shape :obj:`(..., ngram_size - 1)` to keys of shape :obj:`(..., 1)` by
+    reading their tokens as the digits of a number in base :obj:`base`. The keys are exact (two prefixes share a key
+    only if they are equal) as long as all tokens are smaller than :obj:`base` and :obj:`base ** (ngram_size - 1)` fits
+    in 63 bits. Otherwise the prefixes themselves are used as keys.
+    """
+    prefix_length = windows.shape[-1]
+    if base ** prefix_length >= 2 ** 63:
+        return windows
+    multipliers = base ** torch.arange(prefix_length - 1, -1, -1, dtype=torch.long, device=windows.device)
+    return (windows * multipliers).sum(-1, keepdim=True)
+
+
+def _get_ngram_windows(ngram_size: int, input_ids: torch.LongTensor) -> torch.LongTensor:
+    """Returns all the n-grams of each row of :obj:`input_ids` as a tensor of shape :obj:`(num_rows, num_ngrams, ngram_size)`."""
+    if input_ids.shape[-1] < ngram_size:
+        return input_ids.new_zeros(input_ids.shape[0], 0, ngram_size)
+    return input_ids.unfold(1, ngram_size, 1)
+
+
+def _ban_ngram_continuations(
+    scores: torch.FloatTensor,
+    query_keys: torch.LongTensor,
+    prefix_keys: torch.LongTensor,
+    next_tokens: torch.LongTensor,
+    query_mask: torch.BoolTensor = None,
+) -> torch.FloatTensor:
+    """
+    Sets the scores of the last tokens of the n-grams whose prefix key equals the key of the last :obj:`ngram_size - 1`
+    tokens of each hypothesis to :obj:`-float("inf")`. :obj:`query_keys` has shape :obj:`(num_hypos, key_size)`,
+    :obj:`prefix_keys` :obj:`(num_hypos, num_ngrams, key_size)` and :obj:`next_tokens` :obj:`(num_hypos, num_ngrams)`.
+    Hypotheses whose :obj:`query_mask` is False get no banned tokens.
+    """
+    vocab_size = scores.shape[-1]
+    matches = (prefix_keys == query_keys.unsqueeze(1)).all(-1) & (next_tokens < vocab_size)
+    if query_mask is not None:
+        matches = matches & query_mask.unsqueeze(1)
+    # adding -inf to the banned tokens and 0 to the rest bans all tokens with a single scatter, even if several
+    # n-grams share their last token
+    banned_tokens = torch.where(matches, next_tokens, torch.zeros_like(next_tokens))
+    penalties = torch.zeros(matches.shape, dtype=scores.dtype, device=scores.device).masked_fill_(matches, -float("inf"))
+    return scores.scatter_add_(1, banned_tokens, penalties)
 
 
 class NoRepeatNGramLogitsProcessor(LogitsProcessor):
@@ -275,6 +335,11 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
     :class:`transformers.LogitsProcessor` that enforces no repetition of n-grams. See `Fairseq
     <https://github.com/pytorch/fairseq/blob/a07cb6f40480928c9e0548b737aadd36ee66ac76/fairseq/sequence_generator.py#L345>`__.
 
+    The keys of the prefixes of all n-grams generated so far are kept as tensors across steps. At each step only the
+    n-gram ending with the newest token is added, after the state has been reordered along with the beams (see
+    :meth:`reorder_state`), and the banned tokens of all hypotheses are set with a single scatter. If the
+    :obj:`input_ids` are not the previous ones extended by one token the state is rebuilt from scratch.
+
     Args:
         ngram_size (:obj:`int`):
             All ngrams of size :obj:`ngram_size` can only occur once.
@@ -284,16 +349,48 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
         if not isinstance(ngram_size, int) or ngram_size <= 0:
             raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
         self.ngram_size = ngram_size
+        self._input_ids = None  # the input ids of the previous step
+        self._prefix_keys = None  # (num_hypos, num_ngrams, key_size) keys of the prefixes of all n-grams so far
+        self._next_tokens = None  # (num_hypos, num_ngrams) last tokens of all n-grams so far
+        self._base = None
+
+    def reorder_state(self, beam_idx: torch.LongTensor):
+        """Reorders the n-grams of the previous step like the hypotheses were reordered by beam search."""
+        if self._input_ids is not None and beam_idx.shape[0] == self._input_ids.shape[0]:
+            self._input_ids = self._input_ids[beam_idx]
+            self._prefix_keys = self._prefix_keys[beam_idx]
+            self._next_tokens = self._next_tokens[beam_idx]
+
+    def _update_state(self, input_ids: torch.LongTensor, vocab_size: int):
+        is_next_step = (
+            self._input_ids is not None
+            and input_ids.shape[0] == self._input_ids.shape[0]
+            and input_ids.shape[-1] == self._input_ids.shape[-1] + 1
+            and int(input_ids[:, -1].max()) < self._base
+            and torch.equal(input_ids[:, :-1], self._input_ids)
+        )
+        if is_next_step:
+            if input_ids.shape[-1] >= self.ngram_size:
+                new_ngrams = input_ids[:, -self.ngram_size :].unsqueeze(1)
+                self._prefix_keys = torch.cat(
+                    [self._prefix_keys, _ngram_prefix_keys(new_ngrams[..., :-1], self._base)], dim=1
+                )
+                self._next_tokens = torch.cat([self._next_tokens, new_ngrams[..., -1]], dim=1)
+        else:
+            self._base = max(vocab_size, int(input_ids.max()) + 1 if input_ids.numel() > 0 else 0)
+            ngrams = _get_ngram_windows(self.ngram_size, input_ids)
+            self._prefix_keys = _ngram_prefix_keys(ngrams[..., :-1], self._base)
+            self._next_tokens = ngrams[..., -1]
+        self._input_ids = input_ids
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        num_batch_hypotheses = scores.shape[0]
+        self._update_state(input_ids, scores.shape[-1])
         cur_len = input_ids.shape[-1]
-        banned_batch_tokens = _calc_banned_ngram_tokens(self.ngram_size, input_ids, num_batch_hypotheses, cur_len)
-
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores[i, banned_tokens] = -float("inf")
-
-        return scores
+        if cur_len + 1 < self.ngram_size:
+            # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
+            return scores
+        query_keys = _ngram_prefix_keys(input_ids[:, cur_len + 1 - self.ngram_size :], self._base)
+        return _ban_ngram_continuations(scores, query_keys, self._prefix_keys, self._next_tokens)
 
 
 class EncoderNoRepeatNGramLogitsProcessor(LogitsProcessor):
@@ -301,6 +398,9 @@ class EncoderNoRepeatNGramLogitsProcessor(LogitsProcessor):
     :class:`transformers.LogitsProcessor` that enforces no repetition of encoder input ids n-grams for the decoder ids.
     See `ParlAI <https://github.com/facebookresearch/ParlAI/blob/master/parlai/core/torch_generator_agent.py#L1350>`__.
 
+    The keys of the prefixes of the encoder n-grams are computed once and the banned tokens of all hypotheses are set
+    with a single scatter at each step.
+
     Args:
         encoder_ngram_size (:obj:`int`):
             All ngrams of size :obj:`ngram_size` can only occur within the encoder input ids.
@@ -317,24 +417,29 @@ class EncoderNoRepeatNGramLogitsProcessor(LogitsProcessor):
         if len(encoder_input_ids.shape) == 1:
             encoder_input_ids = encoder_input_ids.unsqueeze(0)
         self.batch_size = encoder_input_ids.shape[0]
-        self.generated_ngrams = _get_ngrams(encoder_ngram_size, encoder_input_ids, self.batch_size)
+        self.base = int(encoder_input_ids.max()) + 1 if encoder_input_ids.numel() > 0 else 1
+        ngrams = _get_ngram_windows(encoder_ngram_size, encoder_input_ids)
+        self.prefix_keys = _ngram_prefix_keys(ngrams[..., :-1], self.base)
+        self.next_tokens = ngrams[..., -1]
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
         # B x num_beams
         num_hypos = scores.shape[0]
         num_beams = num_hypos // self.batch_size
         cur_len = input_ids.shape[-1]
-        banned_batch_tokens = [
-            _get_generated_ngrams(
-                self.generated_ngrams[hypo_idx // num_beams], input_ids[hypo_idx], self.ngram_size, cur_len
-            )
-            for hypo_idx in range(num_hypos)
-        ]
-
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores[i, banned_tokens] = -float("inf")
-
-        return scores
+        if cur_len + 1 < self.ngram_size:
+            return scores
+        query_tokens = input_ids[:, cur_len + 1 - self.ngram_size :]
+        # decoder tokens which do not occur in the encoder input can not start an encoder n-gram
+        query_mask = (query_tokens < self.base).all(-1)
+        batch_idx = torch.arange(num_hypos, device=input_ids.device) // num_beams
+        return _ban_ngram_continuations(
+            scores,
+            _ngram_prefix_keys(query_tokens, self.base),
+            self.prefix_keys[batch_idx],
+            self.next_tokens[batch_idx],
+            query_mask=query_mask,
+        )
 
 
 class NoBadWordsLogitsProcessor(LogitsProcessor):
@@ -23,7 +23,7 @@ import torch
 from torch.nn import functional as F
 
 from .file_utils import ModelOutput
-from .generation_beam_search import BeamScorer, BeamSearchScorer
+from .generation_beam_search import BeamScorer, TensorBeamSearchScorer
 from .generation_logits_process import (
     EncoderNoRepeatNGramLogitsProcessor,
     HammingDiversityLogitsProcessor,
@@ -33,6 +33,7 @@ from .generation_logits_process import (
     NoRepeatNGramLogitsProcessor,
     PrefixConstrainedLogitsProcessor,
     RepetitionPenaltyLogitsProcessor,
+    SentenceLengthLogitsProcessor,
     TemperatureLogitsWarper,
     TopKLogitsWarper,
     TopPLogitsWarper,
@@ -401,6 +402,8 @@ class GenerationMixin:
             encoder_kwargs["attention_mask"] = attention_mask_temp
             self.config.wait_k = main_source_wait_k
             model_kwargs["context_encoder_representations"] = None ## This will be filled with the context attention in the first decoding step which will actually update the main encoder representation. After that this will just be a placeholder to prevent any future computations. A bit sloppy and should be controlled by an additional condition looking at the value of multi_source type.
+            if self.config.multi_source_method == "average_softmaxes": ## Stack the sources along the batch once instead of at every decoding step.
+                model_kwargs = self.stack_sources_for_generation(model_kwargs)
         return model_kwargs
         ## Modified by Raj Dabre. End.
     
@@ -456,8 +459,13 @@ class GenerationMixin:
         additional_encoder_outputs: ModelOutput = None,
         additional_input_ids_mask: torch.LongTensor = None,
         multi_source = False,
+        share_encoder_outputs = False,
         **model_kwargs,
     ) -> Tuple[torch.LongTensor, Dict[str, Any]]:
+        """
+        Expands the decoder inputs and the encoder outputs for beam search and multiple return sequences.
+        If share_encoder_outputs is set, the encoder outputs and the encoder attention masks are kept at one copy per source sentence and the model shares them across the consecutive expanded sequences of each sentence.
+        """
         expanded_return_idx = (
             torch.arange(input_ids.shape[0]).view(-1, 1).repeat(1, expand_size).view(-1).to(input_ids.device)
         )
@@ -467,14 +475,24 @@ class GenerationMixin:
             token_type_ids = model_kwargs["token_type_ids"]
             model_kwargs["token_type_ids"] = token_type_ids.index_select(0, expanded_return_idx)
 
-        if attention_mask is not None:
+        if share_encoder_outputs: ## Modified by Raj Dabre.
+            model_kwargs["attention_mask"] = attention_mask
+            if multi_source:
+                model_kwargs["additional_input_ids_mask"] = additional_input_ids_mask
+        elif attention_mask is not None:
             model_kwargs["attention_mask"] = attention_mask.index_select(0, expanded_return_idx)
             ## Modified by Raj Dabre. Start.
             if multi_source:
                 model_kwargs["additional_input_ids_mask"] = additional_input_ids_mask.index_select(0, expanded_return_idx)
             ## Modified by Raj Dabre. End.
             
-        if is_encoder_decoder:
+        if is_encoder_decoder and share_encoder_outputs: ## Modified by Raj Dabre.
+            assert encoder_outputs is not None
+            model_kwargs["encoder_outputs"] = encoder_outputs
+            if multi_source:
+                assert additional_encoder_outputs is not None
+                model_kwargs["additional_encoder_outputs"] = additional_encoder_outputs
+        elif is_encoder_decoder:
             assert encoder_outputs is not None
             encoder_outputs["last_hidden_state"] = encoder_outputs.last_hidden_state.index_select(
                 0, expanded_return_idx.to(encoder_outputs.last_hidden_state.device)
@@ -522,17 +540,12 @@ class GenerationMixin:
         # update past
         if "past_key_values" in outputs: ## This will always be true.
             model_kwargs["past"] = outputs.past_key_values
-            ## Modified by Raj Dabre. Start.
-            if "additional_past_key_values" in outputs: ## It will always be in outputs
-                model_kwargs["additional_past"] = outputs.additional_past_key_values
-            ## Modified by Raj Dabre. End.
         elif "mems" in outputs:
             model_kwargs["past"] = outputs.mems
         elif "past_buckets_states" in outputs:
             model_kwargs["past"] = outputs.past_buckets_states
         else:
             model_kwargs["past"] = None
-            model_kwargs["additional_past"] = None
         
         ## Modified by Raj Dabre. Start.
         if "context_encoder_representations" in model_kwargs: ## To ensure that context encoder representations are reused instead of being recomputed.
@@ -559,6 +572,20 @@ class GenerationMixin:
             f"Make sure that a `_reorder_cache` function is correctly implemented in {self.__class__.__module__} to enable beam search for {self.__class__}"
         )
 
+    ## Modified by Raj Dabre. Start.
+    def _prepare_static_cache_for_generation(self, input_ids, max_length, model_kwargs):
+        """This method allocates a preallocated key value cache for the decoder before the first decoding step if the model config asks for one.
+        The cache is passed as the past from the first step onwards and is then updated in place by the decoder. For multi source models which average the softmaxes, the cache holds both sources stacked along the batch.
+        """
+        if self._get_name() != "MBartForConditionalGeneration" or not getattr(self.config, "static_kv_cache", False):
+            return model_kwargs
+        if model_kwargs.get("use_cache") is False or model_kwargs.get("past") is not None:
+            return model_kwargs
+        num_sources = 2 if self.config.multi_source and self.config.multi_source_method == "average_softmaxes" else 1
+        model_kwargs["past"] = self.get_decoder().init_static_cache(num_sources * input_ids.shape[0], max_length)
+        return model_kwargs
+    ## Modified by Raj Dabre. End.
+
     def _get_logits_warper(
         self, top_k: int = None, top_p: float = None, temperature: float = None, num_beams: int = None
     ) -> LogitsProcessorList:
@@ -597,6 +624,8 @@ class GenerationMixin:
         num_beams: int,
         num_beam_groups: int,
         diversity_penalty: float,
+        sentence_min_lengths: Optional[torch.LongTensor] = None,
+        sentence_max_lengths: Optional[torch.LongTensor] = None,
     ) -> LogitsProcessorList:
         """
         This class returns a :obj:`~transformers.LogitsProcessorList` list object that contains all relevant
@@ -643,6 +672,10 @@ class GenerationMixin:
             processors.append(NoBadWordsLogitsProcessor(bad_words_ids, eos_token_id))
         if min_length is not None and eos_token_id is not None and min_length > -1:
             processors.append(MinLengthLogitsProcessor(min_length, eos_token_id))
+        ## Modified by Raj Dabre. Start.
+        if (sentence_min_lengths is not None or sentence_max_lengths is not None) and eos_token_id is not None:
+            processors.append(SentenceLengthLogitsProcessor(sentence_min_lengths, sentence_max_lengths, eos_token_id))
+        ## Modified by Raj Dabre. End.
         if prefix_allowed_tokens_fn is not None:
             processors.append(PrefixConstrainedLogitsProcessor(prefix_allowed_tokens_fn, num_beams))
         return processors
@@ -677,6 +710,8 @@ class GenerationMixin:
         output_hidden_states: Optional[bool] = None,
         output_scores: Optional[bool] = None,
         return_dict_in_generate: Optional[bool] = None,
+        sentence_min_lengths: Optional[torch.LongTensor] = None,
+        sentence_max_lengths: Optional[torch.LongTensor] = None,
         **model_kwargs,
     ) -> Union[GreedySearchOutput, SampleOutput, BeamSearchOutput, BeamSampleOutput, torch.LongTensor]:
         r"""
@@ -770,6 +805,12 @@ class GenerationMixin:
                 Whether or not to return the prediction scores. See ``scores`` under returned tensors for more details.
             return_dict_in_generate (:obj:`bool`, `optional`, defaults to `False`):
                 Whether or not to return a :class:`~transformers.file_utils.ModelOutput` instead of a plain tuple.
+            sentence_min_lengths (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
+                The minimum length of the sequence of each input. Unlike :obj:`min_length` this does not depend on the
+                other inputs of the batch.
+            sentence_max_lengths (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
+                The maximum length of the sequence of each input. The sequence of an input ends with
+                :obj:`eos_token_id` at the latest at this length. :obj:`max_length` defaults to the largest of them.
 
             model_kwargs:
                 Additional model specific kwargs will be forwarded to the :obj:`forward` function of the model. If the
@@ -852,6 +893,10 @@ class GenerationMixin:
         # set init values
         num_beams = num_beams if num_beams is not None else self.config.num_beams
         num_beam_groups = num_beam_groups if num_beam_groups is not None else self.config.num_beam_groups
+        ## Modified by Raj Dabre. Start.
+        if sentence_max_lengths is not None and max_length is None: ## No sequence can be longer than this.
+            max_length = int(sentence_max_lengths.max())
+        ## Modified by Raj Dabre. End.
         max_length = max_length if max_length is not None else self.config.max_length
         do_sample = do_sample if do_sample is not None else self.config.do_sample
         num_return_sequences = (
@@ -964,6 +1009,8 @@ class GenerationMixin:
             num_beams=num_beams,
             num_beam_groups=num_beam_groups,
             diversity_penalty=diversity_penalty,
+            sentence_min_lengths=sentence_min_lengths,
+            sentence_max_lengths=sentence_max_lengths,
         )
 
         if is_greedy_gen_mode:
@@ -996,6 +1043,7 @@ class GenerationMixin:
                 expand_size=num_return_sequences,
                 is_encoder_decoder=self.config.is_encoder_decoder, 
                 multi_source=self.config.multi_source if self._get_name() == "MBartForConditionalGeneration" else False, ## Modified by Raj Dabre.
+                share_encoder_outputs=self._get_name() == "MBartForConditionalGeneration", ## Modified by Raj Dabre.
                 **model_kwargs,
             )
 
@@ -1021,7 +1069,7 @@ class GenerationMixin:
             if num_return_sequences > num_beams:
                 raise ValueError("`num_return_sequences` has to be smaller or equal to `num_beams`.")
 
-            beam_scorer = BeamSearchScorer(
+            beam_scorer = TensorBeamSearchScorer(
                 batch_size=batch_size,
                 max_length=max_length,
                 num_beams=num_beams,
@@ -1032,7 +1080,7 @@ class GenerationMixin:
             )
             # interleave with `num_beams`
             input_ids, model_kwargs = self._expand_inputs_for_generation(
-                input_ids, expand_size=num_beams, is_encoder_decoder=self.config.is_encoder_decoder, multi_source=self.config.multi_source if self._get_name() == "MBartForConditionalGeneration" else False, **model_kwargs
+                input_ids, expand_size=num_beams, is_encoder_decoder=self.config.is_encoder_decoder, multi_source=self.config.multi_source if self._get_name() == "MBartForConditionalGeneration" else False, share_encoder_outputs=self._get_name() == "MBartForConditionalGeneration", **model_kwargs
             ) ## Modified by Raj Dabre.
             return self.beam_search(
                 input_ids,
@@ -1054,7 +1102,7 @@ class GenerationMixin:
             batch_size = input_ids.shape[0] * num_return_sequences
 
             length_penalty = length_penalty if length_penalty is not None else self.config.length_penalty
-            beam_scorer = BeamSearchScorer(
+            beam_scorer = TensorBeamSearchScorer(
                 batch_size=batch_size,
                 max_length=max_length,
                 num_beams=num_beams,
@@ -1069,6 +1117,7 @@ class GenerationMixin:
                 expand_size=num_beams * num_return_sequences,
                 is_encoder_decoder=self.config.is_encoder_decoder,
                 multi_source=self.config.multi_source if self._get_name() == "MBartForConditionalGeneration" else False,
+                share_encoder_outputs=self._get_name() == "MBartForConditionalGeneration",
                 **model_kwargs,
             ) ## Modified by Raj Dabre.
 
@@ -1097,7 +1146,7 @@ class GenerationMixin:
             if num_beams % num_beam_groups != 0:
                 raise ValueError("`num_beams` should be divisible by `num_beam_groups` for group beam search.")
 
-            diverse_beam_scorer = BeamSearchScorer(
+            diverse_beam_scorer = TensorBeamSearchScorer(
                 batch_size=batch_size,
                 max_length=max_length,
                 num_beams=num_beams,
@@ -1109,7 +1158,7 @@ class GenerationMixin:
             )
             # interleave with `num_beams`
             input_ids, model_kwargs = self._expand_inputs_for_generation(
-                input_ids, expand_size=num_beams, is_encoder_decoder=self.config.is_encoder_decoder, multi_source=self.config.multi_source if self._get_name() == "MBartForConditionalGeneration" else False, **model_kwargs
+                input_ids, expand_size=num_beams, is_encoder_decoder=self.config.is_encoder_decoder, multi_source=self.config.multi_source if self._get_name() == "MBartForConditionalGeneration" else False, share_encoder_outputs=self._get_name() == "MBartForConditionalGeneration", **model_kwargs
             ) ## Modified by Raj Dabre.
             return self.group_beam_search(
                 input_ids,
@@ -1210,6 +1259,7 @@ class GenerationMixin:
         # init values
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         max_length = max_length if max_length is not None else self.config.max_length
+        model_kwargs = self._prepare_static_cache_for_generation(input_ids, max_length, model_kwargs) ## Raj: Allocate the static key value cache, if needed.
         pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
         eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
         output_scores = output_scores if output_scores is not None else self.config.output_scores
@@ -1433,6 +1483,7 @@ class GenerationMixin:
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         logits_warper = logits_warper if logits_warper is not None else LogitsProcessorList()
         max_length = max_length if max_length is not None else self.config.max_length
+        model_kwargs = self._prepare_static_cache_for_generation(input_ids, max_length, model_kwargs) ## Raj: Allocate the static key value cache, if needed.
         pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
         eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
         output_scores = output_scores if output_scores is not None else self.config.output_scores
@@ -1668,6 +1719,7 @@ class GenerationMixin:
         # init values
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         max_length = max_length if max_length is not None else self.config.max_length
+        model_kwargs = self._prepare_static_cache_for_generation(input_ids, max_length, model_kwargs) ## Raj: Allocate the static key value cache, if needed.
         pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
         eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
         output_scores = output_scores if output_scores is not None else self.config.output_scores
@@ -1698,7 +1750,7 @@ class GenerationMixin:
                 )
             ## Modified by Raj Dabre. End.
 
-        batch_size = len(beam_scorer._beam_hyps)
+        batch_size = beam_scorer.batch_size
         num_beams = beam_scorer.num_beams
 
         batch_beam_size, cur_len = input_ids.shape
@@ -1779,6 +1831,7 @@ class GenerationMixin:
             beam_idx = beam_outputs["next_beam_indices"]
 
             input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
+            logits_processor.reorder_state(beam_idx)
 
             cur_len = cur_len + 1
 
@@ -1787,10 +1840,6 @@ class GenerationMixin:
             )
             if model_kwargs["past"] is not None:
                 model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
-                ## Modified by Raj Dabre. Start.
-                if self._get_name() == "MBartForConditionalGeneration" and self.config.multi_source and model_kwargs["additional_past"] is not None: ## Raj: Reorder the additional source info too.
-                    model_kwargs["additional_past"] = self._reorder_cache(model_kwargs["additional_past"], beam_idx)
-                ## Modified by Raj Dabre. End.
                 
             if beam_scorer.is_done:
                 break
@@ -1947,6 +1996,7 @@ class GenerationMixin:
         # init values
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         max_length = max_length if max_length is not None else self.config.max_length
+        model_kwargs = self._prepare_static_cache_for_generation(input_ids, max_length, model_kwargs) ## Raj: Allocate the static key value cache, if needed.
         pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
         eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
         output_scores = output_scores if output_scores is not None else self.config.output_scores
@@ -1977,7 +2027,7 @@ class GenerationMixin:
                 )
             ## Modified by Raj Dabre. End.
 
-        batch_size = len(beam_scorer._beam_hyps)
+        batch_size = beam_scorer.batch_size
         num_beams = beam_scorer.num_beams
 
         batch_beam_size, cur_len = input_ids.shape
@@ -2057,6 +2107,7 @@ class GenerationMixin:
             beam_idx = beam_outputs["next_beam_indices"]
 
             input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
+            logits_processor.reorder_state(beam_idx)
             cur_len = cur_len + 1
 
             model_kwargs = self._update_model_kwargs_for_generation(
@@ -2064,10 +2115,6 @@ class GenerationMixin:
             )
             if model_kwargs["past"] is not None:
                 model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
-                ## Modified by Raj Dabre. Start.
-                if self._get_name() == "MBartForConditionalGeneration" and self.config.multi_source and model_kwargs["additional_past"] is not None: ## Raj: Reorder the additional source info too.
-                    model_kwargs["additional_past"] = self._reorder_cache(model_kwargs["additional_past"], beam_idx)
-                ## Modified by Raj Dabre. End.
             if beam_scorer.is_done:
                 break
 
@@ -2214,6 +2261,7 @@ class GenerationMixin:
         # init values
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         max_length = max_length if max_length is not None else self.config.max_length
+        model_kwargs = self._prepare_static_cache_for_generation(input_ids, max_length, model_kwargs) ## Raj: Allocate the static key value cache, if needed.
         pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
         eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
         output_scores = output_scores if output_scores is not None else self.config.output_scores
@@ -2244,7 +2292,7 @@ class GenerationMixin:
                 )
             ## Modified by Raj Dabre. End.
 
-        batch_size = len(beam_scorer._beam_hyps)
+        batch_size = beam_scorer.batch_size
         num_beams = beam_scorer.num_beams
         num_beam_groups = beam_scorer.num_beam_groups
         num_sub_beams = num_beams // num_beam_groups
@@ -2377,10 +2425,6 @@ class GenerationMixin:
             )
             if model_kwargs["past"] is not None:
                 model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], reordering_indices)
-                ## Modified by Raj Dabre. Start.
-                if self._get_name() == "MBartForConditionalGeneration" and self.config.multi_source and model_kwargs["additional_past"] is not None: ## Raj: Reorder the additional source info too.
-                    model_kwargs["additional_past"] = self._reorder_cache(model_kwargs["additional_past"], reordering_indices)
-                ## Modified by Raj Dabre. End.
             input_ids = torch.cat([input_ids, current_tokens.unsqueeze(-1)], dim=-1)
             cur_len = cur_len + 1
             if beam_scorer.is_done:
@@ -555,7 +555,6 @@ class Seq2SeqLMOutput(ModelOutput):
     additional_encoder_last_hidden_state: Optional[torch.FloatTensor] = None
     additional_encoder_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
     additional_source_lm_logits: Optional[Tuple[torch.FloatTensor]] = None
-    additional_past_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None
     context_encoder_representations: torch.FloatTensor = None
     softmax_temperature: Optional[torch.FloatTensor] = None
     domain_classifier_logits: Optional[torch.FloatTensor] = None
@@ -147,6 +147,9 @@ class MBartConfig(PretrainedConfig):
         num_domains_for_domain_classifier=-1, ## Argument to indicate number of domains for domain classifier.
         gradient_reversal_for_domain_classifier=False, ## Argument to indicate whether we should do gradient reversal for domain classifier.
         positional_encodings=False, ## Argument to indicate whether we should do use positional encodings or embeddings.
+        attention_implementation="eager", ## Argument to choose the attention kernel. Can be eager, sdpa or chunked.
+        attention_chunk_size=1024, ## Argument to indicate the number of queries processed at a time by the chunked attention.
+        static_kv_cache=False, ## Argument to indicate whether generation should use a preallocated key value cache instead of concatenating keys and values at every step.
         ## Modified by Raj Dabre. End.
         **kwargs
     ):
@@ -197,6 +200,9 @@ class MBartConfig(PretrainedConfig):
         self.num_domains_for_domain_classifier = num_domains_for_domain_classifier ## Argument to indicate number of domains for domain classifier.
         self.gradient_reversal_for_domain_classifier = gradient_reversal_for_domain_classifier ## Argument to indicate whether we should do gradient reversal for domain classifier.
         self.positional_encodings = positional_encodings ## Argument to indicate whether we should do use positional encodings or embeddings.
+        self.attention_implementation = attention_implementation ## Argument to choose the attention kernel. Can be eager, sdpa or chunked.
+        self.attention_chunk_size = attention_chunk_size ## Argument to indicate the number of queries processed at a time by the chunked attention.
+        self.static_kv_cache = static_kv_cache ## Argument to indicate whether generation should use a preallocated key value cache instead of concatenating keys and values at every step.
         ## Modified by Raj Dabre. End.
         
     @property
@@ -0,0 +1,393 @@
+# coding=utf-8
+# Copyright 2021, The HuggingFace Inc. team. All rights reserved.
+# Copyright 2021, National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Export of MBartForConditionalGeneration to TorchScript or ONNX graphs and a CPU runtime for decoding with them. """
+
+import inspect
+import json
+import os
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from ...generation_beam_search import TensorBeamSearchScorer
+from ...generation_logits_process import LogitsProcessorList, MinLengthLogitsProcessor, NoRepeatNGramLogitsProcessor
+from ...utils import logging
+from .configuration_mbart import MBartConfig
+
+
+logger = logging.get_logger(__name__)
+
+EXPORT_CONFIG_NAME = "export_config.json"
+ENCODER_NAME = "encoder"
+DECODER_WITH_PAST_NAME = "decoder_with_past"
+EXPORT_FORMAT_EXTENSIONS = {"torchscript": ".pt", "onnx": ".onnx"}
+
+## The multi-source methods whose decoding step only needs the encoder outputs and the cached keys and values. Averaging softmaxes runs a second decoder pass per step and additional source attention recomputes the context attention at every step so they are not exported.
+MERGE_BEFORE_ATTENTION_METHODS = ["merge_before_attention", "self_relevance_and_merge_before_attention"]
+MERGE_AFTER_ATTENTION_METHODS = ["merge_after_attention", "self_relevance_and_merge_after_attention", "merge_after_attention_with_context_relevance_only", "self_relevance_and_merge_after_attention_with_context_relevance_only"]
+EXPORTABLE_MULTI_SOURCE_METHODS = MERGE_BEFORE_ATTENTION_METHODS + MERGE_AFTER_ATTENTION_METHODS
+
+
+def _merges_after_attention(config):
+    return config.multi_source and config.multi_source_method in MERGE_AFTER_ATTENTION_METHODS
+
+
+def get_encoder_input_names(config):
+    """This method returns the names of the inputs of the exported encoder in the order in which they are passed."""
+    if config.multi_source:
+        return ["input_ids", "attention_mask", "additional_input_ids", "additional_input_ids_mask"]
+    return ["input_ids", "attention_mask"]
+
+
+def get_encoder_output_names(config):
+    """This method returns the names of the outputs of the exported encoder. The cross attention keys and values of all decoder layers are precomputed by the encoder so that the decoder never projects the encoder outputs again."""
+    if not config.multi_source:
+        return ["encoder_hidden_states", "cross_key_values"]
+    if _merges_after_attention(config):
+        return ["encoder_hidden_states", "additional_encoder_hidden_states", "cross_key_values", "additional_cross_key_values"]
+    return ["encoder_hidden_states", "additional_encoder_hidden_states", "cross_key_values"]
+
+
+def get_decoder_input_names(config):
+    """This method returns the names of the inputs of the exported decoder with past in the order in which they are passed."""
+    input_names = ["decoder_input_ids", "curr_decode_length", "encoder_hidden_states", "attention_mask", "self_key_values", "cross_key_values"]
+    if config.multi_source:
+        input_names += ["additional_encoder_hidden_states", "additional_input_ids_mask"]
+        if _merges_after_attention(config):
+            input_names += ["additional_cross_key_values"]
+    return input_names
+
+
+def get_decoder_output_names(config):
+    """This method returns the names of the outputs of the exported decoder with past."""
+    return ["logits", "present_self_key_values"]
+
+
+def _apply_wait_k(attention_mask, wait_k, curr_decode_length):
+    """This method masks the source tokens which a wait-k decoder is not allowed to see yet. This is what _expand_mask does with a triangular mask but the current decoding length is a tensor here so that the exported graph works for every decoding step."""
+    if wait_k == -1:
+        return attention_mask
+    visible_positions = torch.arange(attention_mask.size(1), device=attention_mask.device) <= curr_decode_length + (wait_k - 2) ## The (curr_decode_length-1) + (wait_k-1) diagonal of _expand_mask.
+    return attention_mask * visible_positions.to(attention_mask.dtype)
+
+
+class MBartEncoderForExport(nn.Module):
+    """This class wraps the encoder of MBartForConditionalGeneration for export. It encodes the source (and the additional source) and projects the encoder outputs to the cross attention keys and values of every decoder layer, stacked into a [decoder_layers, 2, batch, heads, src_len, head_dim] tensor."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def _cross_key_values(self, encoder_hidden_states):
+        bsz = encoder_hidden_states.size(0)
+        cross_key_values = []
+        for layer in self.model.model.decoder.layers:
+            encoder_attn = layer.encoder_attn
+            cross_key_values.append(torch.stack([encoder_attn._shape(encoder_attn.k_proj(encoder_hidden_states), -1, bsz), encoder_attn._shape(encoder_attn.v_proj(encoder_hidden_states), -1, bsz)]))
+        return torch.stack(cross_key_values)
+
+    def forward(self, input_ids, attention_mask, additional_input_ids=None, additional_input_ids_mask=None):
+        config = self.model.config
+        encoder = self.model.model.encoder
+        encoder_hidden_states = encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+        if not config.multi_source:
+            return encoder_hidden_states, self._cross_key_values(encoder_hidden_states)
+        main_source_wait_k = config.wait_k ## The additional source is encoded with its own wait-k just like in MBartModel.
+        config.wait_k = config.additional_source_wait_k
+        try:
+            additional_encoder_hidden_states = encoder(input_ids=additional_input_ids, attention_mask=additional_input_ids_mask, return_dict=True).last_hidden_state
+        finally:
+            config.wait_k = main_source_wait_k
+        if _merges_after_attention(config):
+            return encoder_hidden_states, additional_encoder_hidden_states, self._cross_key_values(encoder_hidden_states), self._cross_key_values(additional_encoder_hidden_states)
+        return encoder_hidden_states, additional_encoder_hidden_states, self._cross_key_values(torch.cat([encoder_hidden_states, additional_encoder_hidden_states], 1)) ## The decoder attends to both sources concatenated along the sequence axis.
+
+
+class MBartDecoderWithPastForExport(nn.Module):
+    """This class wraps the decoder and the lm head of MBartForConditionalGeneration for export. Each call decodes one token given the self attention keys and values of the previous tokens, stacked into a [decoder_layers, 2, batch, heads, past_len, head_dim] tensor which may be empty, and returns the logits of the next token and the self attention keys and values including the current token. The wait-k masks are computed from curr_decode_length inside the graph."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids, curr_decode_length, encoder_hidden_states, attention_mask, self_key_values, cross_key_values, additional_encoder_hidden_states=None, additional_input_ids_mask=None, additional_cross_key_values=None):
+        config = self.model.config
+        attention_mask = _apply_wait_k(attention_mask, config.wait_k, curr_decode_length)
+        if config.multi_source:
+            additional_input_ids_mask = _apply_wait_k(additional_input_ids_mask, config.additional_source_wait_k, curr_decode_length)
+        past_key_values = []
+        for layer_idx in range(self_key_values.size(0)):
+            layer_past_key_value = (self_key_values[layer_idx, 0], self_key_values[layer_idx, 1], cross_key_values[layer_idx, 0], cross_key_values[layer_idx, 1])
+            if additional_cross_key_values is not None:
+                layer_past_key_value += (additional_cross_key_values[layer_idx, 0], additional_cross_key_values[layer_idx, 1])
+            past_key_values.append(layer_past_key_value)
+        wait_k, additional_source_wait_k = config.wait_k, config.additional_source_wait_k ## The masks are already wait-k masks so the model should not apply wait-k once more.
+        config.wait_k, config.additional_source_wait_k = -1, -1
+        try:
+            outputs = self.model(
+                attention_mask=attention_mask,
+                decoder_input_ids=decoder_input_ids,
+                encoder_outputs=(encoder_hidden_states,),
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+                additional_input_ids_mask=additional_input_ids_mask,
+                additional_encoder_outputs=(additional_encoder_hidden_states,) if config.multi_source else None,
+            )
+        finally:
+            config.wait_k, config.additional_source_wait_k = wait_k, additional_source_wait_k
+        present_self_key_values = torch.stack([torch.stack(layer_present_key_value[:2]) for layer_present_key_value in outputs.past_key_values])
+        return outputs.logits[:, -1, :], present_self_key_values
+
+
+def _get_dummy_inputs(config, batch_size=2, src_len=7, additional_src_len=5, past_len=3):
+    """This method creates the inputs with which the graphs are traced. The sizes are all different so that no two dynamic axes get mixed up."""
+    input_ids = torch.randint(3, config.vocab_size, (batch_size, src_len))
+    encoder_inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    if config.multi_source:
+        additional_input_ids = torch.randint(3, config.vocab_size, (batch_size, additional_src_len))
+        encoder_inputs.update({"additional_input_ids": additional_input_ids, "additional_input_ids_mask": torch.ones_like(additional_input_ids)})
+    head_dim = config.d_model // config.decoder_attention_heads
+    decoder_inputs = {
+        "decoder_input_ids": torch.randint(3, config.vocab_size, (batch_size, 1)),
+        "curr_decode_length": torch.tensor(past_len + 1),
+        "attention_mask": encoder_inputs["attention_mask"],
+        "self_key_values": torch.randn(config.decoder_layers, 2, batch_size, config.decoder_attention_heads, past_len, head_dim),
+    }
+    if config.multi_source:
+        decoder_inputs["additional_input_ids_mask"] = encoder_inputs["additional_input_ids_mask"]
+    return encoder_inputs, decoder_inputs
+
+
+def _get_dynamic_axes(config):
+    """This method returns the dynamic axes of the inputs and outputs of both graphs for the ONNX export."""
+    cross_sequence = "cross_sequence" if config.multi_source and config.multi_source_method in MERGE_BEFORE_ATTENTION_METHODS else "sequence"
+    encoder_dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "sequence"},
+        "additional_input_ids": {0: "batch", 1: "additional_sequence"},
+        "additional_input_ids_mask": {0: "batch", 1: "additional_sequence"},
+        "encoder_hidden_states": {0: "batch", 1: "sequence"},
+        "additional_encoder_hidden_states": {0: "batch", 1: "additional_sequence"},
+        "cross_key_values": {2: "batch", 4: cross_sequence},
+        "additional_cross_key_values": {2: "batch", 4: "additional_sequence"},
+    }
+    decoder_dynamic_axes = {
+        "decoder_input_ids": {0: "batch"},
+        "encoder_hidden_states": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "sequence"},
+        "self_key_values": {2: "batch", 4: "past_sequence"},
+        "cross_key_values": {2: "batch", 4: cross_sequence},
+        "additional_encoder_hidden_states": {0: "batch", 1: "additional_sequence"},
+        "additional_input_ids_mask": {0: "batch", 1: "additional_sequence"},
+        "additional_cross_key_values": {2: "batch", 4: "additional_sequence"},
+        "logits": {0: "batch"},
+        "present_self_key_values": {2: "batch", 4: "present_sequence"},
+    }
+    encoder_names = get_encoder_input_names(config) + get_encoder_output_names(config)
+    decoder_names = get_decoder_input_names(config) + get_decoder_output_names(config)
+    return {name: encoder_dynamic_axes[name] for name in encoder_names}, {name: decoder_dynamic_axes[name] for name in decoder_names if name in decoder_dynamic_axes}
+
+
+def export_mbart(model, export_dir, export_format="torchscript", opset_version=14):
+    """This method exports an MBartForConditionalGeneration model into an encoder graph and a decoder with past graph which decodes one token at a time. Models with wait-k, unidirectional encoders, positional encodings and the multi-source methods in EXPORTABLE_MULTI_SOURCE_METHODS are supported. The export format is either torchscript or onnx. The config of the model is saved next to the graphs so that MBartExportedModel can decode with them."""
+    config = model.config
+    if export_format not in EXPORT_FORMAT_EXTENSIONS:
+        raise ValueError(f"Unknown export format {export_format}. Choose one of {list(EXPORT_FORMAT_EXTENSIONS.keys())}.")
+    if config.multi_source and config.multi_source_method not in EXPORTABLE_MULTI_SOURCE_METHODS:
+        raise ValueError(f"Multi-source method {config.multi_source_method} can not be exported. Choose one of {EXPORTABLE_MULTI_SOURCE_METHODS}.")
+    if config.multilayer_softmaxing:
+        raise ValueError("Models with multilayer softmaxing can not be exported.")
+    os.makedirs(export_dir, exist_ok=True)
+    model.eval()
+    static_kv_cache = config.static_kv_cache ## The exported decoder keeps its own cache.
+    config.static_kv_cache = False
+
+    encoder = MBartEncoderForExport(model)
+    decoder = MBartDecoderWithPastForExport(model)
+    encoder_inputs, decoder_inputs = _get_dummy_inputs(config)
+    try:
+        with torch.no_grad():
+            encoder_outputs = dict(zip(get_encoder_output_names(config), encoder(**encoder_inputs)))
+            decoder_inputs.update({name: encoder_outputs[name] for name in get_decoder_input_names(config) if name in encoder_outputs})
+            encoder_args = tuple(encoder_inputs[name] for name in get_encoder_input_names(config))
+            decoder_args = tuple(decoder_inputs[name] for name in get_decoder_input_names(config))
+            encoder_path = os.path.join(export_dir, ENCODER_NAME + EXPORT_FORMAT_EXTENSIONS[export_format])
+            decoder_path = os.path.join(export_dir, DECODER_WITH_PAST_NAME + EXPORT_FORMAT_EXTENSIONS[export_format])
+            if export_format == "torchscript":
+                torch.jit.trace(encoder, encoder_args, check_trace=False).save(encoder_path)
+                torch.jit.trace(decoder, decoder_args, check_trace=False).save(decoder_path)
+            else:
+                encoder_dynamic_axes, decoder_dynamic_axes = _get_dynamic_axes(config)
+                export_kwargs = {"opset_version": opset_version, "do_constant_folding": True}
+                if "dynamo" in inspect.signature(torch.onnx.export).parameters: ## Newer versions of pytorch default to the dynamo exporter but the graphs are traced just like for torchscript.
+                    export_kwargs["dynamo"] = False
+                torch.onnx.export(encoder, encoder_args, encoder_path, input_names=get_encoder_input_names(config), output_names=get_encoder_output_names(config), dynamic_axes=encoder_dynamic_axes, **export_kwargs)
+                torch.onnx.export(decoder, decoder_args, decoder_path, input_names=get_decoder_input_names(config), output_names=get_decoder_output_names(config), dynamic_axes=decoder_dynamic_axes, **export_kwargs)
+    finally:
+        config.static_kv_cache = static_kv_cache
+
+    config.save_pretrained(export_dir)
+    with open(os.path.join(export_dir, EXPORT_CONFIG_NAME), "w") as f:
+        json.dump({"export_format": export_format, "encoder": os.path.basename(encoder_path), "decoder_with_past": os.path.basename(decoder_path)}, f, indent=2)
+    logger.info(f"Exported the encoder to {encoder_path} and the decoder with past to {decoder_path}")
+
+
+class MBartExportedModel:
+    """This class decodes with the graphs written by export_mbart on CPU without needing the model code. Greedy and beam search behave exactly like the generate method of the PyTorch model for the same arguments."""
+
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, EXPORT_CONFIG_NAME)) as f:
+            export_config = json.load(f)
+        self.config = MBartConfig.from_pretrained(export_dir)
+        self.export_format = export_config["export_format"]
+        self.encoder = self._load_graph(os.path.join(export_dir, export_config["encoder"]), get_encoder_input_names(self.config))
+        self.decoder = self._load_graph(os.path.join(export_dir, export_config["decoder_with_past"]), get_decoder_input_names(self.config))
+
+    def _load_graph(self, path, input_names):
+        """This method loads a graph and returns a function which runs it on a dict of named input tensors and returns a tuple of output tensors."""
+        if self.export_format == "torchscript":
+            module = torch.jit.load(path, map_location="cpu")
+            return lambda inputs: module(*[inputs[name] for name in input_names])
+        import onnxruntime ## Only needed for onnx graphs.
+
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        session_input_names = [session_input.name for session_input in session.get_inputs()] ## Inputs which are not used by a graph (such as the decoding length without wait-k) may be dropped by the exporter.
+        return lambda inputs: tuple(torch.from_numpy(output) for output in session.run(None, {name: inputs[name].cpu().numpy() for name in session_input_names}))
+
+    def _decode_step(self, decoder_inputs, input_ids):
+        """This method runs the decoder on the last token of input_ids and caches the self attention keys and values for the next step."""
+        decoder_inputs["decoder_input_ids"] = input_ids[:, -1:]
+        decoder_inputs["curr_decode_length"] = torch.tensor(input_ids.size(1))
+        next_token_logits, decoder_inputs["self_key_values"] = self.decoder(decoder_inputs)
+        return next_token_logits
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        additional_input_ids=None,
+        additional_input_ids_mask=None,
+        max_length=None,
+        min_length=None,
+        num_beams=None,
+        length_penalty=None,
+        early_stopping=None,
+        no_repeat_ngram_size=None,
+        num_return_sequences=None,
+        decoder_start_token_id=None,
+    ):
+        """This method translates a batch of source sentences (and additional source sentences for multi-source models) with greedy search if num_beams is 1 and with beam search otherwise. The arguments have the same meaning and defaults as in the generate method of the PyTorch model."""
+        config = self.config
+        max_length = max_length if max_length is not None else config.max_length
+        min_length = min_length if min_length is not None else config.min_length
+        num_beams = num_beams if num_beams is not None else config.num_beams
+        length_penalty = length_penalty if length_penalty is not None else config.length_penalty
+        early_stopping = early_stopping if early_stopping is not None else config.early_stopping
+        no_repeat_ngram_size = no_repeat_ngram_size if no_repeat_ngram_size is not None else config.no_repeat_ngram_size
+        num_return_sequences = num_return_sequences if num_return_sequences is not None else config.num_return_sequences
+        decoder_start_token_id = decoder_start_token_id if decoder_start_token_id is not None else (config.decoder_start_token_id if config.decoder_start_token_id is not None else config.bos_token_id)
+        if num_return_sequences > num_beams:
+            raise ValueError("num_return_sequences has to be smaller or equal to num_beams.")
+        if attention_mask is None:
+            attention_mask = input_ids.ne(config.pad_token_id).long()
+        if config.multi_source and additional_input_ids_mask is None:
+            additional_input_ids_mask = additional_input_ids.ne(config.pad_token_id).long()
+
+        encoder_inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "additional_input_ids": additional_input_ids, "additional_input_ids_mask": additional_input_ids_mask}
+        encoder_outputs = dict(zip(get_encoder_output_names(config), self.encoder(encoder_inputs)))
+        encoder_outputs.update({"attention_mask": attention_mask, "additional_input_ids_mask": additional_input_ids_mask})
+
+        batch_size = input_ids.size(0)
+        expanded_index = torch.arange(batch_size).repeat_interleave(num_beams) ## The graphs expect one copy of the encoder outputs per beam.
+        decoder_inputs = {}
+        for name in get_decoder_input_names(config):
+            if name in ["cross_key_values", "additional_cross_key_values"]:
+                decoder_inputs[name] = encoder_outputs[name].index_select(2, expanded_index)
+            elif name in encoder_outputs:
+                decoder_inputs[name] = encoder_outputs[name].index_select(0, expanded_index)
+        cross_key_values = decoder_inputs["cross_key_values"]
+        decoder_inputs["self_key_values"] = cross_key_values.new_zeros(cross_key_values.size()[:4] + (0, cross_key_values.size(5)))
+        decoder_input_ids = torch.full((batch_size * num_beams, 1), decoder_start_token_id, dtype=torch.long)
+
+        logits_processor = LogitsProcessorList()
+        if no_repeat_ngram_size is not None and no_repeat_ngram_size > 0:
+            logits_processor.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+        if min_length is not None and config.eos_token_id is not None and min_length > -1:
+            logits_processor.append(MinLengthLogitsProcessor(min_length, config.eos_token_id))
+
+        if num_beams == 1:
+            return self._greedy_search(decoder_input_ids, decoder_inputs, logits_processor, max_length)
+        beam_scorer = TensorBeamSearchScorer(
+            batch_size=batch_size,
+            max_length=max_length,
+            num_beams=num_beams,
+            device=decoder_input_ids.device,
+            length_penalty=length_penalty,
+            do_early_stopping=early_stopping,
+            num_beam_hyps_to_keep=num_return_sequences,
+        )
+        return self._beam_search(decoder_input_ids, decoder_inputs, beam_scorer, logits_processor, max_length)
+
+    def _greedy_search(self, input_ids, decoder_inputs, logits_processor, max_length):
+        """This method mirrors GenerationMixin.greedy_search."""
+        eos_token_id, pad_token_id = self.config.eos_token_id, self.config.pad_token_id
+        unfinished_sequences = input_ids.new_ones(input_ids.size(0))
+        while input_ids.size(1) < max_length:
+            next_token_logits = self._decode_step(decoder_inputs, input_ids)
+            next_tokens = torch.argmax(logits_processor(input_ids, next_token_logits), dim=-1)
+            if eos_token_id is not None:
+                next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            if eos_token_id is not None:
+                unfinished_sequences = unfinished_sequences.mul((next_tokens != eos_token_id).long())
+            if unfinished_sequences.max() == 0:
+                break
+        return input_ids
+
+    def _beam_search(self, input_ids, decoder_inputs, beam_scorer, logits_processor, max_length):
+        """This method mirrors GenerationMixin.beam_search including the forced end of sentence token at the last step done by MBartForConditionalGeneration.adjust_logits_during_generation."""
+        eos_token_id, pad_token_id = self.config.eos_token_id, self.config.pad_token_id
+        batch_size, num_beams = beam_scorer.batch_size, beam_scorer.num_beams
+        beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view((batch_size * num_beams,))
+        if eos_token_id is not None: ## Every token except the end of sentence token is masked at the last step.
+            non_eos_mask = torch.arange(self.config.vocab_size) != eos_token_id
+        while input_ids.size(1) < max_length:
+            next_token_logits = self._decode_step(decoder_inputs, input_ids)
+            if input_ids.size(1) == max_length - 1 and eos_token_id is not None:
+                next_token_logits = next_token_logits.masked_fill(non_eos_mask, -float("inf"))
+            next_token_scores = F.log_softmax(next_token_logits, dim=-1)
+            next_token_scores = logits_processor(input_ids, next_token_scores)
+            next_token_scores = next_token_scores + beam_scores[:, None].expand_as(next_token_scores)
+
+            vocab_size = next_token_scores.shape[-1]
+            next_token_scores, next_tokens = torch.topk(next_token_scores.view(batch_size, num_beams * vocab_size), 2 * num_beams, dim=1, largest=True, sorted=True)
+            next_indices = next_tokens // vocab_size
+            next_tokens = next_tokens % vocab_size
+
+            beam_outputs = beam_scorer.process(input_ids, next_token_scores, next_tokens, next_indices, pad_token_id=pad_token_id, eos_token_id=eos_token_id)
+            beam_scores = beam_outputs["next_beam_scores"]
+            beam_idx = beam_outputs["next_beam_indices"]
+            input_ids = torch.cat([input_ids[beam_idx, :], beam_outputs["next_beam_tokens"].unsqueeze(-1)], dim=-1)
+            decoder_inputs["self_key_values"] = decoder_inputs["self_key_values"].index_select(2, beam_idx)
+            if beam_scorer.is_done:
+                break
+
+        return beam_scorer.finalize(input_ids, beam_scores, next_tokens, next_indices, pad_token_id=pad_token_id, eos_token_id=eos_token_id)["sequences"]
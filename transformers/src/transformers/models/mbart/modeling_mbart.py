@@ -16,6 +16,7 @@
 # limitations under the License.
 """ PyTorch MBART model. """
 import copy
+import inspect
 import math
 import random
 from typing import Optional, Tuple
@@ -40,6 +41,7 @@ from ...file_utils import (
 )
 from ...modeling_outputs import (
     BaseModelOutput,
+    BaseModelOutputWithPast,
     BaseModelOutputWithPastAndCrossAttentions,
     CausalLMOutputWithCrossAttentions,
     Seq2SeqLMOutput,
@@ -54,6 +56,10 @@ from .configuration_mbart import MBartConfig
 
 logger = logging.get_logger(__name__)
 
+## Modified by Raj Dabre. Start.
+CHECKPOINT_KWARGS = {"use_reentrant": False} if "use_reentrant" in inspect.signature(torch.utils.checkpoint.checkpoint).parameters else {} ## Older versions of pytorch only have the reentrant checkpoint which does not accept this argument.
+## Modified by Raj Dabre. End.
+
 _CONFIG_FOR_DOC = "MBartConfig"
 _TOKENIZER_FOR_DOC = "MBartTokenizer"
 
@@ -64,6 +70,31 @@ MBART_PRETRAINED_MODEL_ARCHIVE_LIST = [
 ]
 
 
+## Modified by Raj Dabre. Start.
+def _stack_sources_along_batch(tensor: torch.Tensor, additional_tensor: torch.Tensor, padding_value):
+    """
+    Stacks the main and the additional source along the batch after padding the shorter one along the sequence.
+    """
+    max_length = max(tensor.size(1), additional_tensor.size(1))
+    padded_tensors = []
+    for source_tensor in [tensor, additional_tensor]:
+        padding = [0, 0] * (source_tensor.dim() - 2) + [0, max_length - source_tensor.size(1)] ## F.pad pads the last axis first.
+        padded_tensors.append(F.pad(source_tensor, padding, value=padding_value))
+    return torch.cat(padded_tensors, dim=0)
+
+
+def _unstack_sources_along_batch(tensor: torch.Tensor, length: int, additional_length: int, dims=(1,)):
+    """
+    Inverse of _stack_sources_along_batch. Splits the batch into the main and the additional source and removes the padding along the sequence axes in dims.
+    """
+    main_tensor, additional_tensor = tensor.chunk(2)
+    for dim in dims:
+        main_tensor = main_tensor.narrow(dim, 0, length)
+        additional_tensor = additional_tensor.narrow(dim, 0, additional_length)
+    return main_tensor, additional_tensor
+## Modified by Raj Dabre. End.
+
+
 def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int):
     """
     Shift input ids one token to the right, and wrap the last non pad token (the <LID> token) Note that MBart does not
@@ -176,6 +207,50 @@ class MBartLearnedPositionalEmbedding(nn.Embedding):
         return super().forward(positions + self.offset)
 
 
+## Modified by Raj Dabre. Start.
+class MBartStaticCache:
+    """Preallocated keys and values for incremental decoding with MBartDecoder.
+    The self attention keys and values of all decoder layers live in a single buffer of size (num_layers, 2, batch_size, num_heads, max_length, head_dim) which is allocated once and written into in place at every decoding step instead of being concatenated to the past.
+    The cross attention keys and values are computed in the first step and then reused as is since they do not depend on the beam.
+    Reordering the beams is a single index gather over the filled part of the buffer.
+    """
+    def __init__(self, num_layers, batch_size, num_heads, max_length, head_dim, dtype, device):
+        self.self_attn_key_values = torch.zeros(num_layers, 2, batch_size, num_heads, max_length, head_dim, dtype=dtype, device=device)
+        self.cross_attn_past_key_values = [None] * num_layers
+        self.max_length = max_length
+        self.length = 0 ## The number of decoder positions whose keys and values have been written so far.
+
+    def layer(self, layer_idx):
+        return MBartStaticCacheLayer(self, layer_idx)
+
+    def update(self, layer_idx, key_states, value_states):
+        """Writes the keys and values of the current decoder positions of a layer and returns the keys and values of all positions so far."""
+        new_length = self.length + key_states.size(2)
+        assert new_length <= self.max_length, f"The static cache can hold {self.max_length} positions but {new_length} are needed."
+        self.self_attn_key_values[layer_idx, 0, :, :, self.length:new_length] = key_states
+        self.self_attn_key_values[layer_idx, 1, :, :, self.length:new_length] = value_states
+        return self.self_attn_key_values[layer_idx, 0, :, :, :new_length], self.self_attn_key_values[layer_idx, 1, :, :, :new_length]
+
+    def reorder(self, beam_idx):
+        self.self_attn_key_values[:, :, :, :, :self.length] = self.self_attn_key_values[:, :, beam_idx, :, :self.length]
+        return self
+
+
+class MBartStaticCacheLayer:
+    """The part of a MBartStaticCache which belongs to a single decoder layer."""
+    def __init__(self, cache, layer_idx):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def update(self, key_states, value_states):
+        return self.cache.update(self.layer_idx, key_states, value_states)
+
+    @property
+    def cross_attn_past_key_value(self):
+        return self.cache.cross_attn_past_key_values[self.layer_idx]
+## Modified by Raj Dabre. End.
+
+
 # Copied from transformers.models.bart.modeling_bart.BartAttention with Bart->MBart
 class MBartAttention(nn.Module):
     """Multi-headed attention from 'Attention Is All You Need' paper"""
@@ -189,6 +264,8 @@ class MBartAttention(nn.Module):
         bias: bool = True,
         multi_source_method = None,
         no_scale_attention_embedding = False,
+        attention_implementation = "eager",
+        attention_chunk_size = 1024,
     ):
         super().__init__()
         self.embed_dim = embed_dim
@@ -216,11 +293,72 @@ class MBartAttention(nn.Module):
         else:
             self.multi_source = False
             self.multi_source_method = ""
+        if attention_implementation == "sdpa" and not hasattr(F, "scaled_dot_product_attention"): ## Older versions of pytorch dont have the fused kernel so we fall back to the chunked attention which also avoids materializing the full attention weights.
+            attention_implementation = "chunked"
+        self.attention_implementation = attention_implementation
+        self.attention_chunk_size = attention_chunk_size
         ## Modified by Raj Dabre. End.
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
 
+    ## Modified by Raj Dabre. Start.
+    def _attend(self, query_states, key_states, attention_mask, value_states):
+        """Attention over a (chunk of the) query without any fused kernel. The query is already scaled."""
+        attn_weights = torch.matmul(query_states, key_states.transpose(-1, -2))
+        if attention_mask is not None:
+            attn_weights = attn_weights + attention_mask
+        attn_weights = F.softmax(attn_weights, dim=-1)
+        attn_probs = F.dropout(attn_weights, p=self.dropout, training=self.training)
+        return torch.matmul(attn_probs, value_states)
+
+    def _fused_attention(self, query_states, key_states, attention_mask, value_states, layer_head_mask):
+        """Computes attention without keeping the attention weights of all queries in memory at once.
+        With the sdpa implementation, torch.nn.functional.scaled_dot_product_attention picks a fused (flash or memory efficient) kernel where possible.
+        With the chunked implementation, the queries are processed attention_chunk_size at a time and, during training, the attention weights of each chunk are recomputed in the backward pass instead of being stored.
+        The attention mask (including the wait-k masks from _expand_mask) is additive and of size (bsz, 1, tgt_len, src_len). All other tensors are of size (bsz, num_heads, len, head_dim).
+        Returns the attention output of size (bsz * num_heads, tgt_len, head_dim) just like the original attention.
+        """
+        bsz, _, tgt_len, _ = query_states.size()
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(query_states.dtype)
+        if self.attention_implementation == "sdpa":
+            query_states = query_states * math.sqrt(self.head_dim) ## The query is already scaled but scaled_dot_product_attention scales it again by 1/sqrt(head_dim). Its scale argument only exists from pytorch 2.1 so we undo our scaling instead.
+            attn_output = F.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask=attention_mask, dropout_p=self.dropout if self.training else 0.0)
+        else:
+            attn_outputs = []
+            for chunk_start in range(0, tgt_len, self.attention_chunk_size):
+                query_chunk = query_states[:, :, chunk_start:chunk_start+self.attention_chunk_size]
+                mask_chunk = attention_mask[:, :, chunk_start:chunk_start+self.attention_chunk_size] if attention_mask is not None else None
+                if self.training and torch.is_grad_enabled():
+                    attn_outputs.append(torch.utils.checkpoint.checkpoint(self._attend, query_chunk, key_states, mask_chunk, value_states, **CHECKPOINT_KWARGS))
+                else:
+                    attn_outputs.append(self._attend(query_chunk, key_states, mask_chunk, value_states))
+            attn_output = torch.cat(attn_outputs, dim=2)
+        if layer_head_mask is not None: ## Scaling the attention weights of a head is the same as scaling its output.
+            assert layer_head_mask.size() == (
+                self.num_heads,
+            ), f"Head mask for a single layer should be of size {(self.num_heads,)}, but is {layer_head_mask.size()}"
+            attn_output = layer_head_mask.view(1, -1, 1, 1) * attn_output
+        return attn_output.reshape(bsz * self.num_heads, tgt_len, self.head_dim)
+
+    def _share_mask_across_beams(self, attention_mask, num_sources, num_beams):
+        """Converts a cross attention mask of size (num_sources or num_sources * num_beams, 1, tgt_len, src_len) into a mask of size (num_sources, 1, num_beams * tgt_len, src_len) where the beams of each source sentence are one long query."""
+        if attention_mask is None:
+            return None
+        _, _, tgt_len, src_len = attention_mask.size()
+        if attention_mask.size(0) == num_sources:
+            attention_mask = attention_mask.unsqueeze(1).expand(num_sources, num_beams, 1, tgt_len, src_len)
+        return attention_mask.reshape(num_sources, 1, num_beams * tgt_len, src_len)
+
+    def _unshare_attention_weights_across_beams(self, attn_weights, num_beams):
+        """The inverse of _share_mask_across_beams for the attention weights which are returned when output_attentions is set."""
+        if attn_weights is None:
+            return None
+        num_sources, num_heads, tgt_len, src_len = attn_weights.size()
+        return attn_weights.view(num_sources, num_heads, num_beams, tgt_len // num_beams, src_len).transpose(1, 2).reshape(num_sources * num_beams, num_heads, tgt_len // num_beams, src_len)
+    ## Modified by Raj Dabre. End.
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -232,6 +370,7 @@ class MBartAttention(nn.Module):
         additional_attention_mask: Optional[torch.Tensor] = None,
         layer_head_mask: Optional[torch.Tensor] = None,
         output_attentions: bool = False,
+        use_cache: bool = False,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         """Input shape: Batch x Time x Channel"""
 
@@ -254,13 +393,18 @@ class MBartAttention(nn.Module):
         ## Modified by Raj Dabre. Enf.
         elif is_cross_attention:
             # cross_attentions
-            key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
-            value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
             ## Modified by Raj Dabre. Start.
+            key_states = self._shape(self.k_proj(key_value_states), -1, key_value_states.size(0)) ## The encoder outputs may have fewer sentences than the decoder when they are shared by beams.
+            value_states = self._shape(self.v_proj(key_value_states), -1, key_value_states.size(0))
             if self.multi_source: # additional_past_key_value is not None
-                additional_key_states = self._shape(self.k_proj(additional_key_value_states), -1, bsz)
-                additional_value_states = self._shape(self.v_proj(additional_key_value_states), -1, bsz)
+                additional_key_states = self._shape(self.k_proj(additional_key_value_states), -1, additional_key_value_states.size(0))
+                additional_value_states = self._shape(self.v_proj(additional_key_value_states), -1, additional_key_value_states.size(0))
             ## Modified by Raj Dabre. End.
+        ## Modified by Raj Dabre. Start.
+        elif isinstance(past_key_value, MBartStaticCacheLayer):
+            # write k, v into the preallocated cache and reuse all k, v so far, self_attention
+            key_states, value_states = past_key_value.update(self._shape(self.k_proj(hidden_states), -1, bsz), self._shape(self.v_proj(hidden_states), -1, bsz))
+        ## Modified by Raj Dabre. End.
         elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
@@ -272,7 +416,7 @@ class MBartAttention(nn.Module):
             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
             value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
 
-        if self.is_decoder:
+        if self.is_decoder or use_cache: ## Raj: A unidirectional encoder also caches its keys and values when it reads the source incrementally.
             # if cross_attention save Tuple(torch.Tensor, torch.Tensor) of all cross attention key/value_states.
             # Further calls to cross_attention layer can then reuse all cross-attention
             # key/value_states (first "if" case)
@@ -285,107 +429,129 @@ class MBartAttention(nn.Module):
             if self.multi_source and is_cross_attention: ## Both conditions are not needed as one multi-source logic can only run when there is cross attention. multi_source is sufficient but keeping this condition for checking.
                 additional_past_key_value = (additional_key_states, additional_value_states)
             ## Modified by Raj Dabre. End.
-        proj_shape = (bsz * self.num_heads, -1, self.head_dim)
-        query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
-        key_states = key_states.view(*proj_shape)
-        value_states = value_states.view(*proj_shape)
-
-        src_len = key_states.size(1)
-        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
-        assert attn_weights.size() == (
-            bsz * self.num_heads,
-            tgt_len,
-            src_len,
-        ), f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is {attn_weights.size()}"
-        
-        if attention_mask is not None:
-            assert attention_mask.size() == (
-                bsz,
-                1,
-                tgt_len,
-                src_len,
-            ), f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}"
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attention_mask
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
-
-        attn_weights = F.softmax(attn_weights, dim=-1)
         ## Modified by Raj Dabre. Start.
-        if self.multi_source:
-            additional_key_states = additional_key_states.view(*proj_shape)
-            additional_value_states = additional_value_states.view(*proj_shape)
-            additional_src_len = additional_key_states.size(1)
-            additional_attn_weights = torch.bmm(query_states, additional_key_states.transpose(1, 2))
-            assert additional_attn_weights.size() == (
+        num_beams = 1
+        if is_cross_attention and key_states.size(0) != bsz: ## The encoder outputs and the cross attention keys and values are computed once per source sentence and shared by its consecutive beams (see generate). The beams of a sentence then attend as one longer query so that the keys and values are never copied for each beam.
+            num_beams = bsz // key_states.size(0)
+            bsz, tgt_len = key_states.size(0), num_beams * tgt_len
+            query_states = query_states.view(bsz, tgt_len, embed_dim)
+            attention_mask = self._share_mask_across_beams(attention_mask, bsz, num_beams)
+            if self.multi_source:
+                additional_attention_mask = self._share_mask_across_beams(additional_attention_mask, bsz, num_beams)
+        if self.attention_implementation != "eager" and not output_attentions: ## The fused or chunked attention never materializes the full attention weights so they cant be returned.
+            query_states = self._shape(query_states, tgt_len, bsz)
+            attn_output = self._fused_attention(query_states, key_states, attention_mask, value_states, layer_head_mask)
+            attn_weights_reshaped = None
+            if self.multi_source:
+                additional_attn_output = self._fused_attention(query_states, additional_key_states, additional_attention_mask, additional_value_states, layer_head_mask)
+                additional_attn_weights_reshaped = None
+        ## Modified by Raj Dabre. End.
+        else: ## The original attention which materializes the full attention weights.
+            proj_shape = (bsz * self.num_heads, -1, self.head_dim)
+            query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
+            key_states = key_states.view(*proj_shape)
+            value_states = value_states.view(*proj_shape)
+
+            src_len = key_states.size(1)
+            attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+            assert attn_weights.size() == (
                 bsz * self.num_heads,
                 tgt_len,
-                additional_src_len,
-            ), f"Additional attention weights should be of size {(bsz * self.num_heads, tgt_len, additional_src_len)}, but is {additional_attn_weights.size()}"
-            if additional_attention_mask is not None:
-                assert additional_attention_mask.size() == (
+                src_len,
+            ), f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is {attn_weights.size()}"
+        
+            if attention_mask is not None:
+                assert attention_mask.size() == (
                     bsz,
                     1,
                     tgt_len,
-                    additional_src_len,
-                ), f"Attention mask should be of size {(bsz, 1, tgt_len, additional_src_len)}, but is {additional_attention_mask.size()}"
-                additional_attn_weights = additional_attn_weights.view(bsz, self.num_heads, tgt_len, additional_src_len) + additional_attention_mask
-                additional_attn_weights = additional_attn_weights.view(bsz * self.num_heads, tgt_len, additional_src_len)
+                    src_len,
+                ), f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}"
+                attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attention_mask
+                attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
 
-            additional_attn_weights = F.softmax(additional_attn_weights, dim=-1)
-        ## Modified by Raj Dabre. End.
-        
-        if layer_head_mask is not None:
-            assert layer_head_mask.size() == (
-                self.num_heads,
-            ), f"Head mask for a single layer should be of size {(self.num_heads,)}, but is {layer_head_mask.size()}"
-            attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights = F.softmax(attn_weights, dim=-1)
             ## Modified by Raj Dabre. Start.
             if self.multi_source:
-                additional_attn_weights = layer_head_mask.view(1, -1, 1, 1) * additional_attn_weights.view(bsz, self.num_heads, tgt_len, additional_src_len)
-                additional_attn_weights = additional_attn_weights.view(bsz * self.num_heads, tgt_len, additional_src_len)
+                additional_key_states = additional_key_states.view(*proj_shape)
+                additional_value_states = additional_value_states.view(*proj_shape)
+                additional_src_len = additional_key_states.size(1)
+                additional_attn_weights = torch.bmm(query_states, additional_key_states.transpose(1, 2))
+                assert additional_attn_weights.size() == (
+                    bsz * self.num_heads,
+                    tgt_len,
+                    additional_src_len,
+                ), f"Additional attention weights should be of size {(bsz * self.num_heads, tgt_len, additional_src_len)}, but is {additional_attn_weights.size()}"
+                if additional_attention_mask is not None:
+                    assert additional_attention_mask.size() == (
+                        bsz,
+                        1,
+                        tgt_len,
+                        additional_src_len,
+                    ), f"Attention mask should be of size {(bsz, 1, tgt_len, additional_src_len)}, but is {additional_attention_mask.size()}"
+                    additional_attn_weights = additional_attn_weights.view(bsz, self.num_heads, tgt_len, additional_src_len) + additional_attention_mask
+                    additional_attn_weights = additional_attn_weights.view(bsz * self.num_heads, tgt_len, additional_src_len)
+
+                additional_attn_weights = F.softmax(additional_attn_weights, dim=-1)
             ## Modified by Raj Dabre. End.
+        
+            if layer_head_mask is not None:
+                assert layer_head_mask.size() == (
+                    self.num_heads,
+                ), f"Head mask for a single layer should be of size {(self.num_heads,)}, but is {layer_head_mask.size()}"
+                attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+                attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+                ## Modified by Raj Dabre. Start.
+                if self.multi_source:
+                    additional_attn_weights = layer_head_mask.view(1, -1, 1, 1) * additional_attn_weights.view(bsz, self.num_heads, tgt_len, additional_src_len)
+                    additional_attn_weights = additional_attn_weights.view(bsz * self.num_heads, tgt_len, additional_src_len)
+                ## Modified by Raj Dabre. End.
             
-        if output_attentions:
-            # this operation is a bit akward, but it's required to
-            # make sure that attn_weights keeps its gradient.
-            # In order to do so, attn_weights have to reshaped
-            # twice and have to be reused in the following
-            attn_weights_reshaped = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            attn_weights = attn_weights_reshaped.view(bsz * self.num_heads, tgt_len, src_len)
-            ## Modified by Raj Dabre. Start.
-            if self.multi_source:
-                additional_attn_weights_reshaped = additional_attn_weights.view(bsz, self.num_heads, tgt_len, additional_src_len)
-                additional_attn_weights = additional_attn_weights_reshaped.view(bsz * self.num_heads, tgt_len, additional_src_len)
-            ## Modified by Raj Dabre. End.
+            if output_attentions:
+                # this operation is a bit akward, but it's required to
+                # make sure that attn_weights keeps its gradient.
+                # In order to do so, attn_weights have to reshaped
+                # twice and have to be reused in the following
+                attn_weights_reshaped = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+                attn_weights = attn_weights_reshaped.view(bsz * self.num_heads, tgt_len, src_len)
+                ## Modified by Raj Dabre. Start.
+                if self.multi_source:
+                    additional_attn_weights_reshaped = additional_attn_weights.view(bsz, self.num_heads, tgt_len, additional_src_len)
+                    additional_attn_weights = additional_attn_weights_reshaped.view(bsz * self.num_heads, tgt_len, additional_src_len)
+                ## Modified by Raj Dabre. End.
             
-        else:
-            attn_weights_reshaped = None
-            ## Modified by Raj Dabre. Start.
-            if self.multi_source:
-                additional_attn_weights_reshaped = None
-            ## Modified by Raj Dabre. End.
+            else:
+                attn_weights_reshaped = None
+                ## Modified by Raj Dabre. Start.
+                if self.multi_source:
+                    additional_attn_weights_reshaped = None
+                ## Modified by Raj Dabre. End.
         
-        attn_probs = F.dropout(attn_weights, p=self.dropout, training=self.training)
+            attn_probs = F.dropout(attn_weights, p=self.dropout, training=self.training)
 
-        attn_output = torch.bmm(attn_probs, value_states)
-        
-        assert attn_output.size() == (
-            bsz * self.num_heads,
-            tgt_len,
-            self.head_dim,
-        ), f"`attn_output` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is {attn_output.size()}"
+            attn_output = torch.bmm(attn_probs, value_states)
         
-        ## Modified by Raj Dabre. Start.
-        if self.multi_source:
-            additional_attn_probs = F.dropout(additional_attn_weights, p=self.dropout, training=self.training)
-
-            additional_attn_output = torch.bmm(additional_attn_probs, additional_value_states)
-
-            assert additional_attn_output.size() == (
+            assert attn_output.size() == (
                 bsz * self.num_heads,
                 tgt_len,
                 self.head_dim,
-            ), f"`attn_output` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is {additional_attn_output.size()}"
+            ), f"`attn_output` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is {attn_output.size()}"
+        
+            ## Modified by Raj Dabre. Start.
+            if self.multi_source:
+                additional_attn_probs = F.dropout(additional_attn_weights, p=self.dropout, training=self.training)
+
+                additional_attn_output = torch.bmm(additional_attn_probs, additional_value_states)
+
+                assert additional_attn_output.size() == (
+                    bsz * self.num_heads,
+                    tgt_len,
+                    self.head_dim,
+                ), f"`attn_output` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is {additional_attn_output.size()}"
+            ## Modified by Raj Dabre. End.
+
+        ## Modified by Raj Dabre. Start.
+        if self.multi_source:
             if self.multi_source_method == "merge_after_attention" or self.multi_source_method == "self_relevance_and_merge_after_attention":
                 attentions_merged = torch.cat([attn_output, additional_attn_output], -1) ## Concatenate along hidden axis.
                 gating_weight = torch.sigmoid(self.gating_layer(attentions_merged)) ## Compute gating weight.
@@ -402,6 +568,14 @@ class MBartAttention(nn.Module):
             .reshape(bsz, tgt_len, embed_dim)
         )
 
+        ## Modified by Raj Dabre. Start.
+        if num_beams > 1: ## Split the beams of each source sentence again.
+            attn_output = attn_output.view(bsz * num_beams, tgt_len // num_beams, embed_dim)
+            attn_weights_reshaped = self._unshare_attention_weights_across_beams(attn_weights_reshaped, num_beams)
+            if self.multi_source:
+                additional_attn_weights_reshaped = self._unshare_attention_weights_across_beams(additional_attn_weights_reshaped, num_beams)
+        ## Modified by Raj Dabre. End.
+
         attn_output = self.out_proj(attn_output)
         
         ## Modified by Raj Dabre. Start.
@@ -420,6 +594,8 @@ class MBartEncoderLayer(nn.Module):
             num_heads=config.encoder_attention_heads,
             dropout=config.attention_dropout,
             no_scale_attention_embedding=config.no_scale_attention_embedding,
+            attention_implementation=config.attention_implementation,
+            attention_chunk_size=config.attention_chunk_size,
         ) ## An if else condition to either return the sann or a FFT. The FFT will be implemented via a method which pre-generates a bunch of matrices and returns a closure which uses the right matrix during runtime. 
         self.self_attn_layer_norm = nn.LayerNorm(self.embed_dim)
         self.dropout = config.dropout
@@ -435,6 +611,8 @@ class MBartEncoderLayer(nn.Module):
         attention_mask: torch.Tensor,
         layer_head_mask: torch.Tensor,
         output_attentions: bool = False,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        use_cache: bool = False,
     ):
         """
         Args:
@@ -446,15 +624,23 @@ class MBartEncoderLayer(nn.Module):
             output_attentions (:obj:`bool`, `optional`):
                 Whether or not to return the attentions tensors of all attention layers. See ``attentions`` under
                 returned tensors for more detail.
+            past_key_value (:obj:`Tuple(torch.FloatTensor)`): cached past key and value projection states of the
+                previous source tokens. Only valid for a unidirectional encoder.
+            use_cache (:obj:`bool`, `optional`):
+                Whether or not to return the key and value projection states of all source tokens so far.
         """
         residual = hidden_states
         hidden_states = self.self_attn_layer_norm(hidden_states)
-        hidden_states, attn_weights, _ = self.self_attn(
+        ## Modified by Raj Dabre. Start.
+        hidden_states, attn_weights, present_key_value = self.self_attn(
             hidden_states=hidden_states,
+            past_key_value=past_key_value,
             attention_mask=attention_mask,
             layer_head_mask=layer_head_mask,
             output_attentions=output_attentions,
+            use_cache=use_cache,
         )
+        ## Modified by Raj Dabre. End.
         hidden_states = F.dropout(hidden_states, p=self.dropout, training=self.training)
         hidden_states = residual + hidden_states
 
@@ -475,6 +661,11 @@ class MBartEncoderLayer(nn.Module):
         if output_attentions:
             outputs += (attn_weights,)
 
+        ## Modified by Raj Dabre. Start.
+        if use_cache:
+            outputs += (present_key_value,)
+        ## Modified by Raj Dabre. End.
+
         return outputs
 
 
@@ -489,6 +680,8 @@ class MBartDecoderLayer(nn.Module):
             dropout=config.attention_dropout,
             is_decoder=True,
             no_scale_attention_embedding=config.no_scale_attention_embedding,
+            attention_implementation=config.attention_implementation,
+            attention_chunk_size=config.attention_chunk_size,
         )
         self.dropout = config.dropout
         self.activation_fn = ACT2FN[config.activation_function]
@@ -502,6 +695,8 @@ class MBartDecoderLayer(nn.Module):
             is_decoder=True,
             multi_source_method=config.multi_source_method,
             no_scale_attention_embedding=config.no_scale_attention_embedding,
+            attention_implementation=config.attention_implementation,
+            attention_chunk_size=config.attention_chunk_size,
         )
         self.encoder_attn_layer_norm = nn.LayerNorm(self.embed_dim)
         self.fc1 = nn.Linear(self.embed_dim, config.decoder_ffn_dim)
@@ -544,7 +739,13 @@ class MBartDecoderLayer(nn.Module):
 
         # Self Attention
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
-        self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
+        ## Modified by Raj Dabre. Start.
+        if isinstance(past_key_value, MBartStaticCacheLayer): ## The self attention writes into the static cache and the cross attention reuses the cached keys and values, if any.
+            self_attn_past_key_value = past_key_value
+            past_key_value = past_key_value.cross_attn_past_key_value
+        else:
+            self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
+        ## Modified by Raj Dabre. End.
         # add present self-attn cache to positions 1,2 of present_key_value tuple
         #print(attention_mask.size() if attention_mask is not None else 1, encoder_attention_mask.size() if encoder_attention_mask is not None else 1, additional_encoder_attention_mask.size() if additional_encoder_attention_mask is not None else 1)
         hidden_states, self_attn_weights, present_key_value = self.self_attn(
@@ -903,6 +1104,8 @@ class MBartEncoder(MBartPreTrainedModel):
         features_ids=None, ### A tuple or list of feature ids. Each should have the same dimension as input_ids
         additional_input_ids=None, ## Placeholder argument. Wont be used.
         additional_input_ids_mask=None, ## Placeholder argument. Wont be used.
+        past_key_values=None,
+        use_cache=None,
     ):
         r"""
         Args:
@@ -940,6 +1143,16 @@ class MBartEncoder(MBartPreTrainedModel):
                 for more detail.
             return_dict (:obj:`bool`, `optional`):
                 Whether or not to return a :class:`~transformers.file_utils.ModelOutput` instead of a plain tuple.
+            past_key_values (:obj:`Tuple[Tuple[torch.FloatTensor]]` of length :obj:`config.encoder_layers` with each tuple having 2 tensors of shape :obj:`(batch_size, num_heads, past_sequence_length, embed_size_per_head)`, `optional`):
+                The self attention keys and values of the source tokens encoded so far, as returned by a previous call
+                with :obj:`use_cache=True`. Only the new source tokens should then be passed as :obj:`input_ids` and
+                only their hidden states are returned. The :obj:`attention_mask`, if given, covers the past and the
+                new tokens. This needs a unidirectional encoder (:obj:`config.wait_k` or
+                :obj:`config.unidirectional_encoder`) because then the states of the earlier tokens never depend on
+                the later ones.
+            use_cache (:obj:`bool`, `optional`):
+                If set to :obj:`True`, the :obj:`past_key_values` of all source tokens so far are returned and can be
+                used to encode the next source tokens of a stream incrementally.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -958,6 +1171,15 @@ class MBartEncoder(MBartPreTrainedModel):
         else:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
+        ## Modified by Raj Dabre. Start.
+        is_unidirectional = self.config.wait_k != -1 or self.config.unidirectional_encoder
+        if (use_cache or past_key_values is not None) and not is_unidirectional:
+            raise ValueError("The encoder can only be run incrementally with past_key_values if it is unidirectional. Set the wait_k or the unidirectional_encoder of the config.")
+        past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        if attention_mask is None and (use_cache or past_key_values is not None): ## Without a mask the encoder would not be unidirectional.
+            attention_mask = torch.ones(input_shape[0], past_key_values_length + input_shape[-1], dtype=torch.long, device=input_ids.device if input_ids is not None else inputs_embeds.device)
+        ## Modified by Raj Dabre. End.
+
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
             ## Modified by Raj Dabre. Start.
@@ -968,7 +1190,7 @@ class MBartEncoder(MBartPreTrainedModel):
             ## Modified by Raj Dabre. End.
             
 
-        embed_pos = self.embed_positions(input_shape)
+        embed_pos = self.embed_positions(input_shape, past_key_values_length)
 
         hidden_states = inputs_embeds + embed_pos
         if not self.config.no_embed_norm:
@@ -979,11 +1201,15 @@ class MBartEncoder(MBartPreTrainedModel):
         # expand attention_mask
         if attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-            attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype, wait_k=1 if self.config.wait_k!=-1 or self.config.unidirectional_encoder else -1) ## Raj: Just make the mask wait-k with a k=1 and we are good to go. We want to have a unidirectional encoder no matter what.
-        ## Modified by Raj Dabre. End.
+            if past_key_values_length > 0: ## The new tokens see the past tokens and the new tokens up to themselves. This is the wait-1 mask at a decoding length of past_key_values_length+1.
+                attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1], wait_k=1, curr_decode_length=past_key_values_length+1)
+            else:
+                attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype, wait_k=1 if is_unidirectional else -1) ## Raj: Just make the mask wait-k with a k=1 and we are good to go. We want to have a unidirectional encoder no matter what.
 
         encoder_states = () if output_hidden_states else None
         all_attentions = () if output_attentions else None
+        next_encoder_cache = () if use_cache else None
+        ## Modified by Raj Dabre. End.
 
         # check if head_mask has a correct number of layers specified if desired
         if head_mask is not None:
@@ -1018,12 +1244,18 @@ class MBartEncoder(MBartPreTrainedModel):
                         attention_mask,
                         layer_head_mask=(head_mask[idx] if head_mask is not None else None),
                         output_attentions=output_attentions,
+                        past_key_value=past_key_values[idx] if past_key_values is not None else None, ## Modified by Raj Dabre.
+                        use_cache=use_cache, ## Modified by Raj Dabre.
                     )
 
                 hidden_states = layer_outputs[0]
 
             if output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
+            ## Modified by Raj Dabre. Start.
+            if use_cache:
+                next_encoder_cache += (layer_outputs[2 if output_attentions else 1],)
+            ## Modified by Raj Dabre. End.
         
         ## Modified by Raj Dabre. Start.
         if self.config.multi_source_method == "self_relevance_and_merge_after_attention" or self.config.multi_source_method == "self_relevance_and_merge_before_attention" or self.config.multi_source_method == "self_relevance_and_merge_after_attention_with_context_relevance_only":
@@ -1035,6 +1267,14 @@ class MBartEncoder(MBartPreTrainedModel):
         if output_hidden_states:
             encoder_states = encoder_states + (hidden_states,)
 
+        ## Modified by Raj Dabre. Start.
+        if use_cache: ## The past is only returned when asked for so that the outputs of the encoder stay the same for everyone else.
+            if not return_dict:
+                return tuple(v for v in [hidden_states, next_encoder_cache, encoder_states, all_attentions] if v is not None)
+            return BaseModelOutputWithPast(
+                last_hidden_state=hidden_states, past_key_values=next_encoder_cache, hidden_states=encoder_states, attentions=all_attentions
+            )
+        ## Modified by Raj Dabre. End.
         if not return_dict:
             return tuple(v for v in [hidden_states, encoder_states, all_attentions] if v is not None)
         return BaseModelOutput(
@@ -1099,6 +1339,36 @@ class MBartDecoder(MBartPreTrainedModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
+    ## Modified by Raj Dabre. Start.
+    def _skipped_layer_past_key_value(self, layer_idx, hidden_states, past_key_value, static_cache, encoder_hidden_states):
+        """This method computes the self attention keys and values of a layer which was skipped by an early exit, as if the hidden states of the exit layer had been its input. The cross attention keys and values are reused if they were cached and computed otherwise. Returns the past key value of the layer, which is also written into the static cache if there is one."""
+        decoder_layer = self.layers[layer_idx]
+        self_attn = decoder_layer.self_attn
+        normalized_hidden_states = decoder_layer.self_attn_layer_norm(hidden_states)
+        key_states = self_attn._shape(self_attn.k_proj(normalized_hidden_states), -1, hidden_states.size(0))
+        value_states = self_attn._shape(self_attn.v_proj(normalized_hidden_states), -1, hidden_states.size(0))
+        if static_cache is not None:
+            key_states, value_states = static_cache.update(layer_idx, key_states, value_states)
+            cross_attn_past_key_value = static_cache.cross_attn_past_key_values[layer_idx]
+        elif past_key_value is not None:
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+            cross_attn_past_key_value = past_key_value[2:]
+        else:
+            cross_attn_past_key_value = None
+        if cross_attn_past_key_value is None and encoder_hidden_states is not None: ## The first decoding step exited before reaching this layer.
+            encoder_attn = decoder_layer.encoder_attn
+            cross_attn_past_key_value = (encoder_attn._shape(encoder_attn.k_proj(encoder_hidden_states), -1, encoder_hidden_states.size(0)), encoder_attn._shape(encoder_attn.v_proj(encoder_hidden_states), -1, encoder_hidden_states.size(0)))
+            if static_cache is not None:
+                static_cache.cross_attn_past_key_values[layer_idx] = cross_attn_past_key_value
+        return (key_states, value_states) + (tuple(cross_attn_past_key_value) if cross_attn_past_key_value is not None else ())
+
+    def init_static_cache(self, batch_size, max_length):
+        """Allocates a MBartStaticCache which can be passed as past_key_values to decode up to max_length positions."""
+        num_heads = self.config.decoder_attention_heads
+        return MBartStaticCache(len(self.layers), batch_size, num_heads, max_length, self.config.d_model // num_heads, self.embed_tokens.weight.dtype, self.embed_tokens.weight.device)
+    ## Modified by Raj Dabre. End.
+
     # Copied from transformers.models.bart.modeling_bart.BartDecoder._prepare_decoder_attention_mask
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
         # create causal mask
@@ -1135,6 +1405,7 @@ class MBartDecoder(MBartPreTrainedModel):
         additional_encoder_hidden_states=None,
         additional_encoder_attention_mask=None,
         curr_decode_length=-1,
+        early_exit_fn=None,
     ):
         r"""
         Args:
@@ -1218,7 +1489,13 @@ class MBartDecoder(MBartPreTrainedModel):
             raise ValueError("You have to specify either decoder_input_ids or decoder_inputs_embeds")
 
         # past_key_values_length
-        past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        ## Modified by Raj Dabre. Start.
+        static_cache = past_key_values if isinstance(past_key_values, MBartStaticCache) else None
+        if static_cache is not None:
+            past_key_values_length = static_cache.length
+        else:
+            past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        ## Modified by Raj Dabre. End.
 
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
@@ -1266,6 +1543,7 @@ class MBartDecoder(MBartPreTrainedModel):
             assert head_mask.size()[0] == (
                 len(self.layers)
             ), f"The head_mask should be specified for {len(self.layers)} layers, but it is for {head_mask.size()[0]}."
+        exited_early = False
         for idx, decoder_layer in enumerate(self.layers):
             # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
             if output_hidden_states:
@@ -1274,7 +1552,12 @@ class MBartDecoder(MBartPreTrainedModel):
             if self.training and (dropout_probability < self.layerdrop):
                 continue
 
-            past_key_value = past_key_values[idx] if past_key_values is not None else None
+            ## Modified by Raj Dabre. Start.
+            if static_cache is not None:
+                past_key_value = static_cache.layer(idx)
+            else:
+                past_key_value = past_key_values[idx] if past_key_values is not None else None
+            ## Modified by Raj Dabre. End.
 
             if getattr(self.config, "gradient_checkpointing", False) and self.training:
 
@@ -1325,6 +1608,8 @@ class MBartDecoder(MBartPreTrainedModel):
                     next_decoder_cache += (layer_outputs[4 if output_attentions else 1],)
                 else:
                     next_decoder_cache += (layer_outputs[3 if output_attentions else 1],)
+                if static_cache is not None and static_cache.cross_attn_past_key_values[idx] is None and encoder_hidden_states is not None: ## The cross attention keys and values computed in the first step are kept for the following steps.
+                    static_cache.cross_attn_past_key_values[idx] = next_decoder_cache[-1][2:]
             ## Modified by Raj Dabre. End.
             
             if output_attentions:
@@ -1336,8 +1621,19 @@ class MBartDecoder(MBartPreTrainedModel):
                     if self.config.multi_source_method == "merge_after_attention" or self.config.multi_source_method == "self_relevance_and_merge_after_attention" or self.config.multi_source_method == "merge_after_attention_with_context_relevance_only" or self.config.multi_source_method == "self_relevance_and_merge_after_attention_with_context_relevance_only":
                         additional_all_cross_attentions += (layer_outputs[3],)
                     ## Modified by Raj Dabre. End.
+            
+            ## Modified by Raj Dabre. Start.
+            if early_exit_fn is not None and idx < len(self.layers) - 1 and early_exit_fn(hidden_states, idx): ## The softmax of this layer is confident enough so the remaining layers are skipped. Later positions still attend to the current ones in the skipped layers so their keys and values are computed from the hidden states of this layer.
+                for skipped_idx in range(idx + 1, len(self.layers)):
+                    skipped_past_key_value = self._skipped_layer_past_key_value(skipped_idx, hidden_states, None if static_cache is not None or past_key_values is None else past_key_values[skipped_idx], static_cache, encoder_hidden_states)
+                    if use_cache:
+                        next_decoder_cache += (skipped_past_key_value,)
+                exited_early = True
+                break
+            ## Modified by Raj Dabre. End.
                     
-        hidden_states = self.layer_norm(hidden_states)
+        if not exited_early: ## The intermediate softmaxes of multilayer softmaxing are computed without the final layer norm.
+            hidden_states = self.layer_norm(hidden_states)
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
@@ -1345,6 +1641,9 @@ class MBartDecoder(MBartPreTrainedModel):
 
         next_cache = next_decoder_cache if use_cache else None
         ## Modified by Raj Dabre. Start.
+        if static_cache is not None:
+            static_cache.length += input_shape[-1]
+            next_cache = static_cache
         if not return_dict:
             if self.config.multi_source_method == "merge_after_attention" or self.config.multi_source_method == "self_relevance_and_merge_after_attention" or self.config.multi_source_method == "merge_after_attention_with_context_relevance_only" or self.config.multi_source_method == "self_relevance_and_merge_after_attention_with_context_relevance_only":
                 return tuple(
@@ -1432,6 +1731,7 @@ class MBartModel(MBartPreTrainedModel):
         additional_encoder_outputs=None,
         context_encoder_representations=None,
         curr_decode_length=-1,
+        early_exit_fn=None,
     ):
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1527,6 +1827,7 @@ class MBartModel(MBartPreTrainedModel):
             additional_encoder_hidden_states=additional_encoder_outputs[0],
             additional_encoder_attention_mask=additional_input_ids_mask,
             curr_decode_length=curr_decode_length,
+            early_exit_fn=early_exit_fn,
         )
 
         if not return_dict:
@@ -1598,6 +1899,14 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
         self.lm_head = nn.Linear(config.d_model, self.model.shared.num_embeddings, bias=False)
         
         self.init_weights()
+        ## Modified by Raj Dabre. Start.
+        self.vocabulary_shortlist = None ## The token ids to which the output projection is restricted at decode time. See set_vocabulary_shortlist.
+        self.shortlist_lm_head_weight = None
+        self.shortlist_logits_bias = None
+        self.early_exit = None ## The criterion and threshold for exiting the decoder early at decode time. See set_early_exit.
+        self.early_exit_num_layers_used = 0 ## The decoder layers used and the decoder calls made while early exit was on. Their ratio is the average number of layers used per token.
+        self.early_exit_num_steps = 0
+        ## Modified by Raj Dabre. End.
         if config.temperature_calibration:
             assert config.softmax_temperature == 1.0
             print("Temperature calibration will be done.")
@@ -1635,6 +1944,72 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
     def set_output_embeddings(self, new_embeddings):
         self.lm_head = new_embeddings
 
+    ## Modified by Raj Dabre. Start.
+    def set_vocabulary_shortlist(self, vocabulary_shortlist):
+        """This method restricts the output projection to the token ids in vocabulary_shortlist (a 1D LongTensor) till it is called again with None. The rows of the lm head and the final logits bias for these tokens are sliced once here so that each decoding step only projects onto the shortlist instead of the whole vocabulary. The logits of all other tokens are -inf. A shortlist is meant for decoding only since the softmax is normalized over the shortlist."""
+        if vocabulary_shortlist is None:
+            self.vocabulary_shortlist = None
+            self.shortlist_lm_head_weight = None
+            self.shortlist_logits_bias = None
+            return
+        lm_head_weight = self.lm_head.weight() if callable(self.lm_head.weight) else self.lm_head.weight ## Dynamically quantized linear layers return their weight via a method.
+        if lm_head_weight.is_quantized:
+            lm_head_weight = lm_head_weight.dequantize()
+        self.vocabulary_shortlist = vocabulary_shortlist.to(lm_head_weight.device)
+        self.shortlist_lm_head_weight = lm_head_weight.detach().index_select(0, self.vocabulary_shortlist)
+        self.shortlist_logits_bias = self.final_logits_bias.index_select(1, self.vocabulary_shortlist)
+
+    def compute_lm_logits(self, hidden_states):
+        """This method projects the decoder hidden states onto the vocabulary (or onto the shortlist if one is set) and divides the logits by the softmax temperature of the config."""
+        if self.vocabulary_shortlist is None:
+            return (self.lm_head(hidden_states) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
+        shortlist_logits = (F.linear(hidden_states, self.shortlist_lm_head_weight) + self.shortlist_logits_bias)/self.config.softmax_temperature
+        lm_logits = shortlist_logits.new_full(shortlist_logits.size()[:-1] + (self.final_logits_bias.size(1),), -float("inf"))
+        return lm_logits.index_copy_(lm_logits.dim() - 1, self.vocabulary_shortlist, shortlist_logits) ## Map the shortlist logits back to their token ids.
+
+    def set_early_exit(self, threshold, criterion="confidence"):
+        """This method makes the decoder exit after the first layer whose softmax is confident enough till it is called again with a threshold of None. This needs a model trained with multilayer softmaxing so that the lm head works for the intermediate layers. The criterion is either confidence, in which case the highest probability must be at least the threshold, or entropy, in which case the entropy must be at most the threshold. The decision is made for the whole batch (all beams of all sentences) so that the remaining layers can be skipped, which means that decoding with small batches saves the most. The keys and values of the skipped layers are computed from the hidden states of the exit layer so that later tokens can attend to them."""
+        if threshold is None:
+            self.early_exit = None
+            return
+        if not self.config.multilayer_softmaxing:
+            raise ValueError("Early exit needs a model trained with multilayer_softmaxing.")
+        if self.config.multi_source:
+            raise ValueError("Early exit is not supported for multi-source models.")
+        if criterion not in ["confidence", "entropy"]:
+            raise ValueError(f"The early exit criterion should be confidence or entropy but is {criterion}.")
+        self.early_exit = (criterion, threshold)
+
+    def _should_exit_early(self, hidden_states):
+        """This method computes the softmax of the last position of the decoder hidden states of an intermediate layer and decides whether all of them satisfy the early exit criterion. Returns the decision and the logits."""
+        criterion, threshold = self.early_exit
+        lm_logits = self.compute_lm_logits(hidden_states)
+        last_position_logits = lm_logits[:, -1]/self.softmax_temperature if self.config.temperature_calibration else lm_logits[:, -1]
+        probs = F.softmax(last_position_logits, dim=-1)
+        if criterion == "confidence":
+            should_exit = bool((probs.max(dim=-1)[0] >= threshold).all())
+        else:
+            entropy = -(probs * torch.log(probs.clamp(min=1e-20))).sum(dim=-1)
+            should_exit = bool((entropy <= threshold).all())
+        return should_exit, lm_logits
+
+    def generate(self, *args, vocabulary_shortlist=None, early_exit_threshold=None, early_exit_criterion="confidence", **kwargs):
+        """This method is the generate method of the base class which additionally accepts a vocabulary_shortlist (a 1D LongTensor of token ids) to which the output projection is restricted while generating (see set_vocabulary_shortlist) and an early_exit_threshold and early_exit_criterion for exiting the decoder early (see set_early_exit)."""
+        if vocabulary_shortlist is None and early_exit_threshold is None:
+            return super().generate(*args, **kwargs)
+        if vocabulary_shortlist is not None:
+            self.set_vocabulary_shortlist(vocabulary_shortlist)
+        if early_exit_threshold is not None:
+            self.set_early_exit(early_exit_threshold, early_exit_criterion)
+        try:
+            return super().generate(*args, **kwargs)
+        finally:
+            if vocabulary_shortlist is not None:
+                self.set_vocabulary_shortlist(None)
+            if early_exit_threshold is not None:
+                self.set_early_exit(None)
+    ## Modified by Raj Dabre. End.
+
     @add_start_docstrings_to_model_forward(MBART_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=Seq2SeqLMOutput, config_class=_CONFIG_FOR_DOC)
     @add_end_docstrings(MBART_GENERATION_EXAMPLE)
@@ -1658,16 +2033,23 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
         additional_input_ids=None,
         additional_input_ids_mask=None,
         additional_encoder_outputs=None,
-        additional_past_key_values=None,
         curr_decode_length=-1,
         context_encoder_representations=None,
         label_mask=None,
+        stacked_encoder_hidden_states=None,
+        stacked_attention_mask=None,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`):
             Labels for computing the masked language modeling loss. Indices should either be in ``[0, ...,
             config.vocab_size]`` or -100 (see ``input_ids`` docstring). Tokens with indices set to ``-100`` are ignored
             (masked), the loss is only computed for the tokens with labels in ``[0, ..., config.vocab_size]``.
+        stacked_encoder_hidden_states (:obj:`torch.FloatTensor` of shape :obj:`(2 * batch_size, sequence_length, hidden_size)`, `optional`):
+            Only used with the average_softmaxes multi source method. The encoder outputs of the main and the
+            additional source stacked along the batch by :meth:`stack_sources_for_generation` so that they are not
+            stacked again at every decoding step.
+        stacked_attention_mask (:obj:`torch.LongTensor` of shape :obj:`(2 * batch_size, sequence_length)`, `optional`):
+            The attention masks of the sources stacked in the same way as :obj:`stacked_encoder_hidden_states`.
 
         Returns:
 
@@ -1679,54 +2061,78 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
                 decoder_input_ids = shift_tokens_right(labels, self.config.pad_token_id)
         
         
-        if self.config.multi_source_method == "average_softmaxes":
-            outputs = self.model(
-                input_ids,
-                attention_mask=attention_mask,
-                decoder_input_ids=decoder_input_ids,
-                encoder_outputs=encoder_outputs,
-                decoder_attention_mask=decoder_attention_mask,
-                head_mask=head_mask,
-                decoder_head_mask=decoder_head_mask,
+        ## Modified by Raj Dabre. Start.
+        if self.config.multi_source_method == "average_softmaxes": ## Both sources are stacked along the batch (main source first) so that a single encoder and decoder pass serves both of them. The logits are split afterwards. The past key values are those of the stacked batch.
+            if decoder_input_ids is None and decoder_inputs_embeds is None:
+                decoder_input_ids = shift_tokens_right(input_ids, self.config.pad_token_id)
+            if attention_mask is None:
+                attention_mask = torch.ones(encoder_outputs[0].size()[:2] if encoder_outputs is not None else input_ids.size(), dtype=torch.long, device=self.device)
+            if additional_input_ids_mask is None:
+                additional_input_ids_mask = torch.ones(additional_encoder_outputs[0].size()[:2] if additional_encoder_outputs is not None else additional_input_ids.size(), dtype=torch.long, device=self.device)
+            if stacked_attention_mask is None:
+                stacked_attention_mask = _stack_sources_along_batch(attention_mask, additional_input_ids_mask, 0)
+            if encoder_outputs is None:
+                encoder_outputs = self.model.encoder(
+                    input_ids=_stack_sources_along_batch(input_ids, additional_input_ids, self.config.pad_token_id),
+                    attention_mask=stacked_attention_mask,
+                    head_mask=head_mask,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=True,
+                )
+                stacked_encoder_hidden_states = encoder_outputs.last_hidden_state
+                source_lengths = (attention_mask.size(1), additional_input_ids_mask.size(1))
+                encoder_last_hidden_state, additional_encoder_last_hidden_state = _unstack_sources_along_batch(stacked_encoder_hidden_states, *source_lengths)
+                encoder_hidden_states, additional_encoder_hidden_states = zip(*[_unstack_sources_along_batch(hidden_states, *source_lengths) for hidden_states in encoder_outputs.hidden_states]) if encoder_outputs.hidden_states is not None else (None, None)
+                encoder_attentions, additional_encoder_attentions = zip(*[_unstack_sources_along_batch(attentions, *source_lengths, dims=(2, 3)) for attentions in encoder_outputs.attentions]) if encoder_outputs.attentions is not None else (None, None)
+            else:
+                if stacked_encoder_hidden_states is None: ## While generating the sources are stacked only once (see stack_sources_for_generation).
+                    stacked_encoder_hidden_states = _stack_sources_along_batch(encoder_outputs[0], additional_encoder_outputs[0], 0.0)
+                encoder_last_hidden_state, additional_encoder_last_hidden_state = encoder_outputs[0], additional_encoder_outputs[0]
+                encoder_hidden_states, additional_encoder_hidden_states = getattr(encoder_outputs, "hidden_states", None), getattr(additional_encoder_outputs, "hidden_states", None)
+                encoder_attentions, additional_encoder_attentions = getattr(encoder_outputs, "attentions", None), getattr(additional_encoder_outputs, "attentions", None)
+            decoder_outputs = self.model.decoder(
+                input_ids=torch.cat([decoder_input_ids, decoder_input_ids]) if decoder_input_ids is not None else None,
+                attention_mask=torch.cat([decoder_attention_mask, decoder_attention_mask]) if decoder_attention_mask is not None else None,
+                encoder_hidden_states=stacked_encoder_hidden_states,
+                encoder_attention_mask=stacked_attention_mask,
+                head_mask=decoder_head_mask,
+                encoder_head_mask=head_mask,
                 past_key_values=past_key_values,
-                inputs_embeds=inputs_embeds,
-                decoder_inputs_embeds=decoder_inputs_embeds,
+                inputs_embeds=torch.cat([decoder_inputs_embeds, decoder_inputs_embeds]) if decoder_inputs_embeds is not None else None,
                 use_cache=use_cache,
                 output_attentions=output_attentions,
                 output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-                additional_input_ids=None,
-                additional_input_ids_mask=None,
-                additional_encoder_outputs=None,
+                return_dict=True,
                 curr_decode_length=curr_decode_length,
             )
-            lm_logits = (self.lm_head(outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
+            lm_logits, additional_source_lm_logits = self.compute_lm_logits(decoder_outputs.last_hidden_state).chunk(2)
             if self.config.temperature_calibration:
                 lm_logits = lm_logits/self.softmax_temperature ## The softmax_temperature config param should be 1.0
-            additional_outputs = self.model(
-                additional_input_ids,
-                attention_mask=additional_input_ids_mask,
-                decoder_input_ids=decoder_input_ids,
-                encoder_outputs=additional_encoder_outputs,
-                decoder_attention_mask=decoder_attention_mask,
-                head_mask=head_mask,
-                decoder_head_mask=decoder_head_mask,
-                past_key_values=additional_past_key_values,
-                inputs_embeds=inputs_embeds,
-                decoder_inputs_embeds=decoder_inputs_embeds,
-                use_cache=use_cache,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-                additional_input_ids=None,
-                additional_input_ids_mask=None,
-                additional_encoder_outputs=None,
-                curr_decode_length=curr_decode_length,
-            )
-            additional_source_lm_logits = (self.lm_head(additional_outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
-            if self.config.temperature_calibration:
                 additional_source_lm_logits = additional_source_lm_logits/self.softmax_temperature ## The softmax_temperature config param should be 1.0
+            outputs = Seq2SeqModelOutput(
+                last_hidden_state=decoder_outputs.last_hidden_state.chunk(2)[0],
+                past_key_values=decoder_outputs.past_key_values,
+                decoder_hidden_states=decoder_outputs.hidden_states,
+                decoder_attentions=decoder_outputs.attentions,
+                cross_attentions=decoder_outputs.cross_attentions,
+                encoder_last_hidden_state=encoder_last_hidden_state,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attentions=encoder_attentions,
+                additional_encoder_last_hidden_state=additional_encoder_last_hidden_state,
+                additional_encoder_hidden_states=additional_encoder_hidden_states,
+                additional_encoder_attentions=additional_encoder_attentions,
+            )
+        ## Modified by Raj Dabre. End.
         else:
+            early_exit_fn = None
+            exit_lm_logits = [] ## The logits of the layer at which the decoder exited, if it exited early.
+            if self.early_exit is not None and not self.training and (use_cache if use_cache is not None else self.config.use_cache):
+                def early_exit_fn(hidden_states, layer_idx):
+                    should_exit, lm_logits = self._should_exit_early(hidden_states)
+                    if should_exit:
+                        exit_lm_logits.append((layer_idx + 1, lm_logits))
+                    return should_exit
             outputs = self.model(
                 input_ids,
                 attention_mask=attention_mask,
@@ -1747,15 +2153,19 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
                 additional_encoder_outputs=additional_encoder_outputs,
                 curr_decode_length=curr_decode_length,
                 context_encoder_representations=context_encoder_representations,
+                early_exit_fn=early_exit_fn,
             )
-            lm_logits = (self.lm_head(outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
+            if early_exit_fn is not None:
+                self.early_exit_num_layers_used += exit_lm_logits[0][0] if len(exit_lm_logits) > 0 else len(self.model.decoder.layers)
+                self.early_exit_num_steps += 1
+            lm_logits = exit_lm_logits[0][1] if len(exit_lm_logits) > 0 else self.compute_lm_logits(outputs[0]) ## The logits of the exit layer are not computed again.
             if self.config.temperature_calibration:
                 lm_logits = lm_logits/self.softmax_temperature
         
         additional_lm_logits = []
-        if self.config.multilayer_softmaxing:
+        if self.config.multilayer_softmaxing and outputs.decoder_hidden_states is not None: ## The decoder hidden states are not returned while generating.
             for lm_representation in outputs.decoder_hidden_states[1:-1]: ## We count the embedding layer too. Who knows what may happen? However we wont do anything for the final layer as its already dealt with.
-                additional_lm_logits.append((self.lm_head(lm_representation) + self.final_logits_bias)/self.config.softmax_temperature) ## The additional logits will be collected here and then returned to my main code. Divide the logits by a temperature to get a smoothed softmax.
+                additional_lm_logits.append(self.compute_lm_logits(lm_representation)) ## The additional logits will be collected here and then returned to my main code. Divide the logits by a temperature to get a smoothed softmax.
                 if self.config.temperature_calibration:
                     additional_lm_logits = additional_lm_logits/self.softmax_temperature ## The softmax_temperature config param should be 1.0
         
@@ -1789,7 +2199,6 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
             additional_encoder_hidden_states=outputs.additional_encoder_hidden_states if self.config.multi_source else None,
             additional_encoder_attentions=outputs.additional_encoder_attentions if self.config.multi_source else None,
             additional_cross_attentions=outputs.additional_cross_attentions if self.config.multi_source and (self.config.multi_source_method == "merge_after_attention" or self.config.multi_source_method == "self_relevance_and_merge_after_attention" or self.config.multi_source_method == "merge_after_attention_with_context_relevance_only" or self.config.multi_source_method == "self_relevance_and_merge_after_attention_with_context_relevance_only" or self.config.multi_source_method == "average_softmaxes") else (),
-            additional_past_key_values=additional_outputs.past_key_values if self.config.multi_source and (self.config.multi_source_method == "average_softmaxes") else None,
             additional_source_lm_logits=additional_source_lm_logits if self.config.multi_source and (self.config.multi_source_method == "average_softmaxes") else None,
             context_encoder_representations = outputs.context_encoder_representations if self.config.multi_source and (self.config.multi_source_method == "additional_source_attention") else None,
             softmax_temperature = self.softmax_temperature if self.config.temperature_calibration else None,
@@ -1800,7 +2209,9 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
         self, decoder_input_ids, past=None, attention_mask=None, use_cache=None, encoder_outputs=None, **kwargs
     ):
         # cut decoder_input_ids if past is used
-        if past is not None:
+        if isinstance(past, MBartStaticCache): ## The static cache is passed from the first step onwards.
+            decoder_input_ids = decoder_input_ids[:, past.length:]
+        elif past is not None:
             decoder_input_ids = decoder_input_ids[:, -1:]
 
         return {
@@ -1813,10 +2224,17 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
             "additional_input_ids": None,  # additional_encoder_outputs is defined. additional_input_ids not needed
             "additional_input_ids_mask": kwargs["additional_input_ids_mask"] if self.config.multi_source else None, ## This will contain the additional encoder outputs. 
             "additional_encoder_outputs": kwargs["additional_encoder_outputs"] if self.config.multi_source else None, ## This will contain the additional encoder outputs. 
-            "additional_past_key_values": kwargs["additional_past"] if self.config.multi_source_method == "average_softmaxes" and "additional_past" in kwargs else None, ## This is for the past of the additional source when averaging softmaxes. 
             "context_encoder_representations": kwargs["context_encoder_representations"] if self.config.multi_source else None, ##  A bit sloppy and should be controlled by an additional condition looking at the value of multi_source type.
+            "stacked_encoder_hidden_states": kwargs.get("stacked_encoder_hidden_states", None),
+            "stacked_attention_mask": kwargs.get("stacked_attention_mask", None),
         }
 
+    def stack_sources_for_generation(self, model_kwargs):
+        """This method stacks the encoder outputs and the attention masks of the main and the additional source along the batch once before generating with the average_softmaxes multi source method. Otherwise the forward pass would pad and concatenate them at every decoding step. The encoder outputs are shared across the beams (see _expand_inputs_for_generation) so the stacked ones stay valid for the whole generation."""
+        model_kwargs["stacked_encoder_hidden_states"] = _stack_sources_along_batch(model_kwargs["encoder_outputs"].last_hidden_state, model_kwargs["additional_encoder_outputs"].last_hidden_state, 0.0)
+        model_kwargs["stacked_attention_mask"] = _stack_sources_along_batch(model_kwargs["attention_mask"], model_kwargs["additional_input_ids_mask"], 0)
+        return model_kwargs
+
 ## Modified by Raj Dabre. End.
 
     def adjust_logits_during_generation(self, logits, cur_len, max_length):
@@ -1831,6 +2249,13 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
 
     @staticmethod
     def _reorder_cache(past, beam_idx):
+        ## Modified by Raj Dabre. Start.
+        past_batch_size = past.self_attn_key_values.size(2) if isinstance(past, MBartStaticCache) else past[0][0].size(0)
+        if past_batch_size != beam_idx.size(0): ## When averaging softmaxes the past holds both sources stacked along the batch and each source is reordered in the same way.
+            beam_idx = torch.cat([beam_idx + source_idx * beam_idx.size(0) for source_idx in range(past_batch_size // beam_idx.size(0))])
+        if isinstance(past, MBartStaticCache):
+            return past.reorder(beam_idx)
+        ## Modified by Raj Dabre. End.
         reordered_past = ()
         for layer_past in past:
             # cached cross_attention states don't have to be reordered -> they are always the same
@@ -0,0 +1,175 @@
+# coding=utf-8
+# Copyright 2021, National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Speculative decoding of MBart models with a smaller draft model. """
+
+import torch
+import torch.nn.functional as F
+
+
+def _crop_past_key_values(past_key_values, length):
+    """This method keeps the self attention keys and values of the first length decoder positions. The cross attention keys and values are kept as they are."""
+    if past_key_values is None or past_key_values[0][0].size(2) <= length:
+        return past_key_values
+    return tuple((layer_past[0][:, :, :length], layer_past[1][:, :, :length]) + tuple(layer_past[2:]) for layer_past in past_key_values)
+
+
+class MBartSpeculativeDecoder:
+    """This class decodes with a model and a smaller draft model which shares its vocabulary, such as a student distilled from it. In each round the draft model proposes num_draft_tokens tokens one at a time and the model scores all of them in a single teacher forced decoder pass. The longest prefix of the proposals which the model agrees with is kept along with one token of the model itself, so each round gives at least one token and at most num_draft_tokens+1 tokens for the cost of one decoder pass of the model.
+    With greedy decoding the model agrees with a proposal if it is its argmax, so the output is exactly that of greedy decoding with the model alone. With sampling a proposal is accepted with probability min(1, p/q) where p and q are the probabilities of the model and the draft model, and a rejected proposal is replaced with a sample from the normalized max(0, p-q), so the samples follow the distribution of the model alone (Leviathan et al., 2023; Chen et al., 2023).
+    A round stops at the first position where any sentence of the batch disagrees, which keeps the sentences of a batch of the same length. Smaller batches thus accept more proposals.
+
+    Usage:
+        speculative_decoder = MBartSpeculativeDecoder(model, draft_model, num_draft_tokens=4)
+        output_ids = speculative_decoder.generate(input_ids, attention_mask=attention_mask, max_length=100, decoder_start_token_id=tgt_lang_id)
+        acceptance_rate = speculative_decoder.acceptance_rate()
+    """
+
+    def __init__(self, model, draft_model, num_draft_tokens=4):
+        for config in [model.config, draft_model.config]:
+            if config.multi_source:
+                raise ValueError("Speculative decoding is not supported for multi-source models.")
+            if config.wait_k != -1:
+                raise ValueError("Speculative decoding is not supported for wait-k models.")
+        if model.config.vocab_size != draft_model.config.vocab_size:
+            raise ValueError(f"The draft model should share the vocabulary of the model but their vocabulary sizes are {draft_model.config.vocab_size} and {model.config.vocab_size}.")
+        if num_draft_tokens < 1:
+            raise ValueError("The draft model should propose at least one token per round.")
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.num_proposed_tokens = 0
+        self.num_accepted_tokens = 0
+
+    def acceptance_rate(self):
+        """This method returns the fraction of the tokens proposed by the draft model so far which the model accepted."""
+        return self.num_accepted_tokens / self.num_proposed_tokens if self.num_proposed_tokens > 0 else 0.0
+
+    def _propose(self, sequences, encoder_hidden_states, attention_mask, past_key_values, num_draft_tokens, logits_processor, logits_warper):
+        """This method lets the draft model propose num_draft_tokens tokens following the sequences. Returns the proposed tokens, the probabilities with which they were sampled (if sampling), and the past key values of the draft model."""
+        draft_ids = sequences.new_zeros(sequences.size(0), 0)
+        draft_probs = []
+        decoder_input_ids = sequences[:, past_key_values[0][0].size(2) if past_key_values is not None else 0:]
+        for _ in range(num_draft_tokens):
+            outputs = self.draft_model(attention_mask=attention_mask, decoder_input_ids=decoder_input_ids, encoder_outputs=(encoder_hidden_states,), past_key_values=past_key_values, use_cache=True, return_dict=True)
+            past_key_values = outputs.past_key_values
+            prefix_ids = torch.cat([sequences, draft_ids], dim=-1)
+            next_token_scores = logits_processor(prefix_ids, outputs.logits[:, -1, :])
+            if logits_warper is not None:
+                probs = F.softmax(logits_warper(prefix_ids, next_token_scores), dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                draft_probs.append(probs)
+            else:
+                next_tokens = torch.argmax(next_token_scores, dim=-1)
+            draft_ids = torch.cat([draft_ids, next_tokens[:, None]], dim=-1)
+            decoder_input_ids = next_tokens[:, None]
+        return draft_ids, draft_probs, past_key_values
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        max_length=None,
+        min_length=None,
+        do_sample=False,
+        temperature=None,
+        top_k=None,
+        top_p=None,
+        repetition_penalty=None,
+        no_repeat_ngram_size=None,
+        encoder_no_repeat_ngram_size=None,
+        bos_token_id=None,
+        pad_token_id=None,
+        eos_token_id=None,
+        decoder_start_token_id=None,
+        sentence_min_lengths=None,
+        sentence_max_lengths=None,
+    ):
+        """This method translates a batch like the generate method of the model does with greedy decoding (or sampling if do_sample is set). The arguments have the same meaning and defaults."""
+        model = self.model
+        config = model.config
+        if sentence_max_lengths is not None and max_length is None:
+            max_length = int(sentence_max_lengths.max())
+        max_length = max_length if max_length is not None else config.max_length
+        bos_token_id = bos_token_id if bos_token_id is not None else config.bos_token_id
+        pad_token_id = pad_token_id if pad_token_id is not None else config.pad_token_id
+        eos_token_id = eos_token_id if eos_token_id is not None else config.eos_token_id
+        if pad_token_id is None and eos_token_id is not None:
+            pad_token_id = eos_token_id
+        if attention_mask is None:
+            attention_mask = model._prepare_attention_mask_for_generation(input_ids, pad_token_id, eos_token_id)
+        logits_processor = model._get_logits_processor(
+            repetition_penalty=repetition_penalty,
+            no_repeat_ngram_size=no_repeat_ngram_size,
+            encoder_no_repeat_ngram_size=encoder_no_repeat_ngram_size,
+            encoder_input_ids=input_ids,
+            bad_words_ids=None,
+            min_length=min_length,
+            eos_token_id=eos_token_id,
+            prefix_allowed_tokens_fn=None,
+            num_beams=1,
+            num_beam_groups=1,
+            diversity_penalty=None,
+            sentence_min_lengths=sentence_min_lengths,
+            sentence_max_lengths=sentence_max_lengths,
+        )
+        logits_warper = model._get_logits_warper(top_k=top_k, top_p=top_p, temperature=temperature, num_beams=1) if do_sample else None
+
+        encoder_hidden_states = model.get_encoder()(input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+        draft_encoder_hidden_states = self.draft_model.get_encoder()(input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+        sequences = torch.full((input_ids.size(0), 1), model._get_decoder_start_token_id(decoder_start_token_id, bos_token_id), dtype=torch.long, device=input_ids.device)
+        unfinished_sequences = sequences.new_ones(sequences.size(0))
+        past_key_values, draft_past_key_values = None, None
+        while sequences.size(1) < max_length and unfinished_sequences.max() != 0:
+            cur_len = sequences.size(1)
+            num_draft_tokens = min(self.num_draft_tokens, max_length - cur_len - 1) ## The pass of the model gives one more token than proposed.
+            draft_ids, draft_probs, draft_past_key_values = self._propose(sequences, draft_encoder_hidden_states, attention_mask, draft_past_key_values, num_draft_tokens, logits_processor, logits_warper)
+
+            outputs = model(attention_mask=attention_mask, decoder_input_ids=torch.cat([sequences[:, past_key_values[0][0].size(2) if past_key_values is not None else 0:], draft_ids], dim=-1), encoder_outputs=(encoder_hidden_states,), past_key_values=past_key_values, use_cache=True, return_dict=True)
+            past_key_values = outputs.past_key_values
+            logits = outputs.logits[:, -(num_draft_tokens + 1):, :] ## The distributions following the last token of the sequences and each proposal.
+
+            num_accepted_tokens = 0
+            for position in range(num_draft_tokens + 1):
+                next_token_scores = logits_processor(sequences, logits[:, position, :]) ## The sequences so far end with the proposals accepted in this round.
+                is_draft_token = position < num_draft_tokens
+                if logits_warper is None:
+                    next_tokens = torch.argmax(next_token_scores, dim=-1)
+                    accepted = (next_tokens == draft_ids[:, position]) if is_draft_token else None
+                else:
+                    probs = F.softmax(logits_warper(sequences, next_token_scores), dim=-1)
+                    if is_draft_token:
+                        proposed_tokens = draft_ids[:, position]
+                        proposed_probs = probs.gather(1, proposed_tokens[:, None]).squeeze(1)
+                        proposed_draft_probs = draft_probs[position].gather(1, proposed_tokens[:, None]).squeeze(1)
+                        accepted = torch.rand_like(proposed_probs) * proposed_draft_probs <= proposed_probs ## Accept with probability min(1, p/q).
+                        residual_probs = (probs - draft_probs[position]).clamp(min=0)
+                        residual_probs = torch.where(residual_probs.sum(dim=-1, keepdim=True) > 0, residual_probs, probs)
+                        next_tokens = torch.where(accepted, proposed_tokens, torch.multinomial(residual_probs, num_samples=1).squeeze(1))
+                    else:
+                        next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                round_continues = is_draft_token and bool((accepted | (unfinished_sequences == 0)).all())
+                if eos_token_id is not None:
+                    next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
+                    unfinished_sequences = unfinished_sequences.mul((next_tokens != eos_token_id).long())
+                sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+                if not round_continues or unfinished_sequences.max() == 0:
+                    break
+                num_accepted_tokens += 1
+            self.num_proposed_tokens += num_draft_tokens
+            self.num_accepted_tokens += num_accepted_tokens
+            past_key_values = _crop_past_key_values(past_key_values, cur_len + num_accepted_tokens) ## Only the keys and values of the accepted proposals stay. The last token is fed in the next round.
+            draft_past_key_values = _crop_past_key_values(draft_past_key_values, cur_len + num_accepted_tokens)
+        return sequences
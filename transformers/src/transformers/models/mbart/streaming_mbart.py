@@ -0,0 +1,147 @@
+# coding=utf-8
+# Copyright 2021, National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Streaming (simultaneous) translation with wait-k MBart models and its latency metrics. """
+
+import time
+
+import torch
+
+
+def compute_latency_metrics(delays, source_length):
+    """This method computes the latency of a simultaneous translation. delays[i] is the number of source tokens which had been read when the (i+1)-th target token was emitted. Returns the average proportion (Cho and Esipova, 2016), the average lagging (Ma et al., 2019) and the differentiable average lagging (Arivazhagan et al., 2019), all in source tokens except for the average proportion."""
+    target_length = len(delays)
+    if target_length == 0 or source_length == 0:
+        return {"average_proportion": 0.0, "average_lagging": 0.0, "differentiable_average_lagging": 0.0}
+    gamma = target_length / source_length ## The target to source length ratio.
+    average_proportion = sum(delays) / (source_length * target_length)
+    cut_off = next((i + 1 for i, delay in enumerate(delays) if delay >= source_length), target_length) ## Only the target tokens till the first one emitted after reading the whole source count.
+    average_lagging = sum(delays[i] - i / gamma for i in range(cut_off)) / cut_off
+    differentiable_delays = []
+    for i, delay in enumerate(delays):
+        differentiable_delays.append(delay if i == 0 else max(delay, differentiable_delays[-1] + 1 / gamma))
+    differentiable_average_lagging = sum(differentiable_delays[i] - i / gamma for i in range(target_length)) / target_length
+    return {"average_proportion": average_proportion, "average_lagging": average_lagging, "differentiable_average_lagging": differentiable_average_lagging}
+
+
+class MBartStreamingDecoder:
+    """This class translates a source sentence while it is being read with the wait-k policy: the i-th target token is emitted (greedily) as soon as i+k-1 source tokens have been read or the whole source has been read. This needs a unidirectional encoder (wait_k or unidirectional_encoder in the config) because then the encoder states of the tokens read so far do not change when more tokens arrive. Thus only the new source tokens are encoded (given the encoder keys and values of the earlier ones) and projected to cross attention keys and values, while the decoder keys and values of the target tokens emitted so far stay valid. Feeding the tokens of a sentence one at a time gives the same translation as greedy decoding with generate.
+
+    Usage:
+        streaming_decoder = MBartStreamingDecoder(model, decoder_start_token_id=tgt_lang_id)
+        for token in source_tokens:
+            emitted_tokens = streaming_decoder.read([token])
+        emitted_tokens = streaming_decoder.finish()
+        latency = streaming_decoder.latency()
+    """
+
+    def __init__(self, model, decoder_start_token_id=None, wait_k=None, max_length=None, min_length=0, eos_token_id=None):
+        config = model.config
+        if config.multi_source:
+            raise ValueError("Streaming is not supported for multi-source models.")
+        if config.wait_k == -1 and not config.unidirectional_encoder:
+            raise ValueError("Streaming needs a unidirectional encoder. Set the wait_k or the unidirectional_encoder of the config.")
+        self.model = model
+        self.config = config
+        self.wait_k = wait_k if wait_k is not None else config.wait_k ## A unidirectional encoder trained for full sentence decoding can be decoded with a test time wait-k.
+        if self.wait_k < 1:
+            raise ValueError("Streaming needs a wait-k of at least 1. Set the wait_k of the config or pass one.")
+        self.decoder_start_token_id = decoder_start_token_id if decoder_start_token_id is not None else (config.decoder_start_token_id if config.decoder_start_token_id is not None else config.bos_token_id)
+        self.eos_token_id = eos_token_id if eos_token_id is not None else config.eos_token_id
+        self.max_length = max_length if max_length is not None else config.max_length
+        self.min_length = min_length
+        self.device = next(model.parameters()).device
+        self.reset()
+
+    def reset(self):
+        """This method forgets the current sentence so that a new one can be streamed."""
+        self.source_ids = []
+        self.source_finished = False
+        self.target_ids = [self.decoder_start_token_id]
+        self.delays = [] ## The number of source tokens read when each target token was emitted.
+        self.computation_times = [] ## The seconds between the arrival of the source tokens which allowed each target token to be emitted and its emission.
+        self.encoder_hidden_states = None
+        self.encoder_past_key_values = None
+        self.self_key_values = [(torch.zeros(1, layer.self_attn.num_heads, 0, layer.self_attn.head_dim, device=self.device), torch.zeros(1, layer.self_attn.num_heads, 0, layer.self_attn.head_dim, device=self.device)) for layer in self.model.model.decoder.layers]
+        self.cross_key_values = [(torch.zeros(1, layer.encoder_attn.num_heads, 0, layer.encoder_attn.head_dim, device=self.device), torch.zeros(1, layer.encoder_attn.num_heads, 0, layer.encoder_attn.head_dim, device=self.device)) for layer in self.model.model.decoder.layers]
+
+    @property
+    def finished(self):
+        return (len(self.target_ids) > 1 and self.target_ids[-1] == self.eos_token_id) or len(self.target_ids) >= self.max_length
+
+    @property
+    def num_encoded(self):
+        return self.encoder_hidden_states.size(1) if self.encoder_hidden_states is not None else 0
+
+    def read(self, source_ids, is_last=False):
+        """This method reads the next source tokens and returns the target tokens which the wait-k policy allows to be emitted now. If is_last is set then the source is complete and the rest of the translation is emitted."""
+        arrival_time = time.perf_counter()
+        self.source_ids.extend(int(source_id) for source_id in source_ids)
+        self.source_finished = self.source_finished or is_last
+        emitted_ids = []
+        while not self.finished and len(self.source_ids) > 0 and (self.source_finished or len(self.source_ids) >= len(self.target_ids) + self.wait_k - 1):
+            emitted_ids.append(self._decode_step())
+            self.delays.append(len(self.source_ids))
+            self.computation_times.append(time.perf_counter() - arrival_time)
+        return emitted_ids
+
+    def finish(self):
+        """This method marks the end of the source and returns the rest of the translation."""
+        return self.read([], is_last=True)
+
+    def latency(self):
+        """This method returns the latency metrics of the translation so far (see compute_latency_metrics) along with the average computation time per target token in seconds."""
+        metrics = compute_latency_metrics(self.delays, len(self.source_ids))
+        metrics["average_computation_time"] = sum(self.computation_times) / len(self.computation_times) if len(self.computation_times) > 0 else 0.0
+        return metrics
+
+    def _encode(self):
+        """This method encodes the source tokens read since the last call given the encoder keys and values of the earlier ones and computes their cross attention keys and values."""
+        input_ids = torch.tensor([self.source_ids[self.num_encoded:]], dtype=torch.long, device=self.device)
+        encoder_outputs = self.model.model.encoder(input_ids=input_ids, past_key_values=self.encoder_past_key_values, use_cache=True, return_dict=True)
+        self.encoder_past_key_values = encoder_outputs.past_key_values
+        new_encoder_hidden_states = encoder_outputs.last_hidden_state
+        for layer_idx, layer in enumerate(self.model.model.decoder.layers):
+            encoder_attn = layer.encoder_attn
+            key_states = encoder_attn._shape(encoder_attn.k_proj(new_encoder_hidden_states), -1, 1)
+            value_states = encoder_attn._shape(encoder_attn.v_proj(new_encoder_hidden_states), -1, 1)
+            self.cross_key_values[layer_idx] = (torch.cat([self.cross_key_values[layer_idx][0], key_states], dim=2), torch.cat([self.cross_key_values[layer_idx][1], value_states], dim=2))
+        self.encoder_hidden_states = new_encoder_hidden_states if self.encoder_hidden_states is None else torch.cat([self.encoder_hidden_states, new_encoder_hidden_states], dim=1)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        """This method emits the next target token given the source tokens read so far."""
+        config_wait_k = self.config.wait_k ## The decoder masks the source with the wait-k of the policy.
+        self.config.wait_k = self.wait_k
+        try:
+            if self.num_encoded < len(self.source_ids):
+                self._encode()
+            outputs = self.model(
+                attention_mask=torch.ones(1, self.num_encoded, dtype=torch.long, device=self.device),
+                decoder_input_ids=torch.tensor([[self.target_ids[-1]]], dtype=torch.long, device=self.device),
+                encoder_outputs=(self.encoder_hidden_states,),
+                past_key_values=[self_key_value + cross_key_value for self_key_value, cross_key_value in zip(self.self_key_values, self.cross_key_values)],
+                use_cache=True,
+                return_dict=True,
+                curr_decode_length=len(self.target_ids),
+            )
+        finally:
+            self.config.wait_k = config_wait_k
+        self.self_key_values = [layer_past_key_value[:2] for layer_past_key_value in outputs.past_key_values]
+        next_token_logits = outputs.logits[0, -1]
+        if len(self.target_ids) < self.min_length and self.eos_token_id is not None:
+            next_token_logits[self.eos_token_id] = -float("inf")
+        next_token_id = int(torch.argmax(next_token_logits))
+        self.target_ids.append(next_token_id)
+        return next_token_id
@@ -123,6 +123,11 @@ class BeamSearchScorer:
         requires_pytorch(self)
 
 
+class TensorBeamSearchScorer:
+    def __init__(self, *args, **kwargs):
+        requires_pytorch(self)
+
+
 class HammingDiversityLogitsProcessor:
     def __init__(self, *args, **kwargs):
         requires_pytorch(self)
@@ -168,6 +173,11 @@ class RepetitionPenaltyLogitsProcessor:
         requires_pytorch(self)
 
 
+class SentenceLengthLogitsProcessor:
+    def __init__(self, *args, **kwargs):
+        requires_pytorch(self)
+
+
 class TemperatureLogitsWarper:
     def __init__(self, *args, **kwargs):
         requires_pytorch(self)
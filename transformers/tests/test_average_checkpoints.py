@@ -0,0 +1,107 @@
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch
+
+
+if is_torch_available():
+    import torch
+
+    toolkit_path = os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+    sys.path.append(toolkit_path)
+
+    import average_checkpoints  # noqa: E402
+
+
+class TrackedParams(collections.OrderedDict):
+    """Model params which count how many checkpoints are alive."""
+
+    num_alive = 0
+    max_alive = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        TrackedParams.num_alive += 1
+        TrackedParams.max_alive = max(TrackedParams.max_alive, TrackedParams.num_alive)
+
+    def __del__(self):
+        TrackedParams.num_alive -= 1
+
+
+@require_torch
+class AverageCheckpointsStreamingTest(unittest.TestCase):
+    def _save_checkpoints(self, tmpdir, num_checkpoints, full):
+        paths = []
+        for i in range(num_checkpoints):
+            model_params = collections.OrderedDict(
+                [
+                    ("weight", torch.full((3, 2), float(i + 1))),
+                    ("half", torch.full((2,), float(i + 1)).half()),
+                    ("steps", torch.tensor([2 * i], dtype=torch.long)),
+                ]
+            )
+            path = os.path.join(tmpdir, "model.%d" % i)
+            torch.save({"model": model_params, "optimizer": {}, "ctr": i} if full else model_params, path)
+            paths.append(path)
+        return paths
+
+    def _get_args(self, inputs, **kwargs):
+        args = {"inputs": inputs, "geometric_mean": False, "weights": None, "ema_decay": None}
+        args.update(kwargs)
+        return argparse.Namespace(**args)
+
+    def test_uniform_average(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args = self._get_args(self._save_checkpoints(tmpdir, 3, full=True))
+            averaged = average_checkpoints.average_checkpoints_streaming(args)["model"]
+        self.assertTrue(torch.equal(averaged["weight"], torch.full((3, 2), 2.0)))
+        self.assertEqual(averaged["half"].dtype, torch.float16)
+        self.assertTrue(torch.equal(averaged["half"].float(), torch.full((2,), 2.0)))
+        self.assertEqual(averaged["steps"].tolist(), [2])
+
+    def test_weighted_and_ema_average(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inputs = self._save_checkpoints(tmpdir, 3, full=False)
+            weighted = average_checkpoints.average_checkpoints_streaming(self._get_args(inputs, weights=[1, 0, 3]))
+            ema = average_checkpoints.average_checkpoints_streaming(self._get_args(inputs, ema_decay=0.5))
+            geometric = average_checkpoints.average_checkpoints_streaming(self._get_args(inputs, geometric_mean=True))
+        self.assertTrue(torch.allclose(weighted["weight"], torch.full((3, 2), 2.5)))
+        # ((1 * 0.5 + 0.5 * 2) * 0.5 + 0.5 * 3)
+        self.assertTrue(torch.allclose(ema["weight"], torch.full((3, 2), 2.25)))
+        self.assertTrue(torch.allclose(geometric["weight"], torch.full((3, 2), 6 ** (1 / 3))))
+
+    def test_one_checkpoint_alive_at_a_time(self):
+        load_model_params_lazily = average_checkpoints.load_model_params_lazily
+
+        def load_tracked_model_params(fpath):
+            self.assertEqual(TrackedParams.num_alive, 0)
+            model_params, is_full = load_model_params_lazily(fpath)
+            return TrackedParams(model_params), is_full
+
+        TrackedParams.num_alive, TrackedParams.max_alive = 0, 0
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args = self._get_args(self._save_checkpoints(tmpdir, 4, full=True))
+            with mock.patch.object(average_checkpoints, "load_model_params_lazily", load_tracked_model_params):
+                averaged = average_checkpoints.average_checkpoints_streaming(args)["model"]
+        self.assertEqual(TrackedParams.max_alive, 1)
+        self.assertTrue(torch.equal(averaged["weight"], torch.full((3, 2), 2.5)))
@@ -25,7 +25,7 @@ from .test_modeling_common import floats_tensor, ids_tensor
 if is_torch_available():
     import torch
 
-    from transformers.generation_beam_search import BeamHypotheses, BeamSearchScorer
+    from transformers.generation_beam_search import BeamHypotheses, BeamSearchScorer, TensorBeamSearchScorer
 
 
 class BeamSearchTester:
@@ -232,6 +232,81 @@ class BeamSearchTester:
         self.parent.assertListEqual(list(sequences.shape), [self.num_beams * self.batch_size, max_length])
         self.parent.assertListEqual(list(sequence_scores.shape), [self.num_beams * self.batch_size])
 
+    def check_tensor_beam_scorer_equivalence(self, do_early_stopping, num_beam_groups, tied_scores):
+        vocab_size = 6
+        eos_token_id = 1
+        max_length = 12
+        group_size = self.num_beams // num_beam_groups
+        kwargs = dict(
+            batch_size=self.batch_size,
+            max_length=max_length,
+            num_beams=self.num_beams,
+            device=torch_device,
+            length_penalty=self.length_penalty,
+            do_early_stopping=do_early_stopping,
+            num_beam_hyps_to_keep=self.num_beam_hyps_to_keep,
+            num_beam_groups=num_beam_groups,
+        )
+        beam_scorer = BeamSearchScorer(**kwargs)
+        tensor_beam_scorer = TensorBeamSearchScorer(**kwargs)
+
+        input_ids = ids_tensor((self.batch_size * self.num_beams, 1), vocab_size)
+        beam_scores = torch.zeros(self.batch_size * self.num_beams, device=torch_device)
+        while input_ids.shape[-1] < max_length and not beam_scorer.is_done:
+            next_input_ids = input_ids.new_zeros((self.batch_size * self.num_beams, input_ids.shape[-1] + 1))
+            for group_idx in range(num_beam_groups):
+                group_rows = (
+                    torch.arange(self.batch_size, device=torch_device)[:, None] * self.num_beams
+                    + group_idx * group_size
+                    + torch.arange(group_size, device=torch_device)[None, :]
+                ).view(-1)
+                group_input_ids = input_ids[group_rows]
+
+                next_scores = -floats_tensor((self.batch_size, 2 * group_size)).to(torch_device) * 4
+                if tied_scores:
+                    next_scores = next_scores.round()
+                next_scores, _ = next_scores.sort(descending=True)
+                next_tokens = ids_tensor((self.batch_size, 2 * group_size), vocab_size).to(torch_device)
+                # keep enough candidates which are not eos tokens
+                too_many_eos = (next_tokens != eos_token_id).sum(-1) < group_size
+                next_tokens[too_many_eos] = (next_tokens[too_many_eos] == eos_token_id).long() * 2
+                next_indices = ids_tensor((self.batch_size, 2 * group_size), group_size).to(torch_device)
+
+                beam_outputs = beam_scorer.process(
+                    group_input_ids, next_scores, next_tokens, next_indices, pad_token_id=0, eos_token_id=eos_token_id
+                )
+                tensor_beam_outputs = tensor_beam_scorer.process(
+                    group_input_ids, next_scores, next_tokens, next_indices, pad_token_id=0, eos_token_id=eos_token_id
+                )
+                for key in ["next_beam_scores", "next_beam_tokens", "next_beam_indices"]:
+                    self.parent.assertTrue(torch.equal(beam_outputs[key], tensor_beam_outputs[key]))
+                self.parent.assertListEqual(beam_scorer._done.tolist(), tensor_beam_scorer._done.tolist())
+
+                beam_scores[group_rows] = beam_outputs["next_beam_scores"]
+                next_input_ids[group_rows] = torch.cat(
+                    [group_input_ids[beam_outputs["next_beam_indices"]], beam_outputs["next_beam_tokens"][:, None]],
+                    dim=-1,
+                )
+            input_ids = next_input_ids
+
+        sequence_outputs = beam_scorer.finalize(input_ids, beam_scores, None, None, pad_token_id=0, eos_token_id=eos_token_id)
+        tensor_sequence_outputs = tensor_beam_scorer.finalize(
+            input_ids, beam_scores, None, None, pad_token_id=0, eos_token_id=eos_token_id
+        )
+        self.parent.assertListEqual(sequence_outputs["sequences"].tolist(), tensor_sequence_outputs["sequences"].tolist())
+        self.parent.assertTrue(torch.equal(sequence_outputs["sequence_scores"], tensor_sequence_outputs["sequence_scores"]))
+
+        # too many eos tokens
+        tensor_beam_scorer = TensorBeamSearchScorer(**kwargs)
+        with self.parent.assertRaises(ValueError):
+            tensor_beam_scorer.process(
+                input_ids[: self.batch_size * group_size],
+                next_scores,
+                torch.full_like(next_tokens, eos_token_id),
+                next_indices,
+                eos_token_id=eos_token_id,
+            )
+
 
 @require_torch
 class BeamSearchTest(unittest.TestCase):
@@ -249,3 +324,12 @@ class BeamSearchTest(unittest.TestCase):
     def test_beam_scorer_finalize(self):
         inputs = self.beam_search_tester.prepare_inputs()
         self.beam_search_tester.check_beam_scores_finalize(*inputs)
+
+    def test_tensor_beam_scorer_equivalence(self):
+        for do_early_stopping in [False, True]:
+            for num_beam_groups in [1, 2]:
+                for tied_scores in [False, True]:
+                    for _ in range(5):
+                        self.beam_search_tester.check_tensor_beam_scorer_equivalence(
+                            do_early_stopping, num_beam_groups, tied_scores
+                        )
@@ -35,6 +35,7 @@ if is_torch_available():
         NoRepeatNGramLogitsProcessor,
         PrefixConstrainedLogitsProcessor,
         RepetitionPenaltyLogitsProcessor,
+        SentenceLengthLogitsProcessor,
         TemperatureLogitsWarper,
         TopKLogitsWarper,
         TopPLogitsWarper,
@@ -66,6 +67,31 @@ class LogitsProcessorTest(unittest.TestCase):
         scores_before_min_length = min_dist_processor(input_ids, scores)
         self.assertFalse(torch.isinf(scores_before_min_length).any())
 
+    def test_sentence_length_processor(self):
+        vocab_size = 20
+        num_beams = 2
+        eos_token_id = 0
+
+        sentence_length_processor = SentenceLengthLogitsProcessor(
+            min_lengths=torch.tensor([6, 3], device=torch_device),
+            max_lengths=torch.tensor([10, 6], device=torch_device),
+            eos_token_id=eos_token_id,
+        )
+
+        # the first sentence is below its min length and the second one is in between its min and max length
+        input_ids = ids_tensor((2 * num_beams, 4), vocab_size=vocab_size)
+        scores = sentence_length_processor(input_ids, self._get_uniform_logits(2 * num_beams, vocab_size))
+        self.assertListEqual(torch.isinf(scores[:, eos_token_id]).tolist(), 2 * [True] + 2 * [False])
+        self.assertFalse(torch.isinf(scores[:, 1:]).any())
+
+        # the second sentence has to end now, even if it is below its min length
+        sentence_length_processor.min_lengths = torch.tensor([6, 8], device=torch_device)
+        input_ids = ids_tensor((2 * num_beams, 5), vocab_size=vocab_size)
+        scores = sentence_length_processor(input_ids, self._get_uniform_logits(2 * num_beams, vocab_size))
+        self.assertListEqual(torch.isinf(scores[:, eos_token_id]).tolist(), 2 * [True] + 2 * [False])
+        self.assertFalse(torch.isinf(scores[:num_beams, 1:]).any())
+        self.assertTrue(torch.isinf(scores[num_beams:, 1:]).all())
+
     def test_temperature_dist_warper(self):
         input_ids = None
         length = 20
@@ -271,6 +297,70 @@ class LogitsProcessorTest(unittest.TestCase):
             [[False, True, False], [False, False, False], [False, False, True], [False, False, False]],
         )
 
+    def _get_banned_ngram_tokens(self, ngram_size, prefix_ids, ngram_ids):
+        # tokens which follow the last `ngram_size - 1` tokens of `prefix_ids` in an n-gram of `ngram_ids`
+        prefix_ids, ngram_ids = prefix_ids.tolist(), ngram_ids.tolist()
+        if len(prefix_ids) + 1 < ngram_size:
+            return set()
+        query = prefix_ids[len(prefix_ids) + 1 - ngram_size :]
+        return {
+            ngram_ids[i + ngram_size - 1]
+            for i in range(len(ngram_ids) - ngram_size + 1)
+            if ngram_ids[i : i + ngram_size - 1] == query
+        }
+
+    def test_no_repeat_ngram_incremental_beam_search(self):
+        batch_size = 3
+        num_beams = 4
+        num_hypos = batch_size * num_beams
+
+        # a large vocabulary with ngram_size 6 does not fit the prefix keys in 63 bits
+        for vocab_size, ngram_size in [(5, 1), (5, 2), (5, 3), (7, 4), (40000, 6)]:
+            processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(ngram_size)])
+            input_ids = ids_tensor((num_hypos, 1), vocab_size=5)
+            for step in range(12):
+                scores = self._get_uniform_logits(num_hypos, vocab_size)
+                filtered_scores = processors(input_ids, scores.clone())
+                for hypo_idx in range(num_hypos):
+                    banned_tokens = self._get_banned_ngram_tokens(ngram_size, input_ids[hypo_idx], input_ids[hypo_idx])
+                    self.assertSetEqual(
+                        set(torch.isinf(filtered_scores[hypo_idx]).nonzero().view(-1).tolist()), banned_tokens
+                    )
+
+                # reorder the beams within each sentence like beam search does
+                beam_idx = torch.arange(num_hypos, device=torch_device) // num_beams * num_beams + ids_tensor(
+                    (num_hypos,), vocab_size=num_beams
+                )
+                input_ids = torch.cat([input_ids[beam_idx], ids_tensor((num_hypos, 1), vocab_size=5)], dim=-1)
+                processors.reorder_state(beam_idx)
+
+            # the state is rebuilt when the input ids do not continue the previous ones
+            input_ids = ids_tensor((num_hypos, 8), vocab_size=5)
+            filtered_scores = processors(input_ids, self._get_uniform_logits(num_hypos, vocab_size))
+            for hypo_idx in range(num_hypos):
+                banned_tokens = self._get_banned_ngram_tokens(ngram_size, input_ids[hypo_idx], input_ids[hypo_idx])
+                self.assertSetEqual(set(torch.isinf(filtered_scores[hypo_idx]).nonzero().view(-1).tolist()), banned_tokens)
+
+    def test_encoder_no_repeat_ngram_batched(self):
+        batch_size = 3
+        num_beams = 2
+        vocab_size = 6
+
+        for ngram_size in [1, 2, 3]:
+            # the encoder input ids do not use the last token of the vocabulary
+            encoder_input_ids = ids_tensor((batch_size, 10), vocab_size=vocab_size - 1)
+            processor = EncoderNoRepeatNGramLogitsProcessor(ngram_size, encoder_input_ids=encoder_input_ids)
+            for length in range(1, 6):
+                input_ids = ids_tensor((batch_size * num_beams, length), vocab_size=vocab_size)
+                filtered_scores = processor(input_ids, self._get_uniform_logits(batch_size * num_beams, vocab_size))
+                for hypo_idx in range(batch_size * num_beams):
+                    banned_tokens = self._get_banned_ngram_tokens(
+                        ngram_size, input_ids[hypo_idx], encoder_input_ids[hypo_idx // num_beams]
+                    )
+                    self.assertSetEqual(
+                        set(torch.isinf(filtered_scores[hypo_idx]).nonzero().view(-1).tolist()), banned_tokens
+                    )
+
     def test_no_bad_words_dist_processor(self):
         vocab_size = 5
         batch_size = 2
@@ -16,8 +16,10 @@
 
 
 import copy
+import importlib.util
 import tempfile
 import unittest
+from unittest import mock
 
 from transformers import is_torch_available
 from transformers.file_utils import cached_property
@@ -41,7 +43,10 @@ if is_torch_available():
         MBartForSequenceClassification,
         MBartModel,
     )
-    from transformers.models.mbart.modeling_mbart import MBartDecoder, MBartEncoder
+    from transformers.models.mbart.export_mbart import MBartExportedModel, export_mbart
+    from transformers.models.mbart.modeling_mbart import MBartDecoder, MBartEncoder, _stack_sources_along_batch
+    from transformers.models.mbart.speculative_mbart import MBartSpeculativeDecoder
+    from transformers.models.mbart.streaming_mbart import MBartStreamingDecoder, compute_latency_metrics
 
 
 def prepare_mbart_inputs_dict(
@@ -209,6 +214,436 @@ class MBartModelTester:
 
         self.parent.assertTrue((last_hidden_state_2 - last_hidden_state).abs().max().item() < 1e-3)
 
+    def check_attention_implementations_equivalence(self, config, inputs_dict, **config_overrides):
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"]
+        extra_inputs = {}
+        if config_overrides.get("multi_source", False):
+            extra_inputs = {"additional_input_ids": input_ids.flip(1), "additional_input_ids_mask": attention_mask.flip(1)}
+
+        outputs = {}
+        for attention_implementation in ["eager", "sdpa", "chunked"]:
+            config = copy.deepcopy(config)
+            config.update(config_overrides)
+            config.attention_implementation = attention_implementation
+            config.attention_chunk_size = 3
+            torch.manual_seed(0)
+            model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+            with torch.no_grad():
+                outputs[attention_implementation] = model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    decoder_input_ids=inputs_dict["decoder_input_ids"],
+                    head_mask=inputs_dict["head_mask"],
+                    decoder_head_mask=inputs_dict["decoder_head_mask"],
+                    **extra_inputs,
+                ).logits
+
+        self.parent.assertTrue(torch.allclose(outputs["eager"], outputs["sdpa"], atol=1e-5))
+        self.parent.assertTrue(torch.allclose(outputs["eager"], outputs["chunked"], atol=1e-5))
+
+    def check_attention_implementations_gradients_equivalence(self, config, inputs_dict, **config_overrides):
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"]
+        extra_inputs = {}
+        if config_overrides.get("multi_source", False):
+            extra_inputs = {"additional_input_ids": input_ids.flip(1), "additional_input_ids_mask": attention_mask.flip(1)}
+
+        losses = {}
+        gradients = {}
+        for attention_implementation in ["eager", "sdpa", "chunked"]:
+            config = copy.deepcopy(config)
+            config.update(config_overrides)
+            config.attention_implementation = attention_implementation
+            config.attention_chunk_size = 3
+            # dropout would make the implementations diverge, but training mode is needed for the recomputation of the chunked attention in the backward pass
+            config.dropout = 0.0
+            config.attention_dropout = 0.0
+            config.activation_dropout = 0.0
+            config.encoder_layerdrop = 0.0
+            config.decoder_layerdrop = 0.0
+            torch.manual_seed(0)
+            model = MBartForConditionalGeneration(config=config).to(torch_device).train()
+            loss = model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                decoder_input_ids=inputs_dict["decoder_input_ids"],
+                labels=inputs_dict["decoder_input_ids"],
+                **extra_inputs,
+            ).loss
+            loss.backward()
+            losses[attention_implementation] = loss.detach()
+            gradients[attention_implementation] = {
+                name: param.grad for name, param in model.named_parameters() if param.grad is not None
+            }
+
+        self.parent.assertTrue(len(gradients["eager"]) > 0)
+        for attention_implementation in ["sdpa", "chunked"]:
+            self.parent.assertTrue(torch.allclose(losses["eager"], losses[attention_implementation], atol=1e-5))
+            self.parent.assertEqual(gradients["eager"].keys(), gradients[attention_implementation].keys())
+            for name, gradient in gradients["eager"].items():
+                self.parent.assertTrue(torch.allclose(gradient, gradients[attention_implementation][name], atol=1e-5))
+
+    def check_static_kv_cache_equivalence(self, config, inputs_dict, **config_overrides):
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"]
+        extra_inputs = {}
+        if config_overrides.get("multi_source", False):
+            extra_inputs = {"additional_input_ids": input_ids.flip(1), "additional_input_ids_mask": attention_mask.flip(1)}
+
+        for generation_kwargs in [{"num_beams": 1}, {"num_beams": 3}]:
+            outputs = {}
+            for static_kv_cache in [False, True]:
+                config = copy.deepcopy(config)
+                config.update(config_overrides)
+                config.static_kv_cache = static_kv_cache
+                torch.manual_seed(0)
+                model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+                with torch.no_grad():
+                    outputs[static_kv_cache] = model.generate(
+                        input_ids,
+                        attention_mask=attention_mask,
+                        max_length=10,
+                        min_length=10,
+                        **generation_kwargs,
+                        **extra_inputs,
+                    )
+            self.parent.assertListEqual(outputs[False].tolist(), outputs[True].tolist())
+
+    def check_encoder_outputs_shared_across_beams(self, config, inputs_dict, **config_overrides):
+        config = copy.deepcopy(config)
+        config.update(config_overrides)
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        num_beams = 3
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"]
+        attention_mask[0, -2:] = 0
+        decoder_input_ids = inputs_dict["decoder_input_ids"].repeat_interleave(num_beams, dim=0)
+        decoder_input_ids[1::num_beams, -1] = config.eos_token_id ## The beams of a sentence should differ.
+
+        with torch.no_grad():
+            encoder_outputs = model.get_encoder()(input_ids, attention_mask=attention_mask)
+            additional_encoder_outputs = model.get_encoder()(input_ids.flip(1), attention_mask=attention_mask.flip(1))
+            outputs = {}
+            for shared in [True, False]:
+                expand = (lambda tensor: tensor) if shared else (lambda tensor: tensor.repeat_interleave(num_beams, dim=0))
+                extra_inputs = {}
+                if config.multi_source:
+                    extra_inputs = {
+                        "additional_encoder_outputs": (expand(additional_encoder_outputs[0]),),
+                        "additional_input_ids_mask": expand(attention_mask.flip(1)),
+                    }
+                outputs[shared] = model(
+                    encoder_outputs=(expand(encoder_outputs[0]),),
+                    attention_mask=expand(attention_mask),
+                    decoder_input_ids=decoder_input_ids,
+                    output_attentions=config.attention_implementation == "eager",
+                    **extra_inputs,
+                )
+
+        self.parent.assertTrue(torch.allclose(outputs[True].logits, outputs[False].logits, atol=1e-5))
+        if config.attention_implementation == "eager":
+            for shared_cross_attentions, cross_attentions in zip(outputs[True].cross_attentions, outputs[False].cross_attentions):
+                self.parent.assertTrue(torch.allclose(shared_cross_attentions, cross_attentions, atol=1e-5))
+
+    def check_average_softmaxes_equivalence(self, config, inputs_dict):
+        config = copy.deepcopy(config)
+        config.update({"multi_source": True, "multi_source_method": "average_softmaxes"})
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"].long()
+        attention_mask[0, -2:] = 0
+        additional_input_ids, additional_input_ids_mask = input_ids.flip(1)[:, 2:], attention_mask.flip(1)[:, 2:] ## The sources have different lengths.
+        decoder_input_ids = inputs_dict["decoder_input_ids"]
+
+        with torch.no_grad():
+            outputs = model(
+                input_ids,
+                attention_mask=attention_mask,
+                decoder_input_ids=decoder_input_ids,
+                additional_input_ids=additional_input_ids,
+                additional_input_ids_mask=additional_input_ids_mask,
+            )
+            encoder_outputs = model.get_encoder()(input_ids, attention_mask=attention_mask)
+            additional_encoder_outputs = model.get_encoder()(additional_input_ids, attention_mask=additional_input_ids_mask)
+            outputs_from_encoder_outputs = model(
+                encoder_outputs=encoder_outputs,
+                attention_mask=attention_mask,
+                decoder_input_ids=decoder_input_ids,
+                additional_encoder_outputs=additional_encoder_outputs,
+                additional_input_ids_mask=additional_input_ids_mask,
+            )
+            for source_input_ids, source_attention_mask, source_logits, source_encoder_last_hidden_states in [
+                (input_ids, attention_mask, outputs.logits, [outputs.encoder_last_hidden_state, outputs_from_encoder_outputs.encoder_last_hidden_state]),
+                (additional_input_ids, additional_input_ids_mask, outputs.additional_source_lm_logits, [outputs.additional_encoder_last_hidden_state, outputs_from_encoder_outputs.additional_encoder_last_hidden_state]),
+            ]: ## Each source on its own.
+                encoder_hidden_states = model.model.encoder(source_input_ids, attention_mask=source_attention_mask)[0]
+                for source_encoder_last_hidden_state in source_encoder_last_hidden_states: ## The encoder states of each source are returned separately whether or not the encoder outputs are passed in.
+                    self.parent.assertEqual(source_encoder_last_hidden_state.size(), encoder_hidden_states.size())
+                    self.parent.assertTrue(torch.allclose(source_encoder_last_hidden_state, encoder_hidden_states, atol=1e-5))
+                decoder_hidden_states = model.model.decoder(
+                    decoder_input_ids, encoder_hidden_states=encoder_hidden_states, encoder_attention_mask=source_attention_mask
+                )[0]
+                expected_logits = model.lm_head(decoder_hidden_states) + model.final_logits_bias
+                self.parent.assertTrue(torch.allclose(source_logits, expected_logits, atol=1e-5))
+
+            max_length = 10
+            expected_ids = torch.full(
+                (input_ids.size(0), 1), model._get_decoder_start_token_id(None, None), dtype=torch.long, device=torch_device
+            )
+            for _ in range(max_length - 1): ## Greedy decoding with the logits of each source computed on its own and then averaged.
+                next_token_logits = []
+                for source_encoder_outputs, source_attention_mask in [
+                    (encoder_outputs, attention_mask),
+                    (additional_encoder_outputs, additional_input_ids_mask),
+                ]:
+                    decoder_hidden_states = model.model.decoder(
+                        expected_ids, encoder_hidden_states=source_encoder_outputs[0], encoder_attention_mask=source_attention_mask
+                    )[0]
+                    next_token_logits.append(model.lm_head(decoder_hidden_states[:, -1]) + model.final_logits_bias[0])
+                expected_ids = torch.cat([expected_ids, ((next_token_logits[0] + next_token_logits[1]) / 2).argmax(-1, keepdim=True)], dim=-1)
+
+            generation_kwargs = {
+                "attention_mask": attention_mask,
+                "additional_input_ids": additional_input_ids,
+                "additional_input_ids_mask": additional_input_ids_mask,
+                "max_length": max_length,
+                "min_length": 0,
+            }
+            with mock.patch(
+                "transformers.models.mbart.modeling_mbart._stack_sources_along_batch", wraps=_stack_sources_along_batch
+            ) as stack_sources_along_batch:
+                output_ids = model.generate(input_ids, num_beams=1, **generation_kwargs)
+                self.parent.assertEqual(stack_sources_along_batch.call_count, 2) ## The encoder states and the masks are stacked once and not at every step.
+            for generated_ids, sentence_expected_ids in zip(output_ids.tolist(), expected_ids.tolist()):
+                length = sentence_expected_ids.index(config.eos_token_id) + 1 if config.eos_token_id in sentence_expected_ids else max_length
+                self.parent.assertListEqual(generated_ids[:length], sentence_expected_ids[:length])
+
+            output_ids = model.generate(input_ids, num_beams=3, **generation_kwargs)
+            with mock.patch.object(model, "stack_sources_for_generation", lambda model_kwargs: model_kwargs): ## The sources are stacked at every step.
+                per_step_output_ids = model.generate(input_ids, num_beams=3, **generation_kwargs)
+            self.parent.assertListEqual(output_ids.tolist(), per_step_output_ids.tolist())
+
+    def check_sentence_lengths_independent_of_batch(self, config, inputs_dict, **generation_kwargs):
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        input_ids = inputs_dict["input_ids"].clone()
+        attention_mask = inputs_dict["attention_mask"].long()
+        input_ids[0, -3:] = config.pad_token_id
+        attention_mask[0, -3:] = 0
+        source_lengths = attention_mask.sum(dim=1)
+
+        with torch.no_grad():
+            batch_output_ids = model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                sentence_min_lengths=source_lengths // 2,
+                sentence_max_lengths=source_lengths * 2,
+                **generation_kwargs,
+            )
+            for i, source_length in enumerate(source_lengths.tolist()): ## Each sentence on its own without padding.
+                output_ids = model.generate(
+                    input_ids[i : i + 1, :source_length],
+                    attention_mask=attention_mask[i : i + 1, :source_length],
+                    sentence_min_lengths=source_lengths[i : i + 1] // 2,
+                    sentence_max_lengths=source_lengths[i : i + 1] * 2,
+                    **generation_kwargs,
+                )[0]
+                batch_output = batch_output_ids[i][batch_output_ids[i] != config.pad_token_id]
+                self.parent.assertListEqual(batch_output.tolist(), output_ids[output_ids != config.pad_token_id].tolist())
+                self.parent.assertLessEqual(len(batch_output), 2 * source_length)
+                if len(batch_output) == 2 * source_length:
+                    self.parent.assertEqual(batch_output[-1].item(), config.eos_token_id)
+
+    def check_vocabulary_shortlist(self, config, inputs_dict, **config_overrides):
+        config = copy.deepcopy(config)
+        config.update(config_overrides)
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"]
+
+        with torch.no_grad():
+            full_output_ids = model.generate(input_ids, attention_mask=attention_mask, max_length=10, min_length=10)
+            vocabulary_shortlist = torch.unique(torch.cat([full_output_ids.view(-1), torch.arange(5, device=torch_device)]))
+            shortlist_output_ids = model.generate(
+                input_ids, attention_mask=attention_mask, max_length=10, min_length=10, vocabulary_shortlist=vocabulary_shortlist
+            )
+            self.parent.assertListEqual(full_output_ids.tolist(), shortlist_output_ids.tolist()) ## The greedy choices are in the shortlist.
+            self.parent.assertIsNone(model.vocabulary_shortlist)
+
+            decoder_input_ids = inputs_dict["decoder_input_ids"]
+            full_logits = model(input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids).logits
+            model.set_vocabulary_shortlist(vocabulary_shortlist)
+            shortlist_logits = model(input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids).logits
+            model.set_vocabulary_shortlist(None)
+            in_shortlist = torch.zeros(config.vocab_size, dtype=torch.bool, device=torch_device)
+            in_shortlist[vocabulary_shortlist] = True
+            self.parent.assertTrue(torch.allclose(shortlist_logits[..., in_shortlist], full_logits[..., in_shortlist], atol=1e-5))
+            self.parent.assertTrue(torch.isinf(shortlist_logits[..., ~in_shortlist]).all())
+
+            beam_output_ids = model.generate(
+                input_ids, attention_mask=attention_mask, max_length=10, num_beams=3, vocabulary_shortlist=vocabulary_shortlist
+            )
+            self.parent.assertTrue(in_shortlist[beam_output_ids].all())
+
+    def check_early_exit(self, config, inputs_dict, **config_overrides):
+        config = copy.deepcopy(config)
+        config.update({"multilayer_softmaxing": True})
+        config.update(config_overrides)
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"]
+        num_layers = len(model.model.decoder.layers)
+
+        with torch.no_grad():
+            output_ids = model.generate(input_ids, attention_mask=attention_mask, max_length=10, min_length=10)
+            never_exit_output_ids = model.generate(input_ids, attention_mask=attention_mask, max_length=10, min_length=10, early_exit_threshold=1.1)
+            self.parent.assertListEqual(output_ids.tolist(), never_exit_output_ids.tolist())
+            self.parent.assertEqual(model.early_exit_num_layers_used, num_layers * model.early_exit_num_steps)
+            self.parent.assertIsNone(model.early_exit)
+
+            should_exit_early = model._should_exit_early
+            num_calls = [0]
+            def exit_every_other_step(hidden_states): ## Exit after the first layer in every other step.
+                _, lm_logits = should_exit_early(hidden_states)
+                num_calls[0] += 1
+                return num_calls[0] % 2 == 0, lm_logits
+            model._should_exit_early = exit_every_other_step
+
+            outputs = {}
+            for static_kv_cache in [False, True]:
+                model.config.static_kv_cache = static_kv_cache
+                for num_beams in [1, 3]:
+                    num_calls[0] = 0
+                    outputs[(static_kv_cache, num_beams)] = model.generate(
+                        input_ids, attention_mask=attention_mask, max_length=10, min_length=10, num_beams=num_beams, early_exit_threshold=0.0
+                    )
+            for num_beams in [1, 3]:
+                self.parent.assertListEqual(outputs[(False, num_beams)].tolist(), outputs[(True, num_beams)].tolist())
+
+            if num_layers == 2: ## The keys and values which the last layer computes from the output of the first layer are exact so generating without any cache is a reference.
+                decoder_input_ids = torch.full((input_ids.size(0), 1), model._get_decoder_start_token_id(), dtype=torch.long, device=torch_device)
+                for step in range(9):
+                    step_outputs = model(input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids, output_hidden_states=True, use_cache=False)
+                    next_token_logits = model.compute_lm_logits(step_outputs.decoder_hidden_states[1])[:, -1] if step % 2 == 1 else step_outputs.logits[:, -1]
+                    next_token_logits[:, config.eos_token_id] = -float("inf")
+                    decoder_input_ids = torch.cat([decoder_input_ids, next_token_logits.argmax(dim=-1, keepdim=True)], dim=-1)
+                self.parent.assertListEqual(outputs[(False, 1)].tolist(), decoder_input_ids.tolist())
+
+    def check_speculative_decoding_equivalence(self, config, inputs_dict, draft_overrides=None, **generation_kwargs):
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        draft_config = copy.deepcopy(config)
+        draft_config.update(draft_overrides if draft_overrides is not None else {})
+        draft_model = MBartForConditionalGeneration(config=draft_config).to(torch_device).eval() if draft_overrides is not None else model
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"]
+
+        with torch.no_grad():
+            output_ids = model.generate(input_ids, attention_mask=attention_mask, max_length=12, **generation_kwargs)
+        for num_draft_tokens in [1, 3]:
+            speculative_decoder = MBartSpeculativeDecoder(model, draft_model, num_draft_tokens=num_draft_tokens)
+            speculative_output_ids = speculative_decoder.generate(input_ids, attention_mask=attention_mask, max_length=12, **generation_kwargs)
+            self.parent.assertListEqual(output_ids.tolist(), speculative_output_ids.tolist())
+            if draft_overrides is None: ## The model agrees with itself.
+                self.parent.assertEqual(speculative_decoder.acceptance_rate(), 1.0)
+
+    def check_speculative_sampling_distribution(self, config, inputs_dict, num_samples=4000, **generation_kwargs):
+        torch.manual_seed(0)
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        draft_config = copy.deepcopy(config)
+        draft_config.update({"decoder_layers": 1})
+        draft_model = MBartForConditionalGeneration(config=draft_config).to(torch_device).eval()
+        input_ids = inputs_dict["input_ids"][:1].repeat(num_samples, 1) ## The rows are independent samples of the same sentence.
+        attention_mask = inputs_dict["attention_mask"][:1].repeat(num_samples, 1)
+        decoder_input_ids = torch.full((1, 1), model._get_decoder_start_token_id(), dtype=torch.long, device=torch_device)
+
+        with torch.no_grad():
+            logits_warper = model._get_logits_warper(num_beams=1, **generation_kwargs)
+            probs, draft_probs = [
+                logits_warper(decoder_input_ids, m(input_ids[:1], attention_mask=attention_mask[:1], decoder_input_ids=decoder_input_ids).logits[:, -1, :]).softmax(dim=-1)[0]
+                for m in [model, draft_model]
+            ]
+        ## The draft model should differ enough from the model for the rejected proposals to matter.
+        self.parent.assertGreater((probs - draft_probs).abs().sum().item() / 2, 0.2)
+        speculative_decoder = MBartSpeculativeDecoder(model, draft_model, num_draft_tokens=3)
+        torch.manual_seed(0)
+        output_ids = speculative_decoder.generate(input_ids, attention_mask=attention_mask, max_length=4, do_sample=True, **generation_kwargs)
+        self.parent.assertLess(speculative_decoder.acceptance_rate(), 1.0)
+        ## The first token of each row is the draft proposal if accepted and a sample from the residual distribution otherwise.
+        sampled_probs = torch.bincount(output_ids[:, 1], minlength=config.vocab_size).double() / num_samples
+        self.parent.assertLess((sampled_probs - probs.double()).abs().max().item(), 0.03)
+
+    def check_encoder_past_equivalence(self, config, inputs_dict, **config_overrides):
+        config = copy.deepcopy(config)
+        config.update(config_overrides)
+        encoder = MBartEncoder(config=config).to(torch_device).eval()
+        input_ids = inputs_dict["input_ids"]
+        attention_mask = inputs_dict["attention_mask"].long()
+        attention_mask[0, -2:] = 0
+        with torch.no_grad():
+            expected_hidden_states = encoder(input_ids, attention_mask=attention_mask).last_hidden_state
+            past_key_values = None
+            hidden_states = []
+            for start, end in [(0, 3), (3, 4), (4, input_ids.size(1))]: ## The source arrives in chunks of different sizes.
+                outputs = encoder(
+                    input_ids[:, start:end],
+                    attention_mask=attention_mask[:, :end],
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                past_key_values = outputs.past_key_values
+                self.parent.assertEqual(past_key_values[0][0].size(2), end)
+                hidden_states.append(outputs.last_hidden_state)
+        self.parent.assertTrue(torch.allclose(torch.cat(hidden_states, dim=1), expected_hidden_states, atol=1e-5))
+
+    def check_streaming_equivalence(self, config, inputs_dict, tokens_per_read=1, **config_overrides):
+        config = copy.deepcopy(config)
+        config.update(config_overrides)
+        torch.manual_seed(0)
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        streaming_decoder = MBartStreamingDecoder(model, max_length=10, min_length=3)
+        for input_ids in inputs_dict["input_ids"][:4]:
+            with torch.no_grad():
+                expected_output_ids = model.generate(input_ids[None, :], max_length=10, min_length=3, num_beams=1)[0]
+            streaming_decoder.reset()
+            output_ids = [streaming_decoder.decoder_start_token_id]
+            for start in range(0, len(input_ids), tokens_per_read):
+                output_ids += streaming_decoder.read(input_ids[start : start + tokens_per_read])
+            output_ids += streaming_decoder.finish()
+            self.parent.assertListEqual(expected_output_ids.tolist()[: len(output_ids)], output_ids)
+            self.parent.assertTrue(len(output_ids) == len(expected_output_ids) or output_ids[-1] == config.eos_token_id)
+            self.parent.assertEqual(len(streaming_decoder.delays), len(output_ids) - 1)
+            if tokens_per_read == 1: ## The i-th token should wait for exactly i+k-1 source tokens.
+                expected_delays = [min(i + config.wait_k, len(input_ids)) for i in range(len(output_ids) - 1)]
+                self.parent.assertListEqual(streaming_decoder.delays, expected_delays)
+
+    def check_export_equivalence(self, config, inputs_dict, export_format="torchscript", **config_overrides):
+        config = copy.deepcopy(config)
+        config.update(config_overrides)
+        torch.manual_seed(0)
+        model = MBartForConditionalGeneration(config=config).eval()
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            export_mbart(model, tmpdirname, export_format=export_format)
+            exported_model = MBartExportedModel(tmpdirname)
+            ## The graphs are traced with a source of length 7 so the parity is checked at other lengths to make sure that the source length is dynamic.
+            for seq_length in [self.seq_length - 2, self.seq_length + 4]:
+                input_ids = ids_tensor([self.batch_size, seq_length], self.vocab_size).clamp(3).cpu()
+                input_ids[:, -1] = self.eos_token_id
+                attention_mask = torch.ones_like(input_ids)
+                attention_mask[0, -2:] = 0
+                extra_inputs = {}
+                if config.multi_source: ## The additional source is shorter so that the two sources have different lengths.
+                    extra_inputs = {"additional_input_ids": input_ids.flip(1)[:, 1:], "additional_input_ids_mask": attention_mask.flip(1)[:, 1:]}
+                for generation_kwargs in [{"num_beams": 1}, {"num_beams": 3, "num_return_sequences": 2}]:
+                    with torch.no_grad():
+                        expected_output_ids = model.generate(
+                            input_ids, attention_mask=attention_mask, max_length=10, min_length=3, **generation_kwargs, **extra_inputs
+                        )
+                    output_ids = exported_model.generate(
+                        input_ids, attention_mask=attention_mask, max_length=10, min_length=3, **generation_kwargs, **extra_inputs
+                    )
+                    self.parent.assertListEqual(expected_output_ids.tolist(), output_ids.tolist())
+
 
 @require_torch
 class MBartModelTest(ModelTesterMixin, GenerationTesterMixin, unittest.TestCase):
@@ -247,6 +682,219 @@ class MBartModelTest(ModelTesterMixin, GenerationTesterMixin, unittest.TestCase)
         config_and_inputs = self.model_tester.prepare_config_and_inputs_for_common()
         self.model_tester.check_encoder_decoder_model_standalone(*config_and_inputs)
 
+    def test_attention_implementations(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_attention_implementations_equivalence(*config_and_inputs)
+
+    def test_attention_implementations_wait_k(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_attention_implementations_equivalence(*config_and_inputs, wait_k=2)
+
+    def test_attention_implementations_multi_source(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_attention_implementations_equivalence(
+            *config_and_inputs, multi_source=True, multi_source_method="merge_after_attention"
+        )
+
+    def test_attention_implementations_gradients(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_attention_implementations_gradients_equivalence(*config_and_inputs)
+
+    def test_attention_implementations_gradients_wait_k(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_attention_implementations_gradients_equivalence(*config_and_inputs, wait_k=2)
+
+    def test_attention_implementations_gradients_multi_source(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_attention_implementations_gradients_equivalence(
+            *config_and_inputs, multi_source=True, multi_source_method="merge_after_attention"
+        )
+
+    def test_static_kv_cache(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_static_kv_cache_equivalence(*config_and_inputs)
+
+    def test_static_kv_cache_multi_source(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_static_kv_cache_equivalence(
+            *config_and_inputs, multi_source=True, multi_source_method="merge_after_attention"
+        )
+
+    def test_encoder_outputs_shared_across_beams(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_encoder_outputs_shared_across_beams(*config_and_inputs)
+
+    def test_encoder_outputs_shared_across_beams_sdpa(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_encoder_outputs_shared_across_beams(*config_and_inputs, attention_implementation="sdpa")
+
+    def test_encoder_outputs_shared_across_beams_multi_source(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_encoder_outputs_shared_across_beams(
+            *config_and_inputs, multi_source=True, multi_source_method="merge_after_attention"
+        )
+
+    def test_average_softmaxes_single_pass(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_average_softmaxes_equivalence(*config_and_inputs)
+
+    def test_static_kv_cache_average_softmaxes(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_static_kv_cache_equivalence(
+            *config_and_inputs, multi_source=True, multi_source_method="average_softmaxes"
+        )
+
+    def test_sentence_lengths_greedy(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_sentence_lengths_independent_of_batch(*config_and_inputs, num_beams=1)
+
+    def test_sentence_lengths_beam_search(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_sentence_lengths_independent_of_batch(*config_and_inputs, num_beams=3, early_stopping=True)
+
+    def test_vocabulary_shortlist(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_vocabulary_shortlist(*config_and_inputs)
+
+    def test_vocabulary_shortlist_static_kv_cache(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_vocabulary_shortlist(*config_and_inputs, static_kv_cache=True)
+
+    def test_early_exit(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_early_exit(*config_and_inputs)
+
+    def test_early_exit_three_layers(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_early_exit(*config_and_inputs, decoder_layers=3)
+
+    def test_early_exit_needs_multilayer_softmaxing(self):
+        config, _ = self.model_tester.prepare_config_and_inputs()
+        model = MBartForConditionalGeneration(config=config).to(torch_device).eval()
+        with self.assertRaises(ValueError):
+            model.set_early_exit(0.9)
+
+    def test_speculative_decoding_greedy(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_speculative_decoding_equivalence(*config_and_inputs, draft_overrides={"decoder_layers": 1, "encoder_layers": 1, "d_model": 8})
+
+    def test_speculative_decoding_greedy_min_length_no_repeat_ngram(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_speculative_decoding_equivalence(
+            *config_and_inputs, draft_overrides={"decoder_layers": 1}, min_length=8, no_repeat_ngram_size=2
+        )
+
+    def test_speculative_decoding_self_draft(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_speculative_decoding_equivalence(*config_and_inputs)
+
+    def test_speculative_decoding_sampling_top_1(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_speculative_decoding_equivalence(
+            *config_and_inputs, draft_overrides={"decoder_layers": 1}, do_sample=True, top_k=1
+        )
+
+    def test_speculative_decoding_sampling_distribution(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_speculative_sampling_distribution(*config_and_inputs, top_k=5, temperature=0.5)
+
+    def test_speculative_decoding_draft_vocabulary(self):
+        config, _ = self.model_tester.prepare_config_and_inputs()
+        draft_config = copy.deepcopy(config)
+        draft_config.vocab_size = config.vocab_size + 1
+        with self.assertRaises(ValueError):
+            MBartSpeculativeDecoder(MBartForConditionalGeneration(config), MBartForConditionalGeneration(draft_config))
+
+    def test_encoder_past_unidirectional_encoder(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_encoder_past_equivalence(*config_and_inputs, unidirectional_encoder=True)
+
+    def test_encoder_past_wait_k_positional_encodings(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_encoder_past_equivalence(*config_and_inputs, wait_k=2, positional_encodings=True)
+
+    def test_encoder_past_sdpa(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_encoder_past_equivalence(
+            *config_and_inputs, unidirectional_encoder=True, attention_implementation="sdpa"
+        )
+
+    def test_encoder_past_needs_unidirectional_encoder(self):
+        config, inputs_dict = self.model_tester.prepare_config_and_inputs()
+        encoder = MBartEncoder(config=config).to(torch_device).eval()
+        with self.assertRaises(ValueError):
+            encoder(inputs_dict["input_ids"], use_cache=True)
+
+    def test_streaming_wait_k(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_streaming_equivalence(*config_and_inputs, wait_k=2)
+
+    def test_streaming_wait_k_multiple_tokens_per_read(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_streaming_equivalence(*config_and_inputs, tokens_per_read=3, wait_k=3)
+
+    def test_streaming_needs_unidirectional_encoder(self):
+        config, _ = self.model_tester.prepare_config_and_inputs()
+        model = MBartForConditionalGeneration(config=config).eval()
+        with self.assertRaises(ValueError):
+            MBartStreamingDecoder(model, wait_k=2)
+
+    def test_latency_metrics(self):
+        metrics = compute_latency_metrics([2, 3, 4, 4], source_length=4) ## Wait-2 with equally long source and target lags by 2 tokens.
+        self.assertAlmostEqual(metrics["average_lagging"], 2.0)
+        self.assertAlmostEqual(metrics["average_proportion"], 13 / 16)
+        self.assertAlmostEqual(metrics["differentiable_average_lagging"], 2.0)
+
+    def test_export_torchscript(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_export_equivalence(*config_and_inputs)
+
+    def test_export_torchscript_wait_k(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_export_equivalence(*config_and_inputs, wait_k=2)
+
+    def test_export_torchscript_unidirectional_encoder_positional_encodings(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_export_equivalence(
+            *config_and_inputs, unidirectional_encoder=True, positional_encodings=True
+        )
+
+    def test_export_torchscript_multi_source_merge_after_attention(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_export_equivalence(
+            *config_and_inputs,
+            multi_source=True,
+            multi_source_method="merge_after_attention",
+            wait_k=3,
+            additional_source_wait_k=2,
+        )
+
+    def test_export_torchscript_multi_source_merge_before_attention(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_export_equivalence(
+            *config_and_inputs, multi_source=True, multi_source_method="self_relevance_and_merge_before_attention"
+        )
+
+    def test_export_unsupported_multi_source_method(self):
+        config, _ = self.model_tester.prepare_config_and_inputs()
+        config.update({"multi_source": True, "multi_source_method": "average_softmaxes"})
+        model = MBartForConditionalGeneration(config=config).eval()
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with self.assertRaises(ValueError):
+                export_mbart(model, tmpdirname)
+
+    @unittest.skipUnless(importlib.util.find_spec("onnxruntime") is not None, "test requires onnxruntime")
+    def test_export_onnx_wait_k(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_export_equivalence(*config_and_inputs, export_format="onnx", wait_k=2)
+
+    @unittest.skipUnless(importlib.util.find_spec("onnxruntime") is not None, "test requires onnxruntime")
+    def test_export_onnx_multi_source_merge_after_attention(self):
+        config_and_inputs = self.model_tester.prepare_config_and_inputs()
+        self.model_tester.check_export_equivalence(
+            *config_and_inputs, export_format="onnx", multi_source=True, multi_source_method="merge_after_attention"
+        )
+
     # MBartForSequenceClassification does not support inputs_embeds
     def test_inputs_embeds(self):
         config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()